@@ -50,6 +50,8 @@ class Constants:
 
     
     def matchDiam(self, i):
+        # Other PSL columns are identified by their header
+        if isinstance(i, str): return i
         if i == 0: return "Spherical"
         elif i == 1: return "Mobility"
         elif i == 2: return "Collision"
@@ -105,6 +107,50 @@ def usage():
     print("-p, --psd <arg>   write PSDs from a PSL file (CSV format)")
     print("-t, --time <arg>  write stats from a trajectory to XML file at time given")
     print("                  (default end time of simulation)")
+    print("--cache           keep the parsed columns of the CSVs in a binary cache in")
+    print("                  ~/.mops_cache, and load them from it the next time")
+    print("--no-cache        parse the CSVs without the cache (the default)")
+    print("\nPSD OPTIONS:")
+    print("-b, --bandwidth <arg> bandwidth: auto (rule of thumb), sj (Sheather-Jones),")
+    print("                  lscv (least-squares cross-validation) or a value")
+    print("--bootstrap <arg> number of bootstrap replicates for 95% confidence bands")
+    print("--jobs <arg>      processes for the bootstrap (default number of CPUs)")
+    print("--joint <arg>     also write the joint PSD of two PSL columns, given as")
+    print("                  'header,header' (names or patterns, requires -p)")
+    print("-e, --engine <arg> kernel engine (direct, numpy, binned, window, prefix,")
+    print("                  or auto for the fastest within --accuracy)")
+    print("--accuracy <arg>  error of the auto engine relative to the kernel peak")
+    print("                  (default 1e-6)")
+    print("--benchmark <arg> write the runtime and error of each engine to a CSV")
+    print("-k, --kernel <arg> kernel (Gaussian, Epanechnikov, Biweight, Triweight,")
+    print("                  Uniform)")
+    print("-l, --log         KDE on ln(d) with a geometric mesh")
+    print("--variable        variable-bandwidth KDE (Abramson), narrower in the")
+    print("                  peaks and wider in the tails")
+    print("-n, --points <arg> number of mesh points (default 64)")
+    print("--bins <arg>      weighted histogram instead of the KDE, with fd")
+    print("                  (Freedman-Diaconis), sturges or a number of bins")
+    print("-c, --columns <arg> comma-separated PSL columns (headers or patterns) to")
+    print("                  analyse instead of the diameters, e.g. 'Age,Num coags'")
+    print("--collapse <arg>  relative tolerance for merging equal diameters, e.g. 0")
+    print("                  for exactly equal ones (default off, keeps every particle)")
+    print("--cutoff <arg>    window engine half-width in bandwidths (default 8)")
+    print("--means           only write means and moments to XML (no PSD)")
+    print("--storage <arg>   particle storage: list, double (typed arrays) or")
+    print("                  float (single-precision diameters, least memory)")
+    print("--mesh <arg>      mesh type (uniform, adaptive)")
+    print("--quantile-method <arg> d10/d50/d90 from the mesh or exact kernel CDF")
+    print("                  (mesh, exact)")
+    print("--quantiles <arg> comma-separated percentiles of the particles to write")
+    print("                  to XML (default 10,50,90)")
+    print("--sweep <arg>     also write PSDs for a comma-separated list of bandwidths")
+    print("                  (one column each, requires -p); like -b, these are")
+    print("                  widths in ln(d) with -l")
+    print("--tol <arg>       relative tolerance of adaptive mesh statistics")
+    print("                  (default 1e-3)")
+    print("--trim <arg>      quantile trimmed from the adaptive mesh bounds")
+    print("--weighted        also write surface, volume and mass-weighted PSDs")
+    print("                  (extra columns of the -p files)")
 
 if __name__ == "__main__":
     head()
@@ -115,12 +161,28 @@ if __name__ == "__main__":
     xmlOut   = False
     psdOut   = False
     timeOut  = None
+    kdeOpts  = {}
+    bandwidth = -1
+    sweep    = None
+    quantiles = None
+    meansOnly = False
+    bootstrap = 0
+    jobs     = None
+    joint    = None
+    weighted = False
+    columns  = None
+    benchmark = None
+    useCache = False
     
     try:
         opts, args = getopt.getopt(sys.argv[1:],\
-                                   "ahd:i:p:t:x:",\
-                                   ["auto", "help", "input=", "psd=", "time=",\
-                                     "xml="]) 
+                                   "ab:c:hd:e:i:k:ln:p:t:x:",\
+                                   ["accuracy=", "auto", "bandwidth=", "benchmark=", "bins=", "bootstrap=", "cache", "collapse=", "columns=", \
+                                    "cutoff=", "help", "engine=", "input=", "jobs=", \
+                                    "joint=", \
+                                    "kernel=", "log", "means", "mesh=", "no-cache", "points=", "psd=", \
+                                    "quantile-method=", "quantiles=", "storage=", "sweep=", \
+                                    "time=", "tol=", "trim=", "variable", "weighted", "xml="]) 
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -137,11 +199,135 @@ if __name__ == "__main__":
             rundir = arg
             print("Changing to directory {0}.".format(rundir))
             os.chdir(rundir)
+        elif opt in ["-b", "--bandwidth"]:
+            if str(arg).lower() in ["auto", "sj", "lscv"]:
+                bandwidth = str(arg).lower()
+            else:
+                try:
+                    bandwidth = float(arg)
+                except:
+                    print(Constants.tcWARNING + \
+                          "Couldn't get bandwidth, using automatic." + 
+                          Constants.tcENDC)
+                    bandwidth = -1
+        elif opt == "--bootstrap":
+            try:
+                bootstrap = int(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get bootstrap replicates, not bootstrapping." + 
+                      Constants.tcENDC)
+                bootstrap = 0
+        elif opt == "--jobs":
+            try:
+                jobs = int(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get number of processes, using all CPUs." + 
+                      Constants.tcENDC)
+                jobs = None
+        elif opt == "--joint":
+            joint = str(arg).split(",")
+            if len(joint) != 2:
+                print(Constants.tcWARNING + \
+                      "Couldn't get two joint PSD columns, not writing it." + 
+                      Constants.tcENDC)
+                joint = None
+        elif opt in ["-c", "--columns"]:
+            columns = [c.strip() for c in str(arg).split(",") if c.strip() != ""]
+            if len(columns) == 0: columns = None
+        elif opt == "--weighted":
+            weighted = True
+        elif opt == "--accuracy":
+            try:
+                kdeOpts["accuracy"] = float(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get engine accuracy, using default." + 
+                      Constants.tcENDC)
+        elif opt == "--benchmark":
+            benchmark = str(arg)
+        elif opt == "--bins":
+            kdeOpts["bins"] = str(arg).lower()
+        elif opt in ["-e", "--engine"]:
+            kdeOpts["engine"] = str(arg)
+        elif opt == "--collapse":
+            if str(arg).lower() in ["off", "none"]:
+                kdeOpts["collapse"] = None
+            else:
+                try:
+                    kdeOpts["collapse"] = float(arg)
+                except:
+                    print(Constants.tcWARNING + \
+                          "Couldn't get collapse tolerance, keeping every particle." + 
+                          Constants.tcENDC)
+        elif opt == "--cutoff":
+            try:
+                kdeOpts["cutoff"] = float(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get window cutoff, using default." + 
+                      Constants.tcENDC)
         elif opt in ["-i", "--input"]:
             fname = arg
             guiMode = False
+        elif opt in ["-k", "--kernel"]:
+            kdeOpts["kernel"] = str(arg)
+        elif opt in ["-l", "--log"]:
+            kdeOpts["logspace"] = True
+        elif opt == "--means":
+            meansOnly = True
+        elif opt == "--storage":
+            kdeOpts["storage"] = str(arg).lower()
+        elif opt == "--variable":
+            kdeOpts["variable"] = True
+        elif opt == "--mesh":
+            kdeOpts["mesh"] = str(arg)
+        elif opt == "--cache":
+            useCache = True
+        elif opt == "--no-cache":
+            useCache = False
+        elif opt == "--tol":
+            try:
+                kdeOpts["tolerance"] = float(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get mesh tolerance, using default." + 
+                      Constants.tcENDC)
+        elif opt == "--trim":
+            try:
+                kdeOpts["trim"] = float(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get mesh trim quantile, using none." + 
+                      Constants.tcENDC)
+        elif opt in ["-n", "--points"]:
+            try:
+                kdeOpts["points"] = int(arg)
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get number of mesh points, using default." + 
+                      Constants.tcENDC)
         elif opt in ["-p", "--psd"]:
             psdOut   = str(arg)
+        elif opt == "--quantile-method":
+            kdeOpts["quantiles"] = str(arg)
+        elif opt == "--quantiles":
+            try:
+                quantiles = [float(q) for q in str(arg).split(",")]
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get quantiles, using default." + 
+                      Constants.tcENDC)
+                quantiles = None
+        elif opt == "--sweep":
+            try:
+                sweep = [float(h) for h in str(arg).split(",")]
+            except:
+                print(Constants.tcWARNING + \
+                      "Couldn't get sweep bandwidths, not sweeping." + 
+                      Constants.tcENDC)
+                sweep = None
         elif opt in ["-t", "--time"]:
             try:
                 timeOut  = float(arg)
@@ -157,6 +343,12 @@ if __name__ == "__main__":
             usage()
             exitVal = 1
         
+    # The parsed columns of each CSV are cached for the next time it is
+    # loaded, if asked for
+    if useCache:
+        import datamodel.mops_parser as MParser
+        MParser.setColumnCache(MParser.ColumnCache())
+    
     if guiMode:
         
         if xmlOut: print("Warning: XML out unsupported in GUI mode.")
@@ -191,17 +383,26 @@ if __name__ == "__main__":
                 print(consts.tcWARNING + \
                       "Warning: no output file specified." + \
                       consts.tcENDC)
+            if (sweep or joint) and (not psdOut):
+                print(consts.tcWARNING + \
+                      "Warning: bandwidth sweep and joint PSD need a PSD output file." + \
+                      consts.tcENDC)
             if timeOut:
                 print(consts.tcWARNING + \
                       "Warning: time argument has no effect for PSL processing." + \
                       consts.tcENDC)
             
-            cmd = Cmd.PSLCommand(fname, consts)
+            cmd = Cmd.PSLCommand(fname, consts, kdeOpts, bandwidth, quantiles, \
+                                 meansOnly, bootstrap, jobs, joint, weighted, \
+                                 columns)
             cmd.start()
             
             if cmd.m_allowOutput:
                 if xmlOut: cmd.writeXML(xmlOut)
                 if psdOut: cmd.writePSDs(psdOut, ",")
+                if psdOut and sweep: cmd.writeSweeps(psdOut, sweep, ",")
+                if psdOut and joint: cmd.writeJoint(psdOut, ",")
+                if benchmark: cmd.writeBenchmark(benchmark, ",")
             else:
                 print(consts.tcFAIL + "No ensembles could be loaded." + \
                       consts.tcENDC)
@@ -231,8 +432,8 @@ if __name__ == "__main__":
                   consts.tcENDC)
             exitVal = 5
     
-if exitVal > 0:
-    print(Constants.tcFAIL + "Goodbye!" + Constants.tcENDC)
-else:
-    print(Constants.tcOKGREEN + "Goodbye!" + Constants.tcENDC)
-sys.exit(exitVal)
\ No newline at end of file
+    if exitVal > 0:
+        print(Constants.tcFAIL + "Goodbye!" + Constants.tcENDC)
+    else:
+        print(Constants.tcOKGREEN + "Goodbye!" + Constants.tcENDC)
+    sys.exit(exitVal)
\ No newline at end of file
@@ -1,12 +1,393 @@
 # Global imports
+import sys
 import math
+import array
+import bisect
+import random
+import time
+import multiprocessing
+
+# Optional imports (used by the array-backed kernel engines)
+try:
+    import numpy
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
 
 # Declare constants
 PI = 3.141592653589793
 
-class KernelDensity:
+# Engines available for evaluating the kernel sums of the PSD, where "auto"
+# lets planEngine() choose one
+ENGINES = ["direct", "numpy", "binned", "window", "prefix", "auto"]
+
+# The "auto" engine is the cheapest whose error bound, relative to the peak
+# of one normalised kernel (norm/h, which no PSD exceeds), is within
+# PLANNER_TOL. The binned engine's grid is then chosen to meet it too, from
+# PLANNER_MIN_GRID up to PLANNER_MAX_GRID points. Each engine costs
+# ENGINE_COSTS[engine] = (seconds per call, seconds per unit of work), as
+# counted by engineWork(). The costs were fitted by fitEngineCosts() to
+# benchmarkEngines() of the bundled PSL and synthetic lognormal ensembles of
+# 10^3 to 10^5 particles on 64 and 256 mesh points (app.py --benchmark with
+# python 2.7 and numpy 1.16), with the Gaussian kernel except for the prefix
+# engine (Biweight).
+PLANNER_TOL = 1.0e-6
+PLANNER_MIN_GRID = 256
+PLANNER_MAX_GRID = 1048576
+ENGINE_COSTS = {"direct": (0.0, 6.2e-7),
+                "numpy": (0.0, 2.3e-8),
+                "binned": (4.7e-4, 5.0e-9),
+                "window": (0.0, 2.7e-7),
+                "prefix": (4.0e-4, 3.8e-7)}
+
+# Batches of more particles than this have their moments accumulated with
+# numpy rather than one particle at a time
+MOMENTS_BATCH = 1000
+
+# Maximum number of (mesh point x particle) elements held in one temporary
+# array by the numpy engine. 2**20 doubles is 8 MB per array.
+CHUNK_ELEMENTS = 1048576
+
+# Default number of grid points used by the binned (FFT) engine, and the
+# number of bandwidths the grid extends beyond the data and the mesh.
+BINNED_GRID = 4096
+BINNED_CUTOFF = 8.0
+
+# Width in bandwidths of the blocks of particles over which the prefix engine
+# keeps its sums, so a window of two bandwidths overlaps at most two blocks
+PREFIX_BLOCK = 2.0
+
+# Default number of bandwidths either side of a mesh point within which the
+# window engine sums particles. exp(-8^2/2) is ~1e-14 of the kernel peak.
+WINDOW_CUTOFF = 8.0
+
+# Adaptive mesh: bounds extend ADAPTIVE_REACH bandwidths beyond the data, the
+# first mesh has ADAPTIVE_START points, and refinement stops when the PSD
+# statistics change by less than the relative tolerance ADAPTIVE_TOL or the
+# mesh reaches ADAPTIVE_MAX points.
+ADAPTIVE_REACH = 4.0
+ADAPTIVE_START = 17
+ADAPTIVE_TOL = 1.0e-3
+ADAPTIVE_MAX = 4096
+
+# Bandwidth selectors: the rule of thumb ("auto"), Sheather-Jones plug-in
+# ("sj") and least-squares cross-validation ("lscv"). The data-driven
+# selectors work on the particles binned onto SELECTOR_GRID points.
+BANDWIDTHS = ["auto", "sj", "lscv"]
+SELECTOR_GRID = 401
+
+# Quantiles (d10/d50/d90) are found from the integrated PSD on the mesh
+# ("mesh") or by root-finding on the closed-form CDF of the kernel sum
+# ("exact"), to a relative tolerance of QUANTILE_TOL.
+QUANTILES = ["mesh", "exact"]
+QUANTILE_TOL = 1.0e-10
+
+# Default PSD bounds: a fraction of the smallest and largest values below and
+# above them ("relative", for diameters), or a fraction of their range
+# ("range", for columns far from zero such as ages)
+BOUNDS = ["relative", "range"]
+
+# Weighted histograms in place of the KDE: the number of bins is given, or
+# from the Freedman-Diaconis ("fd") or Sturges ("sturges") rule, up to
+# HISTOGRAM_MAX_BINS. Bins are linear, or logarithmic in log space.
+BINS = ["fd", "sturges"]
+HISTOGRAM_MAX_BINS = 10000
+
+# Bootstrap confidence bands: the central fraction BOOTSTRAP_LEVEL of the
+# replicates is spanned by the bands
+BOOTSTRAP_LEVEL = 0.95
+
+# Number of mesh points along each axis of a joint (2D) KDE. With numpy
+# the particles are binned on a grid up to JOINT_REFINE times finer, so that
+# there are at least four grid points per bandwidth.
+JOINT_GRID = 128
+JOINT_REFINE = 8
+
+# Variable (Abramson) bandwidths: each particle's bandwidth is
+# h (f(x)/g)^(-ABRAMSON_ALPHA), where f is a pilot KDE with the global
+# bandwidth h and g the weighted geometric mean of f over the particles. The
+# pilot is binned on a grid of PILOT_RESOLUTION points per bandwidth (up to
+# PILOT_MAX_GRID) and interpolated to the particles. The binned engine groups
+# the particles into bandwidth classes a factor BANDWIDTH_CLASS_RATIO apart.
+ABRAMSON_ALPHA = 0.5
+PILOT_RESOLUTION = 4
+PILOT_MAX_GRID = 65536
+BANDWIDTH_CLASS_RATIO = 1.02
+
+# Particle storage: lists of floats ("list"), or typed arrays of doubles
+# ("double") or of single-precision diameters ("float", with ~7 significant
+# figures). Weights are always doubles, and all sums are accumulated in
+# doubles. STORAGE_TYPES gives the array typecodes of the diameters.
+STORAGE = ["list", "double", "float"]
+STORAGE_TYPES = {"double": "d", "float": "f"}
+
+# Relative precision of single-precision diameters, within which a particle
+# is found when it is removed from a "float" ensemble
+FLOAT_EPSILON = 2.0**-23
+
+class Kernel:
+    # A symmetric kernel K(u) = norm * profile(u^2), with the rule-of-thumb
+    # bandwidth h = rot * stdev * N^(-1/5) for normally distributed data.
+    name = ""
+    norm = 1.0          # normalisation constant
+    support = None      # half-width of the support in bandwidths (None if infinite)
+    power = None        # exponent p for kernels of the form (1 - u^2)^p
+    rot = 1.0           # rule-of-thumb bandwidth constant
+    
+    def reach(self, cutoff):
+        # Half-width in bandwidths outside which the kernel is neglected
+        if self.support != None: return self.support
+        return cutoff
+    
+    def interpolationError(self, delta, h):
+        # Bound on the error of linearly interpolating K_h(x) = K(x/h)/h
+        # between points delta apart.
+        return delta * delta * self.d2max / (8.0 * h * h * h)
+    
+    def density(self, u):
+        return self.norm * self.profile(u * u)
+
+class GaussianKernel(Kernel):
+    name = "Gaussian"
+    norm = 1.0 / math.sqrt(PI*2.0)
+    rot = 1.06
+    d2max = norm        # max|K''|, at u = 0
+    
+    def profile(self, s):
+        return math.exp(-0.5 * s)
+    
+    def arrayProfile(self, s):
+        return numpy.exp(-0.5 * s)
+    
+    def cdf(self, u):
+        # Integral of K from -infinity to u
+        return 0.5 * math.erfc(-u / math.sqrt(2.0))
+
+class PolynomialKernel(Kernel):
+    # Kernels of the form norm * (1 - u^2)^power on |u| < 1
+    support = 1.0
+    
+    def profile(self, s):
+        if s < 1.0: return (1.0 - s)**self.power
+        return 0.0
+    
+    def arrayProfile(self, s):
+        return numpy.where(s < 1.0, numpy.clip(1.0 - s, 0.0, 1.0)**self.power, 0.0)
+    
+    def cdf(self, u):
+        # Integral of K from -1 to u, expanding (1 - t^2)^p binomially
+        if u <= -1.0: return 0.0
+        if u >= 1.0: return 1.0
+        total = 0.0
+        coeff = 1.0
+        for k in range(0, self.power+1):
+            total += coeff * (u**(2*k+1) + 1.0) / (2*k+1)
+            coeff *= -float(self.power - k) / (k + 1)
+        return self.norm * total
+
+class EpanechnikovKernel(PolynomialKernel):
+    name = "Epanechnikov"
+    norm = 0.75
+    power = 1
+    rot = 2.34
+    
+    def interpolationError(self, delta, h):
+        # K'' = -3/2 inside the support, plus a kink of 3/2 in K' at its edge
+        return delta * delta * 1.5 / (8.0 * h * h * h) + \
+            delta * 1.5 / (4.0 * h * h)
+
+class BiweightKernel(PolynomialKernel):
+    name = "Biweight"
+    norm = 15.0 / 16.0
+    power = 2
+    rot = 2.78
+    d2max = 7.5         # max|K''|, at u = 1
+
+class TriweightKernel(PolynomialKernel):
+    name = "Triweight"
+    norm = 35.0 / 32.0
+    power = 3
+    rot = 3.15
+    d2max = 6.5625      # max|K''|, at u = 0
+
+class UniformKernel(PolynomialKernel):
+    name = "Uniform"
+    norm = 0.5
+    power = 0
+    rot = 1.84
+    
+    def interpolationError(self, delta, h):
+        # Discontinuous, so only the kernel height itself bounds the error
+        return self.norm / h
+
+# Registry of the available kernels, keyed by name
+KERNELS = {}
+for k in [GaussianKernel(), EpanechnikovKernel(), BiweightKernel(), \
+          TriweightKernel(), UniformKernel()]:
+    KERNELS[k.name] = k
+
+class BandwidthSelector:
+    # Data-driven bandwidth selection for Gaussian kernels. The weighted
+    # particles are linearly binned onto SELECTOR_GRID points, and the
+    # weighted count of particle pairs at each lag (the autocorrelation of the
+    # bin counts) is found once. Every double sum over particle pairs is then
+    # a single sum over lags, so each candidate bandwidth costs O(G) instead
+    # of O(N^2).
+    
+    # wsq is the sum of squared weights of the particles before any were
+    # collapsed, if they were.
+    def __init__(self, values, weights, gridsize=SELECTOR_GRID, wsq=None):
+        lb = min(values)
+        ub = max(values)
+        self.delta = (ub - lb) / (gridsize - 1)
+        self.wsum = float(sum(weights))
+        if wsq == None: wsq = sum([w*w for w in weights])
+        self.wsq = wsq
+        # Effective number of particles, N for equal weights
+        self.neff = self.wsum * self.wsum / self.wsq
+        
+        if self.delta <= 0.0:
+            # All particles at the same point
+            self.pairs = [self.wsum * self.wsum]
+            return
+        
+        counts = [0.0] * gridsize
+        for v, w in zip(values, weights):
+            pos = (v - lb) / self.delta
+            j = min(int(pos), gridsize-2)
+            t = pos - j
+            counts[j] += w * (1.0 - t)
+            counts[j+1] += w * t
+        
+        # Weight of ordered pairs at each lag l >= 0, counting both signs
+        if HAVE_NUMPY:
+            c = numpy.asarray(counts)
+            pairs = numpy.correlate(c, c, "full")[gridsize-1:].tolist()
+        else:
+            pairs = []
+            for l in range(0, gridsize):
+                pairs.append(sum([a*b for a, b in zip(counts, counts[l:])]))
+        self.pairs = [pairs[0]] + [2.0*p for p in pairs[1:]]
+    
+    def pairSum(self, func, g):
+        # Approximates sum_i sum_j w_i w_j func((X_i - X_j)/g)
+        total = 0.0
+        for l in range(0, len(self.pairs)):
+            if self.pairs[l] != 0.0:
+                total += self.pairs[l] * func(l * self.delta / g)
+        return total
+    
+    def psi(self, r, g):
+        # Estimate of the density functional psi_r = int f^(r) f with a
+        # Gaussian pilot of bandwidth g, for r = 4 or 6.
+        if r == 4:
+            func = lambda x: (x**4 - 6.0*x**2 + 3.0) * math.exp(-0.5*x*x)
+        else:
+            func = lambda x: (x**6 - 15.0*x**4 + 45.0*x**2 - 15.0) * \
+                math.exp(-0.5*x*x)
+        return self.pairSum(func, g) / \
+            (self.wsum * self.wsum * math.sqrt(PI*2.0) * g**(r+1))
+    
+    # Sheather & Jones (1991) 'solve-the-equation' plug-in bandwidth. The
+    # pilot bandwidths a and b come from the robust scale of the data, and
+    # h solves h = [R(K) / (n psi4(g(h)))]^(1/5) with
+    # g(h) = 1.357 [psi4(a) / -psi6(b)]^(1/7) h^(5/7), found by bisection.
+    def sheatherJones(self, scale, hstart):
+        n = self.neff
+        a = 1.24 * scale * n**(-1.0/7.0)
+        b = 1.23 * scale * n**(-1.0/9.0)
+        sd = self.psi(4, a)
+        td = -self.psi(6, b)
+        if sd <= 0.0 or td <= 0.0:
+            print("Warning: Sheather-Jones pilot estimates failed, using rule of thumb.")
+            return hstart
+        alpha = 1.357 * (sd / td)**(1.0/7.0)
+        c1 = 1.0 / (2.0 * math.sqrt(PI) * n)
+        
+        def equation(h):
+            psi4 = self.psi(4, alpha * h**(5.0/7.0))
+            if psi4 <= 0.0: return -h
+            return (c1 / psi4)**0.2 - h
+        
+        # Bracket the root around the rule-of-thumb bandwidth
+        lo = 0.1 * hstart
+        hi = hstart
+        i = 0
+        while equation(hi) > 0.0 and i < 20:
+            hi *= 2.0
+            i += 1
+        while equation(lo) < 0.0 and i < 40:
+            lo *= 0.5
+            i += 1
+        
+        for i in range(0, 100):
+            mid = 0.5 * (lo + hi)
+            if equation(mid) > 0.0: lo = mid
+            else: hi = mid
+            if hi - lo < 1.0e-6 * mid: break
+        return 0.5 * (lo + hi)
+    
+    # Least-squares cross-validation bandwidth, minimising
+    #   LSCV(h) = int f^2 - 2 sum_i w_i f_-i(X_i) / W
+    # where f_-i leaves out particle i. For Gaussian kernels int f^2 is a sum
+    # of Gaussians of width sqrt(2) h over pairs. The minimum is found on a
+    # logarithmic grid over [hstart/20, 2 hstart] and then refined by golden
+    # section search; h is kept above 3 grid spacings of the binning.
+    def lscv(self, hstart):
+        gauss = lambda x: math.exp(-0.5*x*x) / math.sqrt(PI*2.0)
+        wsum2 = self.wsum * self.wsum
+        
+        def score(h):
+            allpairs = self.pairSum(gauss, h) / h
+            squared = self.pairSum(gauss, math.sqrt(2.0) * h) / \
+                (math.sqrt(2.0) * h * wsum2)
+            others = (allpairs - self.wsq * gauss(0.0) / h) / (wsum2 - self.wsq)
+            return squared - 2.0 * others
+        
+        lo = max(0.05 * hstart, 3.0 * self.delta)
+        hi = max(2.0 * hstart, 2.0 * lo)
+        grid = [lo * (hi/lo)**(i/24.0) for i in range(0, 25)]
+        scores = [score(h) for h in grid]
+        i = scores.index(min(scores))
+        a = grid[max(i-1, 0)]
+        b = grid[min(i+1, len(grid)-1)]
+        
+        # Golden section search in ln(h)
+        ratio = 0.5 * (math.sqrt(5.0) - 1.0)
+        a = math.log(a)
+        b = math.log(b)
+        c = b - ratio * (b - a)
+        d = a + ratio * (b - a)
+        while b - a > 1.0e-5:
+            if score(math.exp(c)) < score(math.exp(d)): b = d
+            else: a = c
+            c = b - ratio * (b - a)
+            d = a + ratio * (b - a)
+        return math.exp(0.5 * (a + b))
+
+class LazyAttribute(object):
+    # A memoized attribute of a KernelDensity. On first access the named
+    # method is called, which sets the attribute (and the rest of its group)
+    # on the instance; from then on the instance attribute is found first.
+    
+    def __init__(self, name, method):
+        self.name = name
+        self.method = method
+    
+    def __get__(self, obj, cls):
+        if obj is None: return self
+        if len(obj.diameters) > 0: getattr(obj, self.method)()
+        if self.name not in obj.__dict__: raise AttributeError(self.name)
+        return obj.__dict__[self.name]
+
+class KernelDensity(object):
     # Default constructor
-    def __init__(self, diameters, weights, bandwidth):
+    def __init__(self, diameters, weights, bandwidth, engine="direct", \
+                 points=None, gridsize=None, cutoff=None, kernel="Gaussian", \
+                 logspace=False, mesh="uniform", tolerance=None, trim=None, \
+                 collapse=None, quantiles="mesh", weightsets=None, \
+                 bounds="relative", bins=None, accuracy=None, variable=False, \
+                 storage="list"):
         # The KDE object it initialised with a list of diameters and weights
         # from the calling Ensemble class.
         
@@ -15,95 +396,525 @@ class KernelDensity:
             self.__initialiseZeroEnsemble()
 
         else:
+            # Particles with equal diameters (to a relative tolerance) may be
+            # merged into one with their summed weight; collapse=None (the
+            # default) keeps every particle, and 0.0 merges equal diameters.
+            self.num_particles = len(diameters)
+            self.collapse = collapse
+            self.weight_squares = sum([w*w for w in weights])
+            
+            # Other weightings of the same particles (e.g. number times
+            # surface area), as a dictionary of lists like weights
+            if weightsets == None: weightsets = {}
+            names = sorted(weightsets.keys())
+            self.weightsets = weightsets
+            
+            if collapse != None:
+                if storage == "float":
+                    # Narrow the diameters before they are merged, so that no
+                    # two of the unique diameters round to the same float
+                    diameters = storeValues(diameters, STORAGE_TYPES[storage])
+                (diameters, weights, sets) = collapseParticleSets(diameters, \
+                    weights, [weightsets[name] for name in names], collapse)
+                self.weightsets = dict(zip(names, sets))
             self.diameters = diameters
             self.weights = weights
             
             # Default properties of KDE curve
             self.__defaultKDE()
             
+            # The particles may be kept in typed arrays (see STORAGE)
+            self.setStorage(storage)
+            if collapse != None:
+                # The merged particles are already in ascending order
+                self.sorted_particles = (self.diameters, self.weights, \
+                                         (self.diameters, self.weights))
+            self.setKernel(kernel)
+            self.setEngine(engine)
+            if points != None: self.num_points = int(points)
+            if gridsize != None:
+                self.grid_points = int(gridsize)
+                self.plan_grid = False
+            if accuracy != None: self.accuracy = float(accuracy)
+            if cutoff != None: self.cutoff = float(cutoff)
+            
+            # In log space the KDE is done on ln(d) over a geometric mesh
+            if logspace and min(diameters) <= 0.0:
+                print("Warning: values must be positive for log space, using linear.")
+                logspace = False
+            self.logspace = logspace
+            if self.logspace:
+                self.log_diameters = self.storeDiameters(\
+                    [math.log(d) for d in self.diameters])
+            
+            # Adaptive meshes are refined until the PSD statistics converge
+            self.meshtype = mesh
+            if tolerance != None: self.tolerance = float(tolerance)
+            if trim != None: self.trim = float(trim)
+            if quantiles not in QUANTILES:
+                print("Unknown quantile type {0}, using mesh.".format(quantiles))
+                quantiles = "mesh"
+            self.quantiletype = quantiles
+            
+            # Bandwidth: -1 (rule of thumb), a selector name or a value
+            self.bandwidth = bandwidth
+            
+            # A weighted histogram instead of the KDE, whose bins are centred
+            # on the mesh with a width of self.smoothing
+            self.setBins(bins)
+            
+            # Variable bandwidths self.smoothing * self.local_factors
+            self.setVariable(variable)
+            
+            # Set the default bounds of the PSD. Everything else is computed
+            # when it is first needed (see LAZY_ATTRIBUTES).
+            if bounds not in BOUNDS:
+                print("Unknown bounds type {0}, using relative.".format(bounds))
+                bounds = "relative"
+            self.boundtype = bounds
             if len(diameters) == 1:
-                print("Warning: only one particle found in the PSL!")
-                self.astdev = 0.0
-                self.gstdev = 1.0
-                
-                self.damean = diameters[0]
-                self.dgmean = self.damean
-                self.dmode = self.damean
-                self.d10 = self.damean
-                self.d50 = self.damean
-                self.d90 = self.damean
-                
-                # Initialise the bounds
-                self.lowerbound = (1 - self.bound_multiplier) * self.damean
-                self.upperbound = (1 + self.bound_multiplier) * self.damean
-                self.mesh = self.makeMesh(self.num_points, self.lowerbound, self.upperbound)
-                self.psd  = self.calculatePSD(self.diameters, self.weights)
-                
+                if self.num_particles == 1:
+                    print("Warning: only one particle found in the PSL!")
+                else:
+                    print("Warning: all particles in the PSL have one diameter!")
+                self.lowerbound = (1 - self.bound_multiplier) * diameters[0]
+                self.upperbound = (1 + self.bound_multiplier) * diameters[0]
+                if diameters[0] == 0.0:
+                    self.lowerbound = -self.bound_multiplier
+                    self.upperbound = self.bound_multiplier
+            elif bounds == "range" and self.logspace:
+                # The range of ln(d), so the bounds stay positive
+                ratio = (max(diameters) / min(diameters))**self.bound_multiplier
+                self.lowerbound = min(diameters) / ratio
+                self.upperbound = max(diameters) * ratio
+            elif bounds == "range":
+                spread = self.bound_multiplier * (max(diameters) - min(diameters))
+                self.lowerbound = min(diameters) - spread
+                self.upperbound = max(diameters) + spread
             else:
-                # Set the default bounds of the PSD
                 self.lowerbound = (1 - self.bound_multiplier) * min(self.diameters)
                 self.upperbound = (1 + self.bound_multiplier) * max(self.diameters)
-                
-                # Calculate ensemble statistics
-                if bandwidth < 0: self.smoothing = self.getBandwidth()
-                else: self.smoothing = bandwidth
-                
-                # Make the mesh for the PSD
-                self.mesh = self.makeMesh(self.num_points, self.lowerbound, self.upperbound)
-                
-                # Create the PSD
-                self.psd  = self.calculatePSD(self.diameters, self.weights)
     
     def __initialiseZeroEnsemble(self):
         # Initialises the ensemble as an empty object if there are no particles
         # passed as arguments.
         self.diameters = []
         self.weights = []
+        self.weightsets = {}
+        self.num_particles = 0
     
     def __defaultKDE(self):
         # Initialises the default kernel density properties.
         self.bound_multiplier = 0.4     # percentage above/below max/min diameters
-        self.smoothing = 1.0            # 'h' factor for smoothing PSD
+        self.fixed_lowerbound = False   # lower bound set by setLowerBound()?
+        self.fixed_upperbound = False   # upper bound set by setUpperBound()?
         self.kerneltype = "Gaussian"    # type of kernel
         self.num_points = 64            # number of points needed for PSD (multiple of 2)
+        self.engine = "direct"          # engine used to evaluate the kernel sums
+        self.grid_points = BINNED_GRID  # number of grid points for binned engine
+        self.plan_grid = True           # may the planner change grid_points?
+        self.auto_engine = False        # engine chosen by planEngine()?
+        self.accuracy = PLANNER_TOL     # relative error allowed by planEngine()
+        self.cutoff = WINDOW_CUTOFF     # window half-width in bandwidths
+        self.sorted_particles = None    # particles last sorted by diameter
+        self.logspace = False           # KDE on ln(d) instead of d?
+        self.meshtype = "uniform"       # uniform or adaptive mesh
+        self.tolerance = ADAPTIVE_TOL   # relative tolerance of adaptive PSD stats
+        self.trim = 0.0                 # quantile trimmed from adaptive mesh bounds
+        self.quantiletype = "mesh"      # mesh or exact d10/d50/d90
+        self.boundtype = "relative"     # relative or range default bounds
+        self.bins = None                # histogram bin rule or count (None for KDE)
+        self.variable = False           # Abramson variable bandwidths?
+        self.storage = "list"           # lists or typed arrays of particles
+        self.cdf_particles = None       # sorted values and cumulative weights
+    
+    # Set the storage of the particles, converting them if needed
+    def setStorage(self, storage):
+        if storage not in STORAGE:
+            print("Unknown storage type {0}, using list.".format(storage))
+            storage = "list"
+        self.storage = storage
+        self.diameters = self.storeDiameters(self.diameters)
+        self.weights = self.storeWeights(self.weights)
+        for name in self.weightsets.keys():
+            self.weightsets[name] = self.storeWeights(self.weightsets[name])
+    
+    def storeDiameters(self, values, copy=False):
+        # Gets the diameters (or their logs) in the storage of the ensemble.
+        # Arrays already of the right type (e.g. from the parser) are shared
+        # unless a copy is asked for.
+        return storeValues(values, STORAGE_TYPES.get(self.storage), copy)
+    
+    def storeWeights(self, values, copy=False):
+        # Gets weights in the storage of the ensemble, always in doubles
+        if self.storage == "list": return storeValues(values, None, copy)
+        return storeValues(values, "d", copy)
+    
+    def memoryFootprint(self):
+        # Gets the number of bytes held by the particles: the diameters,
+        # weights and other weightings, the logs of the diameters and any
+        # sorted copy. Each list counts its floats, which may be shared.
+        seen = set()
+        total = 0
+        held = [self.diameters, self.weights] + list(self.weightsets.values())
+        if self.logspace: held.append(self.log_diameters)
+        if self.sorted_particles != None: held.extend(self.sorted_particles[2])
+        for values in held:
+            total += storageBytes(values, seen)
+        return total
+    
+    # Set the engine used to evaluate the PSD
+    def setEngine(self, engine):
+        self.auto_engine = engine == "auto"
+        if self.auto_engine:
+            # Planned when the PSD is computed, as it depends on the bandwidth
+            engine = "direct"
+        if engine not in ENGINES:
+            print("Unknown kernel engine {0}, using direct.".format(engine))
+            engine = "direct"
+        elif engine in ["numpy", "binned"] and (not HAVE_NUMPY):
+            print("Warning: numpy not found, using direct kernel engine.")
+            engine = "direct"
+        self.engine = engine
+    
+    # Set the kernel type, matching names from the registry case-insensitively
+    def setKernel(self, kernel):
+        for name in KERNELS.keys():
+            if name.lower() == str(kernel).lower():
+                self.kerneltype = name
+                return
+        print("Unknown kernel {0}, using Gaussian.".format(kernel))
+        self.kerneltype = "Gaussian"
+    
+    # Set the histogram bins: None for the KDE, a rule from BINS or a count
+    def setBins(self, bins):
+        if bins == None:
+            self.bins = None
+            return
+        if str(bins).lower() in BINS:
+            bins = str(bins).lower()
+        else:
+            try:
+                bins = int(bins)
+                if bins < 1: raise ValueError
+            except:
+                print("Unknown histogram bins {0}, using fd.".format(bins))
+                bins = "fd"
+        self.bins = bins
+        if self.meshtype == "adaptive":
+            print("Warning: histograms have a uniform mesh of bins.")
+            self.meshtype = "uniform"
+        if self.quantiletype == "exact":
+            print("Warning: histogram quantiles are found from the mesh.")
+            self.quantiletype = "mesh"
+    
+    # Set whether each particle has its own (Abramson) bandwidth
+    def setVariable(self, variable):
+        self.variable = bool(variable)
+        if self.variable and self.bins != None:
+            print("Warning: histograms have no variable bandwidth.")
+            self.variable = False
+        if self.variable and self.quantiletype == "exact":
+            print("Warning: variable bandwidth quantiles are found from the mesh.")
+            self.quantiletype = "mesh"
+    
+    # Get the estimator of the PSD, for labelling outputs
+    def getEstimator(self):
+        if self.bins != None: return "histogram"
+        return self.kerneltype
+    
+    # Get the space the KDE is done in, for labelling outputs
+    def getSpace(self):
+        if self.logspace: return "log"
+        return "linear"
     
     # Set the lower bound of the estimated PSD
     def setLowerBound(self, lowerbound):
         self.lowerbound = lowerbound
+        self.fixed_lowerbound = True
+        self.invalidate("computePSD")
     
     # Set the upper bound of the estimated PSD
     def setUpperBound(self, upperbound):
         self.upperbound = upperbound
+        self.fixed_upperbound = True
+        self.invalidate("computePSD")
+    
+    # Set the bandwidth: -1, a selector name from BANDWIDTHS or a value
+    def setBandwidth(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.invalidate("computeBandwidth")
+    
+    def isComputed(self, name):
+        # Has the lazy attribute 'name' been computed yet?
+        return name in self.__dict__
+    
+    def invalidate(self, method):
+        # Forgets the attributes computed by method and all of those after
+        # it in LAZY_ATTRIBUTES, which depend on them.
+        found = False
+        for m, names in LAZY_ATTRIBUTES:
+            if m == method: found = True
+            if found:
+                for name in names: self.__dict__.pop(name, None)
+    
+    def computeBandwidth(self):
+        if len(self.diameters) == 1:
+            # No spread to base a bandwidth on
+            self.smoothing = 1.0
+            if self.logspace: self.smoothing = self.smoothing / self.diameters[0]
+        elif self.bins != None:
+            self.smoothing = self.getBinWidth()
+        elif isinstance(self.bandwidth, str):
+            self.smoothing = self.getBandwidth(self.bandwidth)
+        elif self.bandwidth < 0: self.smoothing = self.getBandwidth()
+        else: self.smoothing = self.bandwidth
+        
+        self.local_factors = None
+        if self.variable and len(self.diameters) > 1:
+            self.local_factors = self.calculateLocalFactors()
+    
+    def computePSD(self):
+        if self.auto_engine:
+            self.engine = self.planEngine(self.makeMesh(self.num_points, \
+                self.lowerbound, self.upperbound))
+        
+        if self.bins != None:
+            # One mesh point at the centre of each bin
+            self.mesh = self.makeBinMesh()
+            self.setPSDs()
+        elif self.meshtype == "adaptive" and len(self.diameters) > 1:
+            # Refine the mesh and PSD together; the other weightings follow
+            # the refined mesh, so they take a pass of their own
+            self.makeAdaptivePSD()
+            self.weighted_psds = self.calculateWeightedPSDs()
+        else:
+            # Make the mesh for the PSD
+            self.mesh = self.makeMesh(self.num_points, self.lowerbound, self.upperbound)
+            
+            # Create the PSDs
+            self.setPSDs()
+    
+    def setPSDs(self):
+        # Sets the number PSD on the mesh and the PSDs of the other weightings
+        # (self.weighted_psds), all from one pass over the particles
+        if len(self.weightsets) < 1:
+            self.psd = self.calculatePSD(self.diameters, self.weights)
+            self.weighted_psds = {}
+            return
+        
+        names = sorted(self.weightsets.keys())
+        (values, points) = self.getKDECoordinates(self.diameters)
+        psds = self.evaluateWeightSets(values, [self.weights] + \
+                                       [self.weightsets[name] for name in names], \
+                                       points, self.smoothing)
+        psds = [self.applyJacobian(psd) for psd in psds]
+        self.psd = psds[0]
+        self.weighted_psds = dict(zip(names, psds[1:]))
+    
+    def computeCumulativePSD(self):
+        self.cumulative_psd = self.calculateCumulativePSD()
     
     # Use the 'normal distribution approximation' to estimate for Gaussian kernels
     # http://en.wikipedia.org/wiki/Kernel_density_estimation
-    def getBandwidth(self):
-        if self.kerneltype == "Gaussian":
-            # Check that ensemble stats have already been found.
-            if (not hasattr(self, 'astdev')):
-                self.calculateEnsembleStats(self.diameters, self.weights)
+    # Other kernels use the same rule with their own constant (e.g. 2.34 for
+    # Epanechnikov), which gives the equivalent amount of smoothing.
+    # In log space the rule is applied to the stdev of ln(d).
+    # The "sj" and "lscv" methods use a BandwidthSelector, which finds the
+    # Gaussian bandwidth; for other kernels this is scaled by the ratio of the
+    # rule-of-thumb constants to give the equivalent smoothing.
+    def getBandwidth(self, method="auto"):
+        if self.kerneltype in KERNELS:
+            values = self.diameters
+            stdev = self.astdev
+            if self.logspace:
+                values = self.log_diameters
+                stdev = math.log(self.gstdev)
             
-            return (1.06 * self.astdev * pow(len(self.diameters), -(1.0/5.0)))
+            kern = KERNELS[self.kerneltype]
+            # The sample size is the number of particles before collapsing
+            h = kern.rot * stdev * pow(self.num_particles, -(1.0/5.0))
+            
+            method = method.lower()
+            if method in ["sj", "lscv"]:
+                selector = BandwidthSelector(values, self.weights, \
+                                             wsq=self.weight_squares)
+                hgauss = h * KERNELS["Gaussian"].rot / kern.rot
+                if method == "sj":
+                    (vs, ws) = self.getSortedParticles(values, self.weights)
+                    iqr = weightedQuantile(vs, ws, 0.75) - \
+                        weightedQuantile(vs, ws, 0.25)
+                    scale = min(stdev, iqr / 1.349)
+                    if scale <= 0.0: scale = stdev
+                    hgauss = selector.sheatherJones(scale, hgauss)
+                else:
+                    hgauss = selector.lscv(hgauss)
+                h = hgauss * kern.rot / KERNELS["Gaussian"].rot
+            elif method != "auto":
+                print("Unknown bandwidth method {0}, using auto.".format(method))
+            
+            return h
         else:
             return 1.0
     
+    # Get the histogram bin width, spanning the particles (in the space of
+    # the KDE) with a whole number of bins. The Freedman-Diaconis width is
+    # 2 IQR n^(-1/3) and Sturges' rule uses log2(n) + 1 bins, with the
+    # number of particles before collapsing as n (as for the bandwidth).
+    def getBinWidth(self):
+        values = self.diameters
+        if self.logspace: values = self.log_diameters
+        span = max(values) - min(values)
+        if span <= 0.0: return 1.0
+        
+        if self.bins == "fd":
+            (vs, ws) = self.getSortedParticles(values, self.weights)
+            iqr = weightedQuantile(vs, ws, 0.75) - weightedQuantile(vs, ws, 0.25)
+            width = 2.0 * iqr * pow(self.num_particles, -1.0/3.0)
+            if width > 0.0:
+                count = int(math.ceil(span / width))
+            else:
+                # No spread in the middle half, so use Sturges' rule instead
+                count = int(math.ceil(math.log(self.num_particles, 2))) + 1
+        elif self.bins == "sturges":
+            count = int(math.ceil(math.log(self.num_particles, 2))) + 1
+        else:
+            count = self.bins
+        count = min(max(count, 1), HISTOGRAM_MAX_BINS)
+        return span / count
+    
+    # Generates the mesh of bin centres for a histogram, from the smallest
+    # to the largest particle
+    def makeBinMesh(self):
+        values = self.diameters
+        if self.logspace: values = self.log_diameters
+        lb = min(values)
+        h = self.smoothing
+        count = max(1, int(round((max(values) - lb) / h)))
+        
+        mesh = [lb + (i + 0.5) * h for i in range(0, count)]
+        if max(values) == lb: mesh = [lb]
+        if self.logspace: mesh = [math.exp(x) for x in mesh]
+        return mesh
+    
+    # Get Abramson's factors of the global bandwidth for each particle,
+    # lambda = (f/g)^(-ABRAMSON_ALPHA), from a pilot KDE f with the global
+    # bandwidth. The pilot is found on a uniform grid over the particles by
+    # the binned engine (or the window engine without numpy), which is
+    # O(N + G log G) instead of the O(N^2) sum over pairs of particles, and
+    # linearly interpolated to the particles.
+    def calculateLocalFactors(self):
+        values = self.diameters
+        if self.logspace: values = self.log_diameters
+        h = self.smoothing
+        lb = min(values)
+        span = max(values) - lb
+        size = min(PILOT_MAX_GRID, int(math.ceil(PILOT_RESOLUTION * span / h)) + 1)
+        size = max(size, 2)
+        delta = span / (size - 1)
+        grid = [lb + i * delta for i in range(0, size)]
+        
+        if HAVE_NUMPY:
+            pilot = self.binnedKernel(values, self.weights, grid, h)
+            pilot = numpy.interp(numpy.asarray(values, dtype=float), \
+                                 numpy.asarray(grid), numpy.asarray(pilot))
+            pilot = numpy.maximum(pilot, 1.0e-300)
+            w = numpy.asarray(self.weights, dtype=float)
+            g = math.exp(numpy.dot(w, numpy.log(pilot)) / w.sum())
+            return ((pilot / g)**(-ABRAMSON_ALPHA)).tolist()
+        
+        pilot = self.windowKernel(values, self.weights, grid, h)
+        factors = []
+        for v in values:
+            i = min(int((v - lb) / delta), size - 2)
+            t = (v - grid[i]) / delta
+            factors.append(max((1.0 - t) * pilot[i] + t * pilot[i+1], 1.0e-300))
+        g = math.exp(sum([w * math.log(f) for f, w in zip(factors, self.weights)]) / \
+                     sum(self.weights))
+        return [(f / g)**(-ABRAMSON_ALPHA) for f in factors]
+    
     # Get the kernel density estimated PSD
     # returns a list of mesh diameters and frequency values [[dmesh], [freq]]
     def calculatePSD(self, diameters, weights):
         
+        (values, points) = self.getKDECoordinates(diameters)
+        psd = self.evaluatePSD(values, weights, points, self.smoothing)
+        return self.applyJacobian(psd)
+    
+    # Get the PSD on the mesh for each of a list of bandwidths. All of the
+    # bandwidths are evaluated in one pass over the particles, sharing the
+    # sorted (or binned) particles and the particle-mesh distances. Like
+    # setBandwidth, the bandwidths are in the space of the KDE (ln d in log
+    # space). Returns a list of PSDs, one per bandwidth.
+    def calculateBandwidthSweep(self, bandwidths):
+        
+        (values, points) = self.getKDECoordinates(self.diameters)
+        if self.bins != None:
+            psds = [self.histogramKernel(values, self.weights, points, h) \
+                    for h in bandwidths]
+        elif self.variable and self.local_factors != None:
+            psds = [self.variableKernel(values, self.weights, points, h) \
+                    for h in bandwidths]
+        elif self.engine == "numpy":
+            psds = self.numpySweep(values, self.weights, points, bandwidths)
+        elif self.engine == "binned":
+            psds = self.binnedSweep(values, self.weights, points, bandwidths)
+        else:
+            psds = self.windowSweep(values, self.weights, points, bandwidths)
+        
+        return [self.applyJacobian(psd) for psd in psds]
+    
+    def getKDECoordinates(self, diameters):
+        # Gets the particle values and mesh points in the space of the KDE,
+        # which is ln(d) in log space.
+        if self.logspace:
+            if diameters is self.diameters:
+                values = self.log_diameters
+            else:
+                values = [math.log(d) for d in diameters]
+            return (values, [math.log(dm) for dm in self.mesh])
+        return (diameters, self.mesh)
+    
+    def applyJacobian(self, psd):
+        # Transforms a density from the space of the KDE back to diameter,
+        # f(d) = f(ln d)/d in log space.
+        if self.logspace:
+            return [f / dm for f, dm in zip(psd, self.mesh)]
+        return psd
+    
+    # Evaluate the kernel density at each of the mesh points with the
+    # selected engine
+    def evaluatePSD(self, diameters, weights, mesh, h):
+        
+        if self.bins != None:
+            return self.histogramKernel(diameters, weights, mesh, h)
+        elif self.variable and self.local_factors != None:
+            return self.variableKernel(diameters, weights, mesh, h)
+        elif self.engine == "numpy":
+            return self.numpyKernel(diameters, weights, mesh, h)
+        elif self.engine == "binned":
+            return self.binnedKernel(diameters, weights, mesh, h)
+        elif self.engine == "window":
+            return self.windowKernel(diameters, weights, mesh, h)
+        elif self.engine == "prefix":
+            return self.prefixKernel(diameters, weights, mesh, h)
+        
         psd = []
         
         # Loop over the mesh points
-        for dm in self.mesh:
-            psd.append(self.kernel(diameters, weights, dm, self.smoothing))
+        for dm in mesh:
+            psd.append(self.kernel(diameters, weights, dm, h))
         
         return psd
     
     # Generates the mesh to be used for the PSD
     def makeMesh(self, num_points, lb, ub):
         
-        # Set the lower bound at zero if it's close
-        if lb < 1.0:
+        if self.logspace:
+            return self.makeLogMesh(num_points, lb, ub)
+        
+        # Set the lower bound at zero if it's close (for diameters in nm)
+        if lb < 1.0 and self.boundtype == "relative":
             lb = 0
         
         # Get the step size
@@ -115,6 +926,409 @@ class KernelDensity:
         
         return mesh
     
+    # Generates a geometric mesh, evenly spaced in ln(d)
+    def makeLogMesh(self, num_points, lb, ub):
+        
+        # Get the step size in ln(d)
+        delta = (math.log(ub) - math.log(lb)) / num_points
+        
+        mesh = []
+        for i in range(0, num_points):
+            mesh.append(lb * math.exp(i*delta))
+        
+        return mesh
+    
+    # Generates an adaptive mesh and its PSD. The bounds are set from the
+    # bandwidth (ADAPTIVE_REACH bandwidths beyond the smallest and largest
+    # particles, or beyond the trim and 1-trim quantiles), and clipped to
+    # any bounds set with setLowerBound() and setUpperBound(). Starting from a
+    # coarse uniform mesh, intervals whose estimated contribution to the
+    # error of the cumulative PSD is largest are bisected, and only the new
+    # points are evaluated, until calculatePSDStats() outputs change by less
+    # than self.tolerance (relative).
+    def makeAdaptivePSD(self):
+        
+        # Work in the space of the KDE (d or ln d)
+        if self.logspace:
+            values = self.log_diameters
+        else:
+            values = self.diameters
+        (vs, ws) = self.getSortedParticles(values, self.weights)
+        reach = KERNELS[self.kerneltype].reach(ADAPTIVE_REACH) * self.smoothing
+        lb = weightedQuantile(vs, ws, self.trim) - reach
+        ub = weightedQuantile(vs, ws, 1.0 - self.trim) + reach
+        if (not self.logspace) and lb < 0.0: lb = 0.0
+        
+        # Clip to the bounds set by the user (in ln d in log space, where a
+        # bound that is not positive clips nothing)
+        (lower, upper) = (self.lowerbound, self.upperbound)
+        if self.logspace:
+            lower = math.log(lower) if lower > 0.0 else lb
+            upper = math.log(upper) if upper > 0.0 else ub
+        if self.fixed_lowerbound: lb = max(lb, lower)
+        if self.fixed_upperbound: ub = min(ub, upper)
+        if ub <= lb:
+            # The bounds miss the particles, so just mesh between them
+            (lb, ub) = (lower, upper)
+        
+        delta = (ub - lb) / (ADAPTIVE_START - 1)
+        xmesh = [lb + i*delta for i in range(0, ADAPTIVE_START)]
+        fvals = self.evaluatePSD(values, self.weights, xmesh, self.smoothing)
+        stats = self.setAdaptivePSD(xmesh, fvals)
+        
+        while len(xmesh) < ADAPTIVE_MAX:
+            errors = intervalErrors(xmesh, fvals)
+            threshold = 0.1 * max(errors)
+            if threshold <= 0.0: break
+            
+            # Bisect the intervals with the largest errors
+            newx = []
+            for i in range(0, len(errors)):
+                if errors[i] >= threshold:
+                    newx.append(0.5*(xmesh[i] + xmesh[i+1]))
+            newx = newx[:ADAPTIVE_MAX - len(xmesh)]
+            newf = self.evaluatePSD(values, self.weights, newx, self.smoothing)
+            
+            points = sorted(zip(xmesh + newx, fvals + newf))
+            xmesh = [p[0] for p in points]
+            fvals = [p[1] for p in points]
+            
+            newstats = self.setAdaptivePSD(xmesh, fvals)
+            converged = True
+            for a, b in zip(stats, newstats):
+                if abs(b - a) > self.tolerance * abs(a): converged = False
+            stats = newstats
+            if converged: break
+    
+    def setAdaptivePSD(self, xmesh, fvals):
+        # Sets the mesh and PSD from points in the space of the KDE, and
+        # returns the PSD statistics [d10, d50, d90, dmode] for them
+        if self.logspace:
+            self.mesh = [math.exp(x) for x in xmesh]
+            self.psd = [f / dm for f, dm in zip(fvals, self.mesh)]
+        else:
+            self.mesh = xmesh
+            self.psd = fvals
+        
+        self.cumulative_psd = self.calculateCumulativePSD()
+        self.calculatePSDStats()
+        return [self.d10, self.d50, self.d90, self.dmode]
+    
+    # Get the PSDs weighted by each of self.weightsets (e.g. by surface
+    # area, volume or mass), from one pass over the particles. The number
+    # PSD usually comes from the same pass (see setPSDs()), as the lazy
+    # attribute weighted_psds; this is only used alone for adaptive meshes.
+    # Returns a dictionary of PSDs on the mesh, keyed like self.weightsets.
+    def calculateWeightedPSDs(self):
+        names = sorted(self.weightsets.keys())
+        if len(names) < 1: return {}
+        (values, points) = self.getKDECoordinates(self.diameters)
+        psds = self.evaluateWeightSets(values, [self.weightsets[name] for \
+                                                name in names], \
+                                       points, self.smoothing)
+        
+        weighted = {}
+        for name, psd in zip(names, psds):
+            weighted[name] = self.applyJacobian(psd)
+        return weighted
+    
+    # Get the moments of the particle diameters weighted by each of
+    # self.weightsets, which need no kernel sums.
+    # Returns a dictionary of WeightedMoments, keyed like self.weightsets.
+    def calculateWeightedMoments(self):
+        moments = {}
+        for name, weights in self.weightsets.items():
+            moments[name] = WeightedMoments()
+            for d, w in zip(self.diameters, weights):
+                moments[name].add(d, w)
+        return moments
+    
+    def evaluateWeightSets(self, values, weightsets, mesh, h):
+        # Evaluates the PSD for each of a list of weights of the same
+        # particles, each normalised by its own total weight, with the
+        # selected engine. The kernel value of each particle-mesh pair is
+        # found once and used for every set in blocks with the numpy engine,
+        # and within the kernel's reach of each mesh point (as windowKernel())
+        # with the window engine. The binned engine bins every set at once
+        # onto a grid with one column per set. The direct and prefix engines,
+        # histograms and variable bandwidths evaluate the sets one by one.
+        if self.kerneltype not in KERNELS:
+            print("Unknown kernel specified!")
+            return [[-1 for dm in mesh] for ws in weightsets]
+        if self.bins != None or self.variable or \
+                self.engine not in ["numpy", "binned", "window"]:
+            return [self.evaluatePSD(values, ws, mesh, h) for ws in weightsets]
+        if self.engine == "binned":
+            return self.binnedSets(values, weightsets, mesh, [h])[0]
+        
+        kern = KERNELS[self.kerneltype]
+        totals = [float(sum(ws)) for ws in weightsets]
+        if self.engine == "numpy":
+            d = numpy.asarray(values, dtype=float)
+            x = numpy.asarray(mesh, dtype=float)
+            w = numpy.asarray(weightsets, dtype=float).T
+            step = max(1, CHUNK_ELEMENTS // len(x))
+            sums = numpy.zeros((len(x), len(weightsets)))
+            for i in range(0, len(d), step):
+                u = (x[:, numpy.newaxis] - d[numpy.newaxis, i:i+step]) / h
+                sums += kern.arrayProfile(u * u).dot(w[i:i+step])
+            sums *= kern.norm / (numpy.asarray(totals) * h)
+            return sums.T.tolist()
+        
+        # Particles in ascending order, with the weights of every set
+        order = sorted(range(0, len(values)), key=values.__getitem__)
+        vs = [values[i] for i in order]
+        rows = [[ws[i] for ws in weightsets] for i in order]
+        reach = kern.reach(self.cutoff) * h
+        factor = 1.0 / (h * h)
+        profile = kern.profile
+        
+        psds = [[] for ws in weightsets]
+        for dm in mesh:
+            lo = bisect.bisect_left(vs, dm - reach)
+            hi = bisect.bisect_right(vs, dm + reach, lo)
+            k = [0.0] * len(weightsets)
+            for v, row in zip(vs[lo:hi], rows[lo:hi]):
+                kv = profile((dm - v) * (dm - v) * factor)
+                for j in range(0, len(row)):
+                    k[j] += row[j] * kv
+            for j in range(0, len(weightsets)):
+                psds[j].append(k[j] * kern.norm / (totals[j] * h))
+        return psds
+    
+    # Weighted bootstrap of the PSD and its statistics. Each replicate draws
+    # as many particles as the ensemble had (before collapsing) with
+    # probability proportional to weight, and is evaluated on the same mesh
+    # with the same bandwidth. The replicates are shared out between a pool
+    # of processes, each of which evaluates its share as one batch.
+    # Sets self.psd_bands with the pointwise lower and upper bands of the PSD
+    # and the bands of d10, d50, d90 and dmode.
+    def calculateBootstrap(self, replicates, level=BOOTSTRAP_LEVEL, \
+                           processes=None, seed=None):
+        if replicates < 2 or len(self.diameters) < 2:
+            print("Too few replicates or particles to bootstrap.")
+            return
+        
+        # Seed each replicate separately, so the results do not depend on
+        # how they are shared out
+        if seed == None: seed = random.randint(0, 2**30)
+        seeds = [seed + i for i in range(0, replicates)]
+        
+        # Find the bandwidth and mesh before the ensemble is copied to the
+        # pool processes, so each replicate reuses them
+        if not self.isComputed("smoothing"): self.computeBandwidth()
+        if not self.isComputed("mesh"): self.computePSD()
+        
+        if processes == None: processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, replicates))
+        if processes > 1:
+            step = int(math.ceil(float(replicates) / processes))
+            jobs = [(self, seeds[i:i+step]) for i in range(0, replicates, step)]
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(bootstrapWorker, jobs)
+            finally:
+                pool.close()
+                pool.join()
+            results = [r for result in results for r in result]
+        else:
+            results = self.bootstrapReplicates(seeds)
+        
+        lo = 0.5 * (1.0 - level)
+        hi = 1.0 - lo
+        bands = {"replicates": replicates, "level": level}
+        bands["lower"] = []
+        bands["upper"] = []
+        for i in range(0, len(self.mesh)):
+            values = sorted([r[0][i] for r in results])
+            bands["lower"].append(percentile(values, lo))
+            bands["upper"].append(percentile(values, hi))
+        for j, name in enumerate(["d10", "d50", "d90", "dmode"]):
+            values = sorted([r[1][j] for r in results])
+            bands[name] = (percentile(values, lo), percentile(values, hi))
+        self.psd_bands = bands
+    
+    def bootstrapReplicates(self, seeds):
+        # Evaluates the bootstrap replicates for a list of seeds, returning
+        # [psd, [d10, d50, d90, dmode]] for each
+        weightsets = [resampleWeights(self.weights, self.num_particles, seed) \
+                      for seed in seeds]
+        (values, points) = self.getKDECoordinates(self.diameters)
+        psds = self.evaluateWeightSets(values, weightsets, points, self.smoothing)
+        
+        # The quantiles are found the same way as those of the ensemble
+        exact = self.quantiletype == "exact" and self.kerneltype in KERNELS
+        if exact:
+            order = sorted(range(0, len(values)), key=values.__getitem__)
+            vs = [values[i] for i in order]
+        
+        results = []
+        for psd, weights in zip(psds, weightsets):
+            psd = self.applyJacobian(psd)
+            if exact:
+                particles = cumulativeParticles(vs, [weights[i] for i in order])
+                stats = [self.findQuantile(t, particles) for t in [0.1, 0.5, 0.9]]
+            else:
+                cdf = cumulativeDensity(self.mesh, psd, self.logspace)[0]
+                stats = [meshQuantile(self.mesh, cdf, t, self.logspace) \
+                         for t in [0.1, 0.5, 0.9]]
+            results.append([psd, stats + [meshMode(self.mesh, psd)]])
+        return results
+    
+    # Incremental updates: particles can be added to or removed from the
+    # ensemble after it is built. The bandwidth and mesh are kept, and the
+    # unnormalised kernel sums on the mesh are updated with the batch alone,
+    # in O(batch x mesh), along with the running moments.
+    def addParticles(self, diameters, weights):
+        self.updateParticles(diameters, weights, 1.0)
+    
+    def removeParticles(self, diameters, weights):
+        self.updateParticles(diameters, weights, -1.0)
+    
+    def updateParticles(self, diameters, weights, sign):
+        if len(diameters) < 1: return
+        if len(self.diameters) < 1:
+            print("Can't update an empty ensemble!")
+            return
+        if (not self.isComputed("psd")) or self.variable:
+            # Nothing derived from the PSD to update (or the bandwidths of
+            # all the particles change), so just change the particles and
+            # compute everything again when it is needed
+            self.updateParticleLists(diameters, weights, sign)
+            self.invalidate("computeEnsembleStats")
+            return
+        self.makeIncremental()
+        changes = self.updateParticleLists(diameters, weights, sign)
+        
+        # The stored particles that were added and removed (merging a
+        # particle replaces the one it is merged into), so the sums follow
+        # what is stored rather than the particles given
+        for (ds, ws), change in zip(changes, [1.0, -1.0]):
+            if len(ds) < 1: continue
+            if self.isComputed("damean"):
+                self.accumulateEnsembleStats(ds, ws, change)
+            
+            # Kernel sums of the batch alone, from the chosen engine
+            (values, points) = self.getKDECoordinates(ds)
+            wsum = sum(ws)
+            batch = self.evaluatePSD(values, ws, points, self.smoothing)
+            for i in range(0, len(points)):
+                self.kernel_sums[i] += change * batch[i] * wsum * self.smoothing
+        
+        if len(changes[0][0]) + len(changes[1][0]) < 1: return
+        if self.isComputed("damean"): self.setEnsembleStats()
+        if len(self.diameters) < 1: return
+        
+        wtotal = sum(self.weights)
+        psd = [k / (wtotal * self.smoothing) for k in self.kernel_sums]
+        self.psd = self.applyJacobian(psd)
+        self.invalidate("computeCumulativePSD")
+    
+    def updateParticleLists(self, diameters, weights, sign):
+        # Adds or removes particles from the lists, returning the stored
+        # particles that were added and those that were removed, as
+        # ((diameters, weights), (diameters, weights))
+        if len(self.weightsets) > 0:
+            print("Warning: other weightings are dropped by particle updates.")
+            self.weightsets = {}
+            self.weighted_psds = {}
+        if self.sorted_particles == None or \
+                self.sorted_particles[2][0] is not self.diameters:
+            # Sorted copies, as the lists may be shared with the parser
+            (ds, ws) = self.getSortedParticles(self.diameters, self.weights)
+            self.diameters = self.storeDiameters(ds, True)
+            self.weights = self.storeWeights(ws, True)
+            if self.logspace:
+                self.log_diameters = self.storeDiameters(\
+                    [math.log(d) for d in self.diameters])
+        
+        # Update the particle lists, which are kept in ascending order
+        added = ([], [])
+        removed = ([], [])
+        for d, w in zip(diameters, weights):
+            if sign > 0.0:
+                i = self.findParticle(d)
+                if i != None and self.collapse != None:
+                    # Merge as collapseParticles() does
+                    (dold, wold) = (self.diameters[i], self.weights[i])
+                    self.deleteParticle(i)
+                    self.insertParticle(dold + (d - dold) * w / (wold + w), \
+                                        wold + w, added)
+                    removed[0].append(dold)
+                    removed[1].append(wold)
+                else:
+                    self.insertParticle(d, w, added)
+                self.num_particles += 1
+                self.weight_squares += w * w
+                continue
+            
+            # Removed from an entry holding at least its weight
+            i = self.findParticle(d, w)
+            if i == None:
+                print("Particle {0} not in the ensemble, not removed.".format(d))
+                continue
+            (dold, wold) = (self.diameters[i], self.weights[i])
+            self.deleteParticle(i)
+            removed[0].append(dold)
+            removed[1].append(wold)
+            if wold - w > w * 1.0e-12:
+                # The rest of the entry, undoing a merge of d into it
+                dnew = dold
+                if self.collapse != None:
+                    dnew = (dold * wold - d * w) / (wold - w)
+                self.insertParticle(dnew, wold - w, added)
+            self.num_particles -= 1
+            self.weight_squares -= w * w
+        
+        self.sorted_particles = (self.diameters, self.weights, \
+                                 (self.diameters, self.weights))
+        self.cdf_particles = None
+        return (added, removed)
+    
+    def insertParticle(self, d, w, added):
+        # Inserts a particle in order, adding it as stored to the lists of
+        # added particles
+        i = bisect.bisect_left(self.diameters, d)
+        self.diameters.insert(i, d)
+        self.weights.insert(i, w)
+        if self.logspace: self.log_diameters.insert(i, math.log(self.diameters[i]))
+        added[0].append(self.diameters[i])
+        added[1].append(w)
+    
+    def deleteParticle(self, i):
+        del self.diameters[i]
+        del self.weights[i]
+        if self.logspace: del self.log_diameters[i]
+    
+    def findParticle(self, d, w=None):
+        # Gets the index of the particle with diameter d, or within the
+        # collapse tolerance of it, or None if there is none. Given a weight
+        # w, only particles with at least that weight are found.
+        tolerance = 0.0
+        if self.collapse != None: tolerance = self.collapse * abs(d)
+        if self.storage == "float": tolerance += FLOAT_EPSILON * abs(d)
+        i = bisect.bisect_left(self.diameters, d - tolerance)
+        best = None
+        while i < len(self.diameters) and self.diameters[i] <= d + tolerance:
+            if w != None and self.weights[i] < w * (1.0 - 1.0e-12):
+                i += 1
+                continue
+            if best == None or abs(self.diameters[i] - d) < \
+                    abs(self.diameters[best] - d):
+                best = i
+            i += 1
+        return best
+    
+    def makeIncremental(self):
+        # Prepares for incremental updates of the PSD: the kernel sums
+        # sum_j w_j K((x - v_j)/h) are recovered from it.
+        if self.isComputed("kernel_sums"): return
+        psd = self.psd
+        if self.logspace:
+            psd = [f * dm for f, dm in zip(self.psd, self.mesh)]
+        scale = sum(self.weights) * self.smoothing
+        self.kernel_sums = [f * scale for f in psd]
+    
     # The kernel used (Gaussian default and recommended)
     def kernel(self, diameters, weights, dmesh, h):
         if self.kerneltype == "Gaussian":
@@ -125,10 +1339,529 @@ class KernelDensity:
                     k = k + ki
             k = (1.0/math.sqrt(PI*2.0)) * k / (sum(weights) * h)
             return k
+        elif self.kerneltype in KERNELS:
+            kern = KERNELS[self.kerneltype]
+            k = 0
+            for di, w in zip(diameters, weights):
+                k += w * kern.profile(pow( (dmesh - di)/h, 2.0))
+            k = kern.norm * k / (sum(weights) * h)
+            return k
         else:
             print("Unknown kernel specified!")
             return -1
     
+    # Array-backed equivalent of kernel(), evaluated at all mesh points at once.
+    # The mesh x particle sum is done in blocks of mesh points so that the
+    # temporary arrays never exceed CHUNK_ELEMENTS entries.
+    def numpyKernel(self, diameters, weights, mesh, h):
+        return self.numpySweep(diameters, weights, mesh, [h])[0]
+    
+    # numpyKernel() for a list of bandwidths: the squared distances of each
+    # block are found once and reused for every bandwidth.
+    def numpySweep(self, diameters, weights, mesh, bandwidths):
+        if self.kerneltype not in KERNELS:
+            print("Unknown kernel specified!")
+            return [[-1 for dm in mesh] for h in bandwidths]
+        
+        kern = KERNELS[self.kerneltype]
+        d = numpy.asarray(diameters, dtype=float)
+        w = numpy.asarray(weights, dtype=float)
+        x = numpy.asarray(mesh, dtype=float)
+        
+        step = max(1, CHUNK_ELEMENTS // len(d))
+        psds = numpy.empty((len(bandwidths), len(x)))
+        for i in range(0, len(x), step):
+            dist = x[i:i+step, numpy.newaxis] - d[numpy.newaxis, :]
+            dist *= dist
+            for j in range(0, len(bandwidths)):
+                h = bandwidths[j]
+                psds[j, i:i+step] = kern.arrayProfile(dist / (h*h)).dot(w)
+        
+        for j in range(0, len(bandwidths)):
+            psds[j] *= kern.norm / (w.sum() * bandwidths[j])
+        return psds.tolist()
+    
+    # Binned approximation of kernel(), costing O(N + G log G) for N particles
+    # on a grid of G points. The weights are linearly binned onto a uniform
+    # grid, convolved with the kernel by FFT and linearly interpolated back
+    # onto the mesh. With grid spacing delta, the absolute error relative to
+    # kernel() at any mesh point is bounded by binnedErrorBound().
+    def binnedKernel(self, diameters, weights, mesh, h):
+        return self.binnedSweep(diameters, weights, mesh, [h])[0]
+    
+    # binnedKernel() for a list of bandwidths: the particles are binned and
+    # Fourier transformed once, on a grid wide enough for the largest.
+    def binnedSweep(self, diameters, weights, mesh, bandwidths):
+        return [psds[0] for psds in \
+                self.binnedSets(diameters, [weights], mesh, bandwidths)]
+    
+    # binnedSweep() for a list of weights of the same particles: the
+    # positions on the grid are found once and every set is binned into its
+    # own column, which is transformed with the others.
+    # Returns a list, per bandwidth, of the PSDs of each set.
+    def binnedSets(self, diameters, weightsets, mesh, bandwidths):
+        if self.kerneltype not in KERNELS:
+            print("Unknown kernel specified!")
+            return [[[-1 for dm in mesh] for ws in weightsets] \
+                    for h in bandwidths]
+        
+        kern = KERNELS[self.kerneltype]
+        d = numpy.asarray(diameters, dtype=float)
+        x = numpy.asarray(mesh, dtype=float)
+        (lb, delta) = self.binnedGrid(d, x, max(bandwidths))
+        G = self.grid_points
+        
+        # Linear binning of the weights onto the grid, one column per set
+        pos = (d - lb) / delta
+        j = numpy.clip(numpy.floor(pos).astype(int), 0, G-2)
+        t = pos - j
+        counts = numpy.empty((G, len(weightsets)))
+        totals = []
+        for k in range(0, len(weightsets)):
+            w = numpy.asarray(weightsets[k], dtype=float)
+            counts[:, k] = numpy.bincount(j, weights=w*(1.0-t), minlength=G) + \
+                           numpy.bincount(j+1, weights=w*t, minlength=G)
+            totals.append(w.sum())
+        
+        # Padding to P >= G + L stops any wrap-around of the convolution
+        L = min(G-1, int(math.ceil(kern.reach(BINNED_CUTOFF) * \
+                                   max(bandwidths) / delta)))
+        P = 1
+        while P < G + L: P *= 2
+        fcounts = numpy.fft.rfft(counts, P, axis=0)
+        grid = lb + delta * numpy.arange(0, G)
+        
+        psds = []
+        for h in bandwidths:
+            # Kernel sampled at the grid lags, -L..L, in wrap-around order
+            lags = numpy.arange(0, L+1) * delta / h
+            kvals = kern.arrayProfile(lags * lags)
+            kvec = numpy.zeros(P)
+            kvec[:L+1] = kvals
+            kvec[P-L:] = kvals[:0:-1]
+            
+            fkern = numpy.fft.rfft(kvec)[:, numpy.newaxis]
+            dens = numpy.fft.irfft(fcounts * fkern, P, axis=0)[:G]
+            psds.append([numpy.interp(x, grid, dens[:, k] * \
+                                      (kern.norm / (totals[k] * h))).tolist() \
+                         for k in range(0, len(weightsets))])
+        
+        return psds
+    
+    def bandwidthClasses(self):
+        # Groups the particles by local bandwidth factor into classes
+        # BANDWIDTH_CLASS_RATIO apart, as {class: [particle indices]}, where
+        # class c has the factor BANDWIDTH_CLASS_RATIO**c.
+        classes = {}
+        step = math.log(BANDWIDTH_CLASS_RATIO)
+        for i, f in enumerate(self.local_factors):
+            classes.setdefault(int(round(math.log(f) / step)), []).append(i)
+        return classes
+    
+    def variableKernel(self, diameters, weights, mesh, h):
+        # The KDE with the bandwidth h * self.local_factors[i] for particle i,
+        # so the diameters must be those of the ensemble (in the space of the
+        # KDE). The numpy engine sums blocks of kernels; the binned engine
+        # bins each class of nearly equal bandwidths (BANDWIDTH_CLASS_RATIO
+        # apart) separately; the others add each particle's kernel to the
+        # mesh points within its reach.
+        if self.kerneltype not in KERNELS:
+            print("Unknown kernel specified!")
+            return [-1 for dm in mesh]
+        
+        kern = KERNELS[self.kerneltype]
+        factors = self.local_factors
+        wsum = float(sum(weights))
+        
+        if self.engine == "binned":
+            psd = numpy.zeros(len(mesh))
+            for c, members in self.bandwidthClasses().items():
+                ws = [weights[i] for i in members]
+                wclass = sum(ws)
+                if wclass <= 0.0: continue
+                part = self.binnedKernel([diameters[i] for i in members], ws, \
+                                         mesh, h * BANDWIDTH_CLASS_RATIO**c)
+                psd += numpy.asarray(part) * (wclass / wsum)
+            return psd.tolist()
+        
+        if self.engine == "numpy":
+            d = numpy.asarray(diameters, dtype=float)
+            hs = h * numpy.asarray(factors, dtype=float)
+            w = numpy.asarray(weights, dtype=float) / hs
+            x = numpy.asarray(mesh, dtype=float)
+            step = max(1, CHUNK_ELEMENTS // len(x))
+            psd = numpy.zeros(len(x))
+            for i in range(0, len(d), step):
+                u = (x[:, numpy.newaxis] - d[numpy.newaxis, i:i+step]) / \
+                    hs[numpy.newaxis, i:i+step]
+                psd += kern.arrayProfile(u * u).dot(w[i:i+step])
+            return (psd * kern.norm / wsum).tolist()
+        
+        reach = kern.reach(self.cutoff)
+        profile = kern.profile
+        sums = [0.0] * len(mesh)
+        for d, w, f in zip(diameters, weights, factors):
+            hi = h * f
+            lo = bisect.bisect_left(mesh, d - reach * hi)
+            up = bisect.bisect_right(mesh, d + reach * hi, lo)
+            w = w / hi
+            for j in range(lo, up):
+                u = (mesh[j] - d) / hi
+                sums[j] += w * profile(u * u)
+        return [s * kern.norm / wsum for s in sums]
+    
+    def histogramKernel(self, diameters, weights, mesh, h):
+        # Weighted histogram with bins of width h centred on the mesh points,
+        # normalised to unit area. Bins of a mesh spaced by h are adjacent,
+        # so each particle is binned directly (keeping those on the outer
+        # edges to within rounding); otherwise the weight within h/2 of each
+        # mesh point is summed from the sorted particles.
+        M = len(mesh)
+        norm = 1.0 / (float(sum(weights)) * h)
+        edge = mesh[0] - 0.5 * h
+        tol = 1.0e-9 * M
+        if M == 1 or abs(mesh[-1] - mesh[0] - (M - 1) * h) <= tol * h:
+            if self.engine in ["numpy", "binned"]:
+                u = (numpy.asarray(diameters, dtype=float) - edge) / h
+                i = numpy.floor(u)
+                i[(i == -1) & (u > -tol)] = 0
+                i[(i == M) & (u < M + tol)] = M - 1
+                inside = (i >= 0) & (i < M)
+                sums = numpy.bincount(i[inside].astype(int), minlength=M, \
+                    weights=numpy.asarray(weights, dtype=float)[inside])
+                return (sums * norm).tolist()
+            
+            sums = [0.0] * M
+            for d, w in zip(diameters, weights):
+                u = (d - edge) / h
+                i = int(math.floor(u))
+                if i == -1 and u > -tol: i = 0
+                elif i == M and u < M + tol: i = M - 1
+                if i >= 0 and i < M: sums[i] += w
+            return [s * norm for s in sums]
+        
+        (ds, ws) = self.getSortedParticles(diameters, weights)
+        cumulative = [0.0]
+        for w in ws:
+            cumulative.append(cumulative[-1] + w)
+        psd = []
+        for dm in mesh:
+            lo = bisect.bisect_left(ds, dm - 0.5 * h)
+            hi = bisect.bisect_left(ds, dm + 0.5 * h, lo)
+            psd.append((cumulative[hi] - cumulative[lo]) * norm)
+        return psd
+    
+    # Truncated equivalent of kernel() needing no numpy. The particles are
+    # sorted once, and for each mesh point only those within self.cutoff
+    # bandwidths (found by bisection) are summed. Compact kernels are
+    # summed over their support only, which is exact.
+    def windowKernel(self, diameters, weights, mesh, h):
+        if self.kerneltype not in KERNELS:
+            print("Unknown kernel specified!")
+            return [-1 for dm in mesh]
+        
+        kern = KERNELS[self.kerneltype]
+        (ds, ws) = self.getSortedParticles(diameters, weights)
+        reach = kern.reach(self.cutoff) * h
+        norm = kern.norm / (sum(weights) * h)
+        
+        psd = []
+        if self.kerneltype == "Gaussian":
+            factor = -0.5 / (h * h)
+            exp = math.exp
+            for dm in mesh:
+                lo = bisect.bisect_left(ds, dm - reach)
+                hi = bisect.bisect_right(ds, dm + reach, lo)
+                k = 0.0
+                for di, w in zip(ds[lo:hi], ws[lo:hi]):
+                    u = dm - di
+                    k += w * exp(u * u * factor)
+                psd.append(k * norm)
+        else:
+            factor = 1.0 / (h * h)
+            profile = kern.profile
+            for dm in mesh:
+                lo = bisect.bisect_left(ds, dm - reach)
+                hi = bisect.bisect_right(ds, dm + reach, lo)
+                k = 0.0
+                for di, w in zip(ds[lo:hi], ws[lo:hi]):
+                    u = dm - di
+                    k += w * profile(u * u * factor)
+                psd.append(k * norm)
+        
+        return psd
+    
+    # windowKernel() for a list of bandwidths. The window is set by the
+    # largest bandwidth, and each particle-mesh distance is found once and
+    # used for every bandwidth.
+    def windowSweep(self, diameters, weights, mesh, bandwidths):
+        if self.kerneltype not in KERNELS:
+            print("Unknown kernel specified!")
+            return [[-1 for dm in mesh] for h in bandwidths]
+        
+        kern = KERNELS[self.kerneltype]
+        (ds, ws) = self.getSortedParticles(diameters, weights)
+        reach = kern.reach(self.cutoff) * max(bandwidths)
+        factors = [1.0 / (h * h) for h in bandwidths]
+        profile = kern.profile
+        
+        psds = [[] for h in bandwidths]
+        for dm in mesh:
+            lo = bisect.bisect_left(ds, dm - reach)
+            hi = bisect.bisect_right(ds, dm + reach, lo)
+            k = [0.0] * len(bandwidths)
+            for di, w in zip(ds[lo:hi], ws[lo:hi]):
+                u2 = (dm - di) * (dm - di)
+                for j in range(0, len(factors)):
+                    k[j] += w * profile(u2 * factors[j])
+            for j in range(0, len(bandwidths)):
+                psds[j].append(k[j])
+        
+        wsum = sum(weights)
+        for j in range(0, len(bandwidths)):
+            norm = kern.norm / (wsum * bandwidths[j])
+            psds[j] = [k * norm for k in psds[j]]
+        return psds
+    
+    # Evaluation of kernel() for the polynomial kernels in O((N + M) log N).
+    # Within the support each kernel is a polynomial in the particle
+    # position, so every window sum is a combination of prefix sums of w*z^k
+    # over the sorted particles. The sums restart for each block of
+    # particles PREFIX_BLOCK bandwidths wide, with z measured from the centre
+    # of the block, so their cancellation doesn't grow with the span of the
+    # data (see errorBound()). Other kernels use windowKernel().
+    def prefixKernel(self, diameters, weights, mesh, h):
+        kern = KERNELS.get(self.kerneltype)
+        if kern == None or kern.power == None:
+            return self.windowKernel(diameters, weights, mesh, h)
+        
+        (ds, ws) = self.getSortedParticles(diameters, weights)
+        wsum = sum(ws)
+        degree = 2 * kern.power
+        starts = prefixBlocks(ds, PREFIX_BLOCK * h)
+        ends = starts[1:] + [len(ds)]
+        centres = [ds[i] + 0.5 * PREFIX_BLOCK * h for i in starts]
+        
+        # Prefix sums of w*z^k for k = 0..degree within each block
+        prefix = []
+        for first, last, centre in zip(starts, ends, centres):
+            sums = [[0.0] for k in range(0, degree+1)]
+            for i in range(first, last):
+                z = (ds[i] - centre) / h
+                term = ws[i]
+                for k in range(0, degree+1):
+                    sums[k].append(sums[k][-1] + term)
+                    term *= z
+            prefix.append(sums)
+        
+        psd = []
+        for dm in mesh:
+            lo = bisect.bisect_left(ds, dm - h)
+            hi = bisect.bisect_right(ds, dm + h, lo)
+            
+            # Add the part of the window in each block it overlaps
+            k = 0.0
+            b = bisect.bisect_right(starts, lo) - 1
+            while b < len(starts) and starts[b] < hi:
+                i = max(lo, starts[b]) - starts[b]
+                j = min(hi, ends[b]) - starts[b]
+                
+                # Expand (1 - (zm - z)^2)^power as coefficients of z^k
+                zm = (dm - centres[b]) / h
+                coeffs = [1.0]
+                for p in range(0, kern.power):
+                    coeffs = multiplyPolynomials(coeffs, [1.0 - zm*zm, 2.0*zm, -1.0])
+                
+                for c, sums in zip(coeffs, prefix[b]):
+                    k += c * (sums[j] - sums[i])
+                b += 1
+            psd.append(max(k, 0.0) * kern.norm / (wsum * h))
+        
+        return psd
+    
+    def getSortedParticles(self, diameters, weights):
+        # Gets the particles sorted by diameter. The result is kept for the
+        # ensemble's own weights, so the same diameters are sorted only once.
+        if self.sorted_particles != None and \
+                self.sorted_particles[0] is diameters and \
+                self.sorted_particles[1] is weights:
+            return self.sorted_particles[2]
+        
+        result = sortParticles(diameters, weights)
+        if weights is self.weights:
+            result = (self.storeDiameters(result[0]), self.storeWeights(result[1]))
+            self.sorted_particles = (diameters, weights, result)
+        return result
+    
+    # Upper bound on |windowKernel() - kernel()| at any mesh point: every
+    # particle left out is at least self.cutoff bandwidths away. Compact
+    # kernels leave nothing out.
+    def windowErrorBound(self):
+        kern = KERNELS[self.kerneltype]
+        if kern.support != None: return 0.0
+        return kern.norm * kern.profile(self.cutoff * self.cutoff) / \
+            self.smoothing
+    
+    def binnedGrid(self, d, x, h):
+        # Gets the lower bound and spacing of the binned engine's grid, which
+        # covers both the particles and the mesh with a margin of
+        # BINNED_CUTOFF bandwidths.
+        lb = min(d.min(), x.min()) - BINNED_CUTOFF * h
+        ub = max(d.max(), x.max()) + BINNED_CUTOFF * h
+        return (lb, (ub - lb) / (self.grid_points - 1))
+    
+    # Upper bound on |binnedKernel() - kernel()| at any mesh point. Linear
+    # binning replaces each kernel by its linear interpolant between grid
+    # points, and interpolating the gridded density onto the mesh does the
+    # same again. For a kernel with a bounded second derivative each step is
+    # in error by at most delta^2/8 * max|K_h''|; for the Gaussian
+    # max|K_h''| = 1/(sqrt(2 pi) h^3), giving
+    #     |error| <= delta^2 / (4 sqrt(2 pi) h^3)
+    # i.e. (delta/h)^2/4 of the peak height of a single normalised kernel.
+    # The kernel truncation at BINNED_CUTOFF bandwidths adds < exp(-32).
+    # See Kernel.interpolationError() for the other kernels.
+    def binnedErrorBound(self):
+        (lb, delta) = self.binnedGrid(numpy.asarray(self.diameters, dtype=float), \
+                                      numpy.asarray(self.mesh, dtype=float), \
+                                      self.smoothing)
+        kern = KERNELS[self.kerneltype]
+        return 2.0 * kern.interpolationError(delta, self.smoothing)
+    
+    # Chooses the cheapest engine for the PSD on the mesh whose error bound
+    # (relative to norm/h) is within self.accuracy, from the costs in
+    # ENGINE_COSTS. The binned engine's grid is set for the chosen plan.
+    def planEngine(self, mesh):
+        if self.bins != None or self.kerneltype not in KERNELS or \
+                len(self.diameters) < 2:
+            if HAVE_NUMPY: return "numpy"
+            return "direct"
+        
+        kern = KERNELS[self.kerneltype]
+        values = self.diameters
+        points = mesh
+        if self.logspace:
+            values = self.log_diameters
+            points = [math.log(dm) for dm in mesh]
+        
+        plans = []
+        for engine in ENGINES:
+            if engine == "auto": continue
+            if engine in ["numpy", "binned"] and (not HAVE_NUMPY): continue
+            if engine == "prefix" and kern.power == None: continue
+            # Variable bandwidths use the window engine's scatter for these
+            if self.variable and engine in ["direct", "prefix"]: continue
+            grid = None
+            if engine == "binned":
+                grid = self.planGrid(values, points)
+                if grid == None: continue
+            elif self.errorBound(engine, values, points) > self.accuracy:
+                continue
+            work = self.engineWork(engine, values, points, self.smoothing, grid)
+            (call, unit) = ENGINE_COSTS[engine]
+            plans.append((call + unit * work, engine, grid))
+        
+        (cost, engine, grid) = min(plans)
+        if grid != None: self.grid_points = grid
+        print("Planned {0} engine for {1} particles and {2} points.".format(\
+            engine, len(values), len(points)))
+        return engine
+    
+    def planGrid(self, values, points):
+        # Gets the smallest power of two grid size for which the binned
+        # engine's error bound is within self.accuracy (or checks the grid
+        # size that was set), or None if there is none.
+        if not self.plan_grid:
+            if self.errorBound("binned", values, points) <= self.accuracy:
+                return self.grid_points
+            return None
+        
+        given = self.grid_points
+        grid = PLANNER_MIN_GRID
+        while grid <= PLANNER_MAX_GRID:
+            self.grid_points = grid
+            if self.errorBound("binned", values, points) <= self.accuracy:
+                break
+            grid *= 2
+        self.grid_points = given
+        if grid > PLANNER_MAX_GRID: return None
+        return grid
+    
+    def errorBound(self, engine, values, points):
+        # Bound on the error of an engine relative to kernel(), as a fraction
+        # of the peak of one normalised kernel (norm/h), for the KDE values
+        # and mesh points. The numpy engine is exact to rounding.
+        kern = KERNELS[self.kerneltype]
+        h = self.smoothing
+        if engine == "window":
+            if self.variable and self.local_factors != None:
+                # Truncating the narrowest kernel loses the most
+                h = h / min(self.local_factors)
+            return self.windowErrorBound() * h / kern.norm
+        elif engine == "binned":
+            (lb, delta) = self.binnedGrid(numpy.asarray(values, dtype=float), \
+                                          numpy.asarray(points, dtype=float), h)
+            if self.variable and self.local_factors != None:
+                # The narrowest kernel has the largest error, and rounding
+                # each bandwidth to its class scales kernels by up to half
+                # of BANDWIDTH_CLASS_RATIO - 1
+                hmin = h * min(self.local_factors)
+                return 2.0 * kern.interpolationError(delta, hmin) * h / \
+                    kern.norm + 0.5 * (BANDWIDTH_CLASS_RATIO - 1.0)
+            return 2.0 * kern.interpolationError(delta, h) * h / kern.norm
+        elif engine == "prefix" and kern.power != None:
+            # Rounding in a prefix sum over n particles of total weight W is
+            # at most n eps W |z|^k, and the coefficients of the kernel's
+            # polynomial in z sum to at most (1 + (|zm| + |z|)^2)^power,
+            # with |z| <= PREFIX_BLOCK/2 and |zm| <= PREFIX_BLOCK/2 + 1. Each
+            # window takes two prefix sums from each of at most two blocks.
+            (vs, ws) = self.getSortedParticles(values, self.weights)
+            starts = prefixBlocks(vs, PREFIX_BLOCK * h)
+            ends = starts[1:] + [len(vs)]
+            worst = max([(last - first) * sum(ws[first:last]) for first, last \
+                         in zip(starts, ends)]) / float(sum(ws))
+            reach = 0.5 * PREFIX_BLOCK
+            return 4.0 * sys.float_info.epsilon * worst * \
+                (1.0 + (2.0 * reach + 1.0)**2)**kern.power
+        return 0.0
+    
+    def engineWork(self, engine, values, points, h, grid=None):
+        # Counts the units of work of an engine for the PSD of the KDE values
+        # on the mesh points, which ENGINE_COSTS converts to seconds:
+        # particle-mesh pairs for the direct and numpy engines, pairs within
+        # the kernel's reach (and a sort) for the window engine, prefix sums
+        # for the prefix engine, and FFTs for the binned engine, where
+        # converting and binning a particle costs about 20 FFT units.
+        n = len(values)
+        m = len(points)
+        kern = KERNELS[self.kerneltype]
+        if engine == "window":
+            if self.variable and self.local_factors != None:
+                reach = kern.reach(self.cutoff) * h
+                pairs = 0
+                for v, f in zip(values, self.local_factors):
+                    pairs += bisect.bisect_right(points, v + reach * f) - \
+                        bisect.bisect_left(points, v - reach * f)
+                return pairs + n
+            (vs, ws) = self.getSortedParticles(values, self.weights)
+            reach = kern.reach(self.cutoff) * h
+            pairs = 0
+            for x in points:
+                pairs += bisect.bisect_right(vs, x + reach) - \
+                    bisect.bisect_left(vs, x - reach)
+            return pairs + n
+        elif engine == "prefix":
+            return (n + m) * (2 * kern.power + 1)
+        elif engine == "binned":
+            if grid == None: grid = self.grid_points
+            size = 1
+            while size < 2 * grid: size *= 2
+            if self.variable and self.local_factors != None:
+                # One FFT convolution per bandwidth class
+                return 20 * n + m + len(self.bandwidthClasses()) * \
+                    size * math.log(size, 2)
+            return 20 * n + m + size * math.log(size, 2)
+        return n * m
+    
     # Return the PSD
     def returnPSD(self):
         return [self.mesh, self.psd]
@@ -141,18 +1874,7 @@ class KernelDensity:
             print("PSD not generated yet!")
         
         # Calculate the CDF
-        cdf = [self.psd[0]]
-        asum = 0
-        
-        i = 1
-        while i < len(self.psd):
-            # Calculate integral element
-            dx = 0.5*(self.mesh[i]-self.mesh[i-1])*(self.psd[i]+self.psd[i-1])
-            cdf.append(dx + cdf[i-1])
-            asum += dx
-            i += 1
-        
-        self.psd_area = asum
+        (cdf, self.psd_area) = cumulativeDensity(self.mesh, self.psd, self.logspace)
         
         return cdf
     
@@ -161,13 +1883,21 @@ class KernelDensity:
     # e.g. d10, d50, dmode, d90 etc
     def calculatePSDStats(self):
         
-        if (not hasattr(self, 'cumulative_psd')):
-            self.cumulative_psd = self.calculateCumulativePSD()
-        
         # Get the d10/d50/d90
-        self.d10 = self.findPoint(0.1)
-        self.d50 = self.findPoint(0.5)
-        self.d90 = self.findPoint(0.9)
+        if len(self.diameters) == 1:
+            self.d10 = self.diameters[0]
+            self.d50 = self.d10
+            self.d90 = self.d10
+            self.dmode = self.d10
+            return
+        elif self.quantiletype == "exact":
+            self.d10 = self.findQuantile(0.1)
+            self.d50 = self.findQuantile(0.5)
+            self.d90 = self.findQuantile(0.9)
+        else:
+            self.d10 = self.findPoint(0.1)
+            self.d50 = self.findPoint(0.5)
+            self.d90 = self.findPoint(0.9)
         self.dmode = self.getMode()
     
     # Print the statistics about this PSD to console.
@@ -191,70 +1921,712 @@ class KernelDensity:
     
     def findPoint(self, t):
         # Given a cumulative density 't', return the value of the mesh
-        value = -1
+        return meshQuantile(self.mesh, self.cumulative_psd, t, self.logspace)
+    
+    
+    def getCDFParticles(self):
+        # Gets the particle values in the space of the KDE in ascending order,
+        # with the weight below each particle (cumulative[i] is the weight of
+        # the first i particles).
+        if self.cdf_particles == None:
+            (ds, ws) = self.getSortedParticles(self.diameters, self.weights)
+            if self.logspace: ds = [math.log(d) for d in ds]
+            self.cdf_particles = cumulativeParticles(ds, ws)
+        return self.cdf_particles
+    
+    def evaluateCDF(self, x, particles=None):
+        # Gets the fraction of the KDE below x (in the space of the KDE) and
+        # the density there. Particles more than the kernel's reach below x
+        # count in full, so only those in the window are summed. Other
+        # weights of the particles may be given, as from cumulativeParticles().
+        kern = KERNELS[self.kerneltype]
+        if particles == None: particles = self.getCDFParticles()
+        (vs, ws, cumulative) = particles
+        h = self.smoothing
+        reach = kern.reach(self.cutoff) * h
+        lo = bisect.bisect_left(vs, x - reach)
+        hi = bisect.bisect_right(vs, x + reach, lo)
         
-        i = 0
-        while i < len(self.cumulative_psd):
+        below = cumulative[lo]
+        dens = 0.0
+        for v, w in zip(vs[lo:hi], ws[lo:hi]):
+            u = (x - v) / h
+            below += w * kern.cdf(u)
+            dens += w * kern.density(u)
+        return (below / cumulative[-1], dens / (cumulative[-1] * h))
+    
+    def getParticleQuantiles(self, fractions):
+        # Gets the exact weighted quantiles of the particles themselves (no
+        # smoothing) for a list of cumulative fractions: the smallest diameter
+        # at which the cumulative weight reaches each fraction of the total.
+        # The particles are sorted and summed once for any number of
+        # fractions.
+        (ds, ws) = self.getSortedParticles(self.diameters, self.weights)
+        cumulative = self.getCDFParticles()[2]
+        targets = [f * cumulative[-1] for f in fractions]
+        if HAVE_NUMPY:
+            indices = numpy.searchsorted(numpy.asarray(cumulative[1:]), \
+                                         targets, "left").tolist()
+        else:
+            indices = [bisect.bisect_left(cumulative, t, 1) - 1 for t in targets]
+        return [ds[min(i, len(ds)-1)] for i in indices]
+    
+    def getCDF(self, d):
+        # Gets the exact cumulative KDE at the diameter d
+        if self.logspace: return self.evaluateCDF(math.log(d))[0]
+        return self.evaluateCDF(d)[0]
+    
+    def findQuantile(self, t, particles=None):
+        # Given a cumulative density 't', return the diameter at which the
+        # exact CDF reaches it (for the particles of evaluateCDF()). Newton's
+        # method on the CDF (whose derivative is the PSD), kept inside a
+        # bracket by bisection.
+        if self.kerneltype not in KERNELS: return self.findPoint(t)
+        if particles == None: particles = self.getCDFParticles()
+        (vs, ws, cumulative) = particles
+        reach = KERNELS[self.kerneltype].reach(self.cutoff) * self.smoothing
+        lo = vs[0] - reach
+        hi = vs[-1] + reach
+        x = weightedQuantile(vs, ws, t)
+        
+        for i in range(0, 200):
+            (f, dens) = self.evaluateCDF(x, particles)
+            if f < t: lo = x
+            else: hi = x
             
-            if t == self.cumulative_psd[i]:
-                value = self.mesh[i]
-            elif (self.cumulative_psd[i-1] < t and self.cumulative_psd[i] > t):
-                value = self.interpolate(t, self.mesh[i-1], self.mesh[i], self.cumulative_psd[i-1], self.cumulative_psd[i])
-            i += 1
+            step = 0.0
+            if dens > 0.0: step = (t - f) / dens
+            xnew = x + step
+            if dens <= 0.0 or xnew <= lo or xnew >= hi:
+                xnew = 0.5 * (lo + hi)
+            if abs(xnew - x) <= QUANTILE_TOL * max(abs(x), self.smoothing) or \
+                    hi - lo <= QUANTILE_TOL * max(abs(x), self.smoothing):
+                x = xnew
+                break
+            x = xnew
         
-        return value
+        if self.logspace: return math.exp(x)
+        return x
     
-   
     def getMode(self):
         # Get the mode of the PSD
-        dmax = 0
-        imax = 0
-        i = 0
-        while i < len(self.psd):
-            
-            if self.psd[i] > dmax:
-                dmax = self.psd[i]
-                imax = i
-            
-            i += 1
-        
-        return self.mesh[imax]
+        return meshMode(self.mesh, self.psd)
 
+    def computeEnsembleStats(self):
+        self.calculateEnsembleStats(self.diameters, self.weights)
+    
     def calculateEnsembleStats(self, diameters, weights):
-        # Generate general statistics about this PSD
-        
-        self.damean = 0         # arithmetic mean
-        self.astdev = 0         # arithmetic stdev
-        self.dgmean = 1.0       # geometric mean
-        self.gstdev = 1.0       # geometric stdev
+        # Generate general statistics about this PSD in a single pass over
+        # the particles. The moments of d and ln(d) are accumulated with
+        # WeightedMoments, so the geometric mean is found from the mean of
+        # ln(d) instead of a product of powers.
         
         # Check for diameters and weights
         if (not (hasattr(self, 'diameters') and hasattr(self, 'weights'))):
             print("No diameters or weights found!")
             raise
         
-        asum = 0.0
-        gsum = 1.0
-        avar = 0.0
-        gvar = 1.0
+        self.linear_moments = WeightedMoments()
+        self.log_moments = WeightedMoments()
+        self.power_sums = [0.0, 0.0, 0.0]   # sums of w d^2, w d^3, w d^4
+        self.log_excluded = 0               # particles with d <= 0 (no ln(d))
+        self.accumulateEnsembleStats(self.diameters, self.weights, 1.0)
+        self.setEnsembleStats()
+    
+    def accumulateEnsembleStats(self, diameters, weights, sign):
+        # Adds (sign 1) or removes (sign -1) particles from the running
+        # moments
+        linear = self.linear_moments
+        log = self.log_moments
+        (s2, s3, s4) = self.power_sums
+        if HAVE_NUMPY and sign > 0.0 and len(diameters) > MOMENTS_BATCH and \
+                min(weights) > 0.0:
+            # Large batches are added with numpy, in a few passes
+            d = numpy.asarray(diameters, dtype=float)
+            w = numpy.asarray(weights, dtype=float)
+            linear.addArray(d, w)
+            positive = d > 0.0
+            log.addArray(numpy.log(d[positive]), w[positive])
+            self.log_excluded += len(d) - int(positive.sum())
+            wd2 = w * d * d
+            self.power_sums = [s2 + wd2.sum(), s3 + wd2.dot(d), \
+                               s4 + (wd2 * d).dot(d)]
+            return
+        for d, w in zip(diameters, weights):
+            if sign > 0.0:
+                linear.add(d, w)
+                if d > 0.0: log.add(math.log(d), w)
+                else: self.log_excluded += 1
+            else:
+                linear.remove(d, w)
+                if d > 0.0: log.remove(math.log(d), w)
+                else: self.log_excluded -= 1
+                w = -w
+            d2 = d * d
+            s2 += w * d2
+            s3 += w * d2 * d
+            s4 += w * d2 * d2
+        self.power_sums = [s2, s3, s4]
+    
+    def setEnsembleStats(self):
+        # Sets the ensemble statistics from the running moments
+        linear = self.linear_moments
+        log = self.log_moments
+        (s2, s3, s4) = self.power_sums
+        if linear.weight <= 0.0:
+            print("No weight left in the ensemble!")
+            return
         
-        # Calculate scaling factor
-        p = (1.0/sum(self.weights))
+        self.damean = linear.mean           # arithmetic mean
+        self.astdev = linear.stdev()        # arithmetic stdev
+        self.dgmean = float("nan")          # geometric mean and stdev,
+        self.gstdev = float("nan")          # for positive values only
+        if self.log_excluded == 0:
+            self.dgmean = math.exp(log.mean)
+            self.gstdev = math.exp(log.stdev())
+        self.d32 = float("nan")             # Sauter mean
+        self.d43 = float("nan")             # De Brouckere mean
+        if s2 != 0.0: self.d32 = s3 / s2
+        if s3 != 0.0: self.d43 = s4 / s3
+        self.skewness = linear.skewness()
+        self.kurtosis = linear.kurtosis()   # excess kurtosis
+        self.number_density = linear.weight # sum of the weights
+    
+# The lazy attributes of KernelDensity, grouped by the method that computes
+# them (None for those set elsewhere, which are only invalidated). Each group
+# depends on those before it, so invalidating one group invalidates all of
+# the groups after it too.
+LAZY_ATTRIBUTES = [
+    ("computeEnsembleStats", ["damean", "astdev", "dgmean", "gstdev", "d32", \
+                              "d43", "skewness", "kurtosis", "number_density", \
+                              "linear_moments", "log_moments", "power_sums", \
+                              "log_excluded"]),
+    ("computeBandwidth", ["smoothing", "local_factors"]),
+    ("computePSD", ["mesh", "psd", "weighted_psds"]),
+    (None, ["kernel_sums", "psd_bands"]),
+    ("computeCumulativePSD", ["cumulative_psd", "psd_area"]),
+    ("calculatePSDStats", ["d10", "d50", "d90", "dmode"])]
+for method, names in LAZY_ATTRIBUTES:
+    for name in names:
+        if method != None:
+            setattr(KernelDensity, name, LazyAttribute(name, method))
+
+class JointKernelDensity(object):
+    # Weighted KDE of the joint distribution of two particle properties,
+    # with a product of the same kernel along each axis. Each axis follows
+    # the KernelDensity conventions for its bounds, mesh, log space and
+    # bandwidth rule, with N^(-1/6) in place of N^(-1/5) for two dimensions.
+    # The particles are linearly binned onto the mesh and convolved with the
+    # kernel by FFT (or by separable sums without numpy).
+    
+    def __init__(self, xvalues, yvalues, weights, bandwidths=None, \
+                 points=JOINT_GRID, kernel="Gaussian", logspace=(False, False)):
         
-        # First calculate the means...
-        for d, w in zip(self.diameters, self.weights):
-            asum += (d * w)
-            gsum *= math.pow(d, w*p)
+        if bandwidths == None: bandwidths = (-1, -1)
+        self.axes = []
+        self.smoothing = []
+        for values, h, log in zip([xvalues, yvalues], bandwidths, logspace):
+            axis = KernelDensity(values, weights, -1, points=points, \
+                                 kernel=kernel, logspace=log, collapse=None)
+            if h < 0:
+                h = axis.smoothing * pow(axis.num_particles, 0.2 - 1.0/6.0)
+            self.axes.append(axis)
+            self.smoothing.append(h)
         
-        self.damean = asum / sum(self.weights)
-        self.dgmean = gsum
+        self.kerneltype = self.axes[0].kerneltype
+        self.logspace = logspace
+        self.xmesh = self.axes[0].makeMesh(points, self.axes[0].lowerbound, \
+                                           self.axes[0].upperbound)
+        self.ymesh = self.axes[1].makeMesh(points, self.axes[1].lowerbound, \
+                                           self.axes[1].upperbound)
+        self.density = self.calculateDensity(xvalues, yvalues, weights)
+    
+    def calculateDensity(self, xvalues, yvalues, weights):
+        # Gets the density at each point of the mesh, as a list of rows:
+        # density[i][j] is at (xmesh[i], ymesh[j]).
+        kern = KERNELS[self.kerneltype]
         
-        # Now use these to find the stdevs...
-        for d, w in zip(self.diameters, self.weights):
-            avar += w * math.pow(d - self.damean, 2.0)
-            gvar += w * math.pow(math.log(d) - math.log(self.dgmean), 2.0)
+        # Uniform grids in the space of the KDE along each axis, each
+        # [values, lower bound, spacing, size, refinement, kernel at lags 0..L]
+        G = len(self.xmesh)
+        grids = []
+        for values, mesh, log, h in zip([xvalues, yvalues], \
+                                        [self.xmesh, self.ymesh], \
+                                        self.logspace, self.smoothing):
+            if log:
+                values = [math.log(v) for v in values]
+                mesh = [math.log(m) for m in mesh]
+            delta = mesh[1] - mesh[0]
+            refine = 1
+            if HAVE_NUMPY:
+                refine = min(JOINT_REFINE, max(1, int(math.ceil(4.0*delta/h))))
+            delta = delta / refine
+            size = (G-1) * refine + 1
+            L = min(size-1, int(math.ceil(kern.reach(BINNED_CUTOFF) * h / delta)))
+            kvals = [kern.profile((l*delta/h)**2) for l in range(0, L+1)]
+            grids.append([values, mesh[0], delta, size, refine, kvals])
         
-        self.astdev = math.sqrt(avar / sum(self.weights))
-        self.gstdev = math.exp(math.sqrt(gvar / sum(self.weights)))
-            
-        
\ No newline at end of file
+        if HAVE_NUMPY:
+            dens = self.binnedFFT(weights, grids)
+        else:
+            dens = self.binnedSums(weights, grids)
+        
+        norm = kern.norm * kern.norm / \
+            (sum(weights) * self.smoothing[0] * self.smoothing[1])
+        for i in range(0, G):
+            for j in range(0, G):
+                jac = 1.0
+                if self.logspace[0]: jac /= self.xmesh[i]
+                if self.logspace[1]: jac /= self.ymesh[j]
+                dens[i][j] *= norm * jac
+        return dens
+    
+    def binnedFFT(self, weights, grids):
+        # Binned density by FFT: the kernel is separable, so its 2D transform
+        # is the outer product of the transforms along each axis.
+        [xs, xlb, dx, Gx, rx, kx] = grids[0]
+        [ys, ylb, dy, Gy, ry, ky] = grids[1]
+        x = (numpy.asarray(xs, dtype=float) - xlb) / dx
+        y = (numpy.asarray(ys, dtype=float) - ylb) / dy
+        w = numpy.asarray(weights, dtype=float)
+        inside = (x >= 0) & (x <= Gx-1) & (y >= 0) & (y <= Gy-1)
+        (x, y, w) = (x[inside], y[inside], w[inside])
+        i = numpy.minimum(numpy.floor(x).astype(int), Gx-2)
+        j = numpy.minimum(numpy.floor(y).astype(int), Gy-2)
+        tx = x - i
+        ty = y - j
+        
+        counts = numpy.zeros(Gx*Gy)
+        for di, dj, f in [(0, 0, (1-tx)*(1-ty)), (1, 0, tx*(1-ty)), \
+                          (0, 1, (1-tx)*ty), (1, 1, tx*ty)]:
+            counts += numpy.bincount((i+di)*Gy + (j+dj), weights=w*f, \
+                                     minlength=Gx*Gy)
+        counts = counts.reshape((Gx, Gy))
+        
+        # Padding to P >= G + L stops any wrap-around of the convolution
+        kvecs = []
+        sizes = []
+        for G, k in [(Gx, kx), (Gy, ky)]:
+            L = len(k) - 1
+            P = 1
+            while P < G + L: P *= 2
+            kvec = numpy.zeros(P)
+            kvec[:L+1] = k
+            if L > 0: kvec[P-L:] = k[:0:-1]
+            kvecs.append(kvec)
+            sizes.append(P)
+        transform = numpy.outer(numpy.fft.fft(kvecs[0]), numpy.fft.rfft(kvecs[1]))
+        dens = numpy.fft.irfft2(numpy.fft.rfft2(counts, sizes) * transform, \
+                                sizes)[:Gx:rx, :Gy:ry]
+        return dens.tolist()
+    
+    def binnedSums(self, weights, grids):
+        # Binned density by direct sums along each axis in turn
+        [xs, xlb, dx, G, rx, kx] = grids[0]
+        [ys, ylb, dy, G, ry, ky] = grids[1]
+        counts = [[0.0] * G for i in range(0, G)]
+        for x, y, w in zip(xs, ys, weights):
+            x = (x - xlb) / dx
+            y = (y - ylb) / dy
+            if x < 0 or x > G-1 or y < 0 or y > G-1: continue
+            i = min(int(x), G-2)
+            j = min(int(y), G-2)
+            tx = x - i
+            ty = y - j
+            counts[i][j] += w * (1-tx) * (1-ty)
+            counts[i+1][j] += w * tx * (1-ty)
+            counts[i][j+1] += w * (1-tx) * ty
+            counts[i+1][j+1] += w * tx * ty
+        
+        # Along x, then along y
+        rows = [[0.0] * G for i in range(0, G)]
+        for i in range(0, G):
+            for l in range(max(0, i-len(kx)+1), min(G, i+len(kx))):
+                k = kx[abs(i-l)]
+                row = rows[i]
+                for j, c in enumerate(counts[l]):
+                    row[j] += k * c
+        dens = []
+        for row in rows:
+            dens.append([sum([ky[abs(j-l)] * row[l] for l in \
+                              range(max(0, j-len(ky)+1), min(G, j+len(ky)))]) \
+                         for j in range(0, G)])
+        return dens
+
+class WeightedMoments:
+    # Running weighted mean and central moments M2, M3, M4 (sums of
+    # w (x - mean)^k), updated one value at a time with the pairwise
+    # formulae of Pebay (2008), which avoid the cancellation of raw power sums.
+    
+    def __init__(self):
+        self.weight = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+    
+    def add(self, x, w):
+        # Adds x with weight w, which may be negative to take x out again
+        wa = self.weight
+        wn = wa + w
+        if wn <= 0.0: return
+        delta = x - self.mean
+        dn = delta / wn
+        term = delta * dn * wa * w
+        
+        self.m4 += term * dn * dn * (wa*wa - wa*w + w*w) + \
+            6.0 * dn * dn * w * w * self.m2 - 4.0 * dn * w * self.m3
+        self.m3 += term * dn * (wa - w) - 3.0 * dn * w * self.m2
+        self.m2 += term
+        self.mean += w * dn
+        self.weight = wn
+    
+    def addArray(self, xs, ws):
+        # Adds numpy arrays of values and (positive) weights at once: their
+        # moments about their own mean are found in two passes and combined
+        # with the running ones by the same pairwise formulae
+        wb = ws.sum()
+        if wb <= 0.0: return
+        mb = ws.dot(xs) / wb
+        dev = xs - mb
+        wd2 = ws * dev * dev
+        (m2b, m3b, m4b) = (wd2.sum(), wd2.dot(dev), (wd2 * dev).dot(dev))
+        
+        wa = self.weight
+        wn = wa + wb
+        delta = mb - self.mean
+        dn = delta / wn
+        term = delta * dn * wa * wb
+        
+        self.m4 += m4b + term * dn * dn * (wa*wa - wa*wb + wb*wb) + \
+            6.0 * dn * dn * (wa*wa * m2b + wb*wb * self.m2) + \
+            4.0 * dn * (wa * m3b - wb * self.m3)
+        self.m3 += m3b + term * dn * (wa - wb) + \
+            3.0 * dn * (wa * m2b - wb * self.m2)
+        self.m2 += m2b + term
+        self.mean += wb * dn
+        self.weight = wn
+    
+    def remove(self, x, w):
+        # Reverses add(x, w); removing all of the weight empties the moments
+        if self.weight - w <= 0.0:
+            self.__init__()
+        else:
+            self.add(x, -w)
+    
+    def stdev(self):
+        if self.weight <= 0.0: return 0.0
+        return math.sqrt(max(self.m2, 0.0) / self.weight)
+    
+    def skewness(self):
+        if self.m2 <= 0.0: return 0.0
+        return math.sqrt(self.weight) * self.m3 / self.m2**1.5
+    
+    def kurtosis(self):
+        # Excess kurtosis, zero for a normal distribution
+        if self.m2 <= 0.0: return 0.0
+        return self.weight * self.m4 / (self.m2 * self.m2) - 3.0
+
+def cumulativeDensity(mesh, psd, logspace=False):
+    # Integrates a PSD over its mesh with the trapezoid rule, in ln(d) for a
+    # log-space PSD (where f(ln d) = d f(d) is smooth). Returns the
+    # cumulative PSD (which starts from psd[0]) and the area.
+    cdf = [psd[0]]
+    asum = 0
+    
+    i = 1
+    while i < len(psd):
+        # Calculate integral element
+        if logspace:
+            dx = 0.5*math.log(mesh[i]/mesh[i-1])*(psd[i]*mesh[i]+psd[i-1]*mesh[i-1])
+        else:
+            dx = 0.5*(mesh[i]-mesh[i-1])*(psd[i]+psd[i-1])
+        cdf.append(dx + cdf[i-1])
+        asum += dx
+        i += 1
+    
+    return (cdf, asum)
+
+def meshQuantile(mesh, cdf, t, logspace=False):
+    # Given a cumulative density 't', returns the diameter interpolated
+    # from the cumulative PSD on the mesh (in ln(d) for a geometric mesh),
+    # or -1 if it is not reached
+    value = -1
+    
+    i = 0
+    while i < len(cdf):
+        
+        if t == cdf[i]:
+            value = mesh[i]
+        elif (cdf[i-1] < t and cdf[i] > t):
+            if logspace:
+                dl = math.log(mesh[i-1])
+                du = math.log(mesh[i])
+            else:
+                dl = mesh[i-1]
+                du = mesh[i]
+            value = (du - dl) * (t - cdf[i-1]) / (cdf[i] - cdf[i-1]) + dl
+            if logspace: value = math.exp(value)
+        i += 1
+    
+    return value
+
+def meshMode(mesh, psd):
+    # Returns the mesh point at the maximum of the PSD
+    dmax = 0
+    imax = 0
+    i = 0
+    while i < len(psd):
+        
+        if psd[i] > dmax:
+            dmax = psd[i]
+            imax = i
+        
+        i += 1
+    
+    return mesh[imax]
+
+def cumulativeParticles(values, weights):
+    # Gets sorted values and their weights with the weight below each value
+    # (cumulative[i] is the weight of the first i), as (values, weights,
+    # cumulative)
+    cumulative = [0.0]
+    for w in weights:
+        cumulative.append(cumulative[-1] + w)
+    return (values, weights, cumulative)
+
+def bootstrapWorker(job):
+    # Evaluates a share of the bootstrap replicates in a pool process
+    (ensemble, seeds) = job
+    return ensemble.bootstrapReplicates(seeds)
+
+def resampleWeights(weights, count, seed):
+    # Draws count particles with probability proportional to weight, and
+    # returns the weight of each particle in the resample: the number of
+    # times it was drawn, scaled to keep the total weight.
+    total = float(sum(weights))
+    if HAVE_NUMPY:
+        w = numpy.asarray(weights, dtype=float)
+        counts = numpy.random.RandomState(seed).multinomial(count, w / total)
+        return (counts * (total / count)).tolist()
+    
+    rng = random.Random(seed)
+    cumulative = []
+    csum = 0.0
+    for w in weights:
+        csum += w
+        cumulative.append(csum)
+    counts = [0] * len(weights)
+    for k in range(0, count):
+        i = bisect.bisect_right(cumulative, rng.random() * csum)
+        counts[min(i, len(weights)-1)] += 1
+    return [c * total / count for c in counts]
+
+def syntheticParticles(count, gmean=50.0, gstdev=1.6, seed=0):
+    # Draws count particles from a lognormal distribution of diameters, with
+    # statistical weights uniform on [0.5, 1.5), for benchmarks
+    rng = random.Random(seed)
+    diameters = [rng.lognormvariate(math.log(gmean), math.log(gstdev)) \
+                 for i in range(0, count)]
+    weights = [0.5 + rng.random() for i in range(0, count)]
+    return (diameters, weights)
+
+def benchmarkEngines(diameters, weights, points=64, kernel="Gaussian", \
+                     logspace=False, engines=None, accuracy=None, cutoff=None):
+    # Measures the runtime of each engine for the PSD of the particles and
+    # its error against the exact sums of kernel(), both relative to the
+    # peak of one normalised kernel (norm/h). The "auto" engine is measured
+    # as the engine it plans. Returns a list of rows of
+    # [engine, particles, points, bandwidth, work, seconds, bound, error].
+    if engines == None: engines = ENGINES
+    ens = KernelDensity(diameters, weights, -1, "direct", points=points, \
+                        kernel=kernel, logspace=logspace, accuracy=accuracy, \
+                        cutoff=cutoff)
+    (values, mesh) = ens.getKDECoordinates(ens.diameters)
+    h = ens.smoothing
+    scale = h / KERNELS[ens.kerneltype].norm
+    start = time.time()
+    exact = ens.evaluatePSD(values, ens.weights, mesh, h)
+    seconds = time.time() - start
+    
+    rows = []
+    sorted_particles = ens.sorted_particles
+    for engine in engines:
+        if engine in ["numpy", "binned"] and (not HAVE_NUMPY): continue
+        if engine == "prefix" and KERNELS[ens.kerneltype].power == None:
+            # The same as the window engine
+            continue
+        ens.setEngine(engine)
+        ens.grid_points = BINNED_GRID
+        if ens.auto_engine:
+            ens.engine = ens.planEngine(ens.mesh)
+        
+        # Each engine starts from the particles as the ensemble holds them
+        if engine != "direct":
+            ens.sorted_particles = sorted_particles
+            start = time.time()
+            psd = ens.evaluatePSD(values, ens.weights, mesh, h)
+            seconds = time.time() - start
+        else:
+            psd = exact
+        
+        error = max([abs(f - g) for f, g in zip(psd, exact)]) * scale
+        name = ens.engine
+        if ens.auto_engine: name = "auto:" + ens.engine
+        rows.append([name, len(values), len(mesh), h, \
+                     ens.engineWork(ens.engine, values, mesh, h), seconds, \
+                     ens.errorBound(ens.engine, values, mesh), error])
+    return rows
+
+def fitEngineCosts(rows):
+    # Fits ENGINE_COSTS (seconds per call and per unit of work) to the rows
+    # of benchmarkEngines() for each engine, by least squares of the relative
+    # error of the predicted seconds (so small and large cases count alike),
+    # keeping both costs positive. Returns a dictionary like ENGINE_COSTS.
+    costs = {}
+    for engine in ENGINES:
+        data = [(row[4], row[5]) for row in rows if row[5] > 0.0 and \
+                row[0] in [engine, "auto:" + engine]]
+        if len(data) < 1: continue
+        # Normal equations of sum(((call + unit*w) / s - 1)^2)
+        a11 = sum([1.0 / (s * s) for w, s in data])
+        a12 = sum([w / (s * s) for w, s in data])
+        a22 = sum([w * w / (s * s) for w, s in data])
+        b1 = sum([1.0 / s for w, s in data])
+        b2 = sum([w / s for w, s in data])
+        det = a11 * a22 - a12 * a12
+        call = -1.0
+        if det > 0.0:
+            call = (b1 * a22 - b2 * a12) / det
+            unit = (a11 * b2 - a12 * b1) / det
+        if call < 0.0 or unit <= 0.0:
+            # Through the origin instead
+            call = 0.0
+            unit = b2 / a22
+        costs[engine] = (call, unit)
+    return costs
+
+def percentile(sortedvalues, p):
+    # Returns the fraction p through a sorted list, interpolating linearly
+    # between its values
+    pos = p * (len(sortedvalues) - 1)
+    i = min(int(pos), len(sortedvalues) - 2)
+    if i < 0: return sortedvalues[0]
+    t = pos - i
+    return (1.0 - t) * sortedvalues[i] + t * sortedvalues[i+1]
+
+def storeValues(values, typecode, copy=False):
+    # Gets the values as a list (typecode None) or a typed array of the
+    # typecode, copying them only if they are not already one (or copy is
+    # set, so they may be changed)
+    if typecode == None:
+        if copy or not isinstance(values, list): return list(values)
+        return values
+    if copy or not (isinstance(values, array.array) and \
+                    values.typecode == typecode):
+        return array.array(typecode, values)
+    return values
+
+def storageBytes(values, seen=None):
+    # Gets the number of bytes held by a typed array, or by a list and the
+    # floats in it. Objects whose ids are in the set seen are not counted
+    # again, and are added to it.
+    if seen == None: seen = set()
+    if id(values) in seen: return 0
+    seen.add(id(values))
+    total = sys.getsizeof(values)
+    if isinstance(values, array.array): return total
+    for v in values:
+        if id(v) not in seen:
+            seen.add(id(v))
+            total += sys.getsizeof(v)
+    return total
+
+def sortParticles(diameters, weights):
+    # Returns lists of the diameters and their weights in ascending order of
+    # diameter.
+    pairs = sorted(zip(diameters, weights))
+    return ([p[0] for p in pairs], [p[1] for p in pairs])
+
+def collapseParticles(diameters, weights, tolerance=0.0):
+    # Merges particles whose diameters are within a relative tolerance of the
+    # smallest diameter of their group. A merged particle carries the summed
+    # weight at the weighted mean diameter, so the arithmetic mean is kept.
+    # Returns lists of the unique diameters and weights in ascending order.
+    return collapseParticleSets(diameters, weights, [], tolerance)[:2]
+
+def collapseParticleSets(diameters, weights, weightsets, tolerance=0.0):
+    # collapseParticles(), also summing each of a list of other weightings
+    # of the particles over the merged groups. Returns the unique diameters,
+    # their weights and the list of merged weightsets.
+    order = sorted(range(0, len(diameters)), key=diameters.__getitem__)
+    udiameters = []
+    uweights = []
+    usets = [[] for ws in weightsets]
+    start = None
+    for i in order:
+        d = diameters[i]
+        w = weights[i]
+        if start != None and d - start <= tolerance * abs(start):
+            wsum = uweights[-1] + w
+            if wsum > 0.0:
+                udiameters[-1] += (d - udiameters[-1]) * w / wsum
+            uweights[-1] = wsum
+            for us, ws in zip(usets, weightsets): us[-1] += ws[i]
+        else:
+            start = d
+            udiameters.append(d)
+            uweights.append(w)
+            for us, ws in zip(usets, weightsets): us.append(ws[i])
+    return (udiameters, uweights, usets)
+
+def prefixBlocks(values, width):
+    # Splits sorted values into blocks spanning at most width each. Returns
+    # the index of the first value of each block.
+    starts = []
+    first = None
+    for i in range(0, len(values)):
+        if first == None or values[i] - first > width:
+            starts.append(i)
+            first = values[i]
+    return starts
+
+def multiplyPolynomials(a, b):
+    # Multiplies two polynomials given as lists of coefficients in ascending
+    # order of power.
+    product = [0.0] * (len(a) + len(b) - 1)
+    for i in range(0, len(a)):
+        for j in range(0, len(b)):
+            product[i+j] += a[i] * b[j]
+    return product
+
+def weightedQuantile(values, weights, p):
+    # Returns the smallest of the sorted values at which the cumulative
+    # weight reaches the fraction p of the total
+    target = p * sum(weights)
+    csum = 0.0
+    for v, w in zip(values, weights):
+        csum += w
+        if csum >= target: return v
+    return values[-1]
+
+def intervalErrors(mesh, psd):
+    # Estimates the error each mesh interval contributes to the cumulative
+    # PSD: linear interpolation across the interval (width * |change in
+    # density| / 8) plus the trapezoid rule (width^3 * |f''| / 12), with the
+    # second derivative taken from the neighbouring points.
+    n = len(mesh)
+    curvature = [0.0] * n
+    for i in range(1, n-1):
+        h1 = mesh[i] - mesh[i-1]
+        h2 = mesh[i+1] - mesh[i]
+        curvature[i] = abs(2.0 * (h1*psd[i+1] - (h1+h2)*psd[i] + h2*psd[i-1]) / \
+                           (h1 * h2 * (h1 + h2)))
+    
+    errors = []
+    for i in range(0, n-1):
+        width = mesh[i+1] - mesh[i]
+        f2 = max(curvature[i], curvature[i+1])
+        errors.append(width * abs(psd[i+1] - psd[i]) / 8.0 + \
+                      width**3 * f2 / 12.0)
+    return errors
@@ -1,9 +1,47 @@
+import os
 import re
+import sys
+import json
+import mmap
+import array
+import struct
+import hashlib
+import warnings
 import series
 
+# Optional imports (used by the bulk column reader)
+try:
+    import numpy
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+# Sidecar cache of the columns parsed from CSVs (a ColumnCache), used by
+# every parser once set by setColumnCache()
+COLUMN_CACHE = None
+
+# Default directory of the cache, and the number of bytes it may hold before
+# the least recently used files are removed
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".mops_cache")
+CACHE_CAPACITY = 512 * 1024 * 1024
+CACHE_MAGIC = b"MOPSCOL1"
+
+def setColumnCache(cache):
+    # Sets the ColumnCache used by all parsers (None for no cache)
+    global COLUMN_CACHE
+    COLUMN_CACHE = cache
+
 class Parser:
-    # Default constructor
+    # Default constructor. A FileSession may be given in place of the file
+    # name, which is then read from the start without opening it again.
     def __init__(self, fname):
+        self.m_session = None
+        if isinstance(fname, FileSession):
+            self.m_session = fname
+            self.m_fname = fname.m_fname
+            self.m_istream = fname.m_istream
+            self.m_session.rewind()
+            return
         self.m_fname = fname
         
         try:
@@ -13,11 +51,34 @@ class Parser:
             print("Couldn't open file {0}.".format(self.m_fname))
             raise
     
-    # Closes the CSV
+    # Closes the CSV (a session stays open for the next parser)
     def closeCSV(self):
+        if self.m_session != None: return
         print("Closing file {0}.".format(self.m_fname))
         self.m_istream.close()
     
+    def getSource(self):
+        # Gets what to give another parser of the same file
+        if self.m_session != None: return self.m_session
+        return self.m_fname
+    
+    def getStat(self):
+        # Gets the status (size, modification time) of the open file
+        if self.m_session != None: return self.m_session.m_stat
+        return os.fstat(self.m_istream.fileno())
+    
+    def getHeaderFields(self):
+        # Reads the headers in the first line of the CSV, which a session
+        # splits only once
+        if self.m_session != None: return list(self.m_session.getHeaderFields())
+        return self.getCSVLine(self.m_istream.readline(), type('str'), ',')
+    
+    def getFormat(self, line):
+        # Gets the format of a file with the headers (see detectFormat()),
+        # which a session detects only once
+        if self.m_session != None: return self.m_session.getFormat()
+        return detectFormat(line)
+    
     # Reads a CSV line and converts all to float or string
     def getCSVLine(self, csvline, datatype, delimiter):
         
@@ -39,6 +100,62 @@ class Parser:
                 raise
                 
         return cleanline
+    
+    # Reads the rest of the CSV in one pass, converting only the columns at
+    # the given indices. Returns a list of the columns, as typed arrays of
+    # the given typecodes or, for typecode None, contiguous numpy arrays of
+    # doubles (lists without numpy; see listColumn()). Returns None if the
+    # rows aren't all numbers with the same number of fields, in which case
+    # the caller can go back and use getCSVLine() on each line.
+    def readColumns(self, columns, delimiter, typecodes=None):
+        if typecodes == None: typecodes = [None] * len(columns)
+        if COLUMN_CACHE != None:
+            cached = COLUMN_CACHE.load(self.m_fname, delimiter, columns, \
+                                       typecodes, self.getStat())
+            if cached != None: return cached
+        
+        text = self.m_istream.read()
+        lines = [l for l in text.splitlines() if l.strip() != ""]
+        if len(lines) < 1: return [storeColumn([], code) for code in typecodes]
+        
+        # Every line must have the same number of fields
+        if delimiter == "tab": widths = set([len(l.split()) for l in lines])
+        else: widths = set([l.count(delimiter) + 1 for l in lines])
+        width = widths.pop()
+        if len(widths) > 0 or max(columns) >= width: return None
+        
+        if HAVE_NUMPY:
+            # Every field is converted by numpy at once, and the columns are
+            # strided slices of the result
+            if delimiter != "tab": text = text.replace(delimiter, " ")
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("error")
+                    values = numpy.fromstring(text, sep=" ")
+            except (ValueError, DeprecationWarning):
+                return None
+            if len(values) != len(lines) * width: return None
+            if COLUMN_CACHE != None:
+                COLUMN_CACHE.save(self.m_fname, delimiter, \
+                    [values[j::width] for j in range(0, width)], self.getStat())
+            return [storeColumn(values[j::width], code) \
+                    for j, code in zip(columns, typecodes)]
+        
+        # The lines are split, and only the wanted columns converted (or
+        # all of them, to be cached)
+        if delimiter == "tab": rows = [l.split() for l in lines]
+        else: rows = [l.split(delimiter) for l in lines]
+        fields = list(zip(*rows))
+        converted = columns
+        if COLUMN_CACHE != None: converted = range(0, width)
+        try:
+            values = dict([(j, [float(x) for x in fields[j]]) for j in converted])
+        except ValueError:
+            return None
+        if COLUMN_CACHE != None:
+            COLUMN_CACHE.save(self.m_fname, delimiter, \
+                [values[j] for j in range(0, width)], self.getStat())
+        return [storeColumn(values[j], code) for j, code in zip(columns, typecodes)]
 
 class HeaderParser(Parser):
     # Used to investigate only the header of a file for loading series
@@ -48,9 +165,8 @@ class HeaderParser(Parser):
         data = []   # Empty list for headers
         
         # Get first line
-        csvline = self.m_istream.readline()
+        line = self.getHeaderFields()
         self.closeCSV()
-        line = self.getCSVLine(csvline, type('str'), ',')
         
         # Check the file format
         if self.__checkForStandardFormat(line):
@@ -68,7 +184,7 @@ class HeaderParser(Parser):
         # Given a list of headers from a csv file, check it is compatible
         
         ans = False
-        if (line[0] == "Step") and re.search("Time", line[1]):
+        if self.getFormat(line) == "trajectory":
             ans = True
         else:
             print("Unrecognised MOPS file format.")
@@ -89,16 +205,36 @@ class TrajectoryParser(Parser):
             self.closeCSV()
             return None
         
+        # Convert indices
+        csvindices = self.convertPassedIndices(indices)
+        
+        # Read the time and the values and errors in one pass if possible
+        wanted = [1]
+        for j in csvindices: wanted.extend([j, j + 1])
+        self.m_istream.readline()
+        columns = self.readColumns(wanted, ",")
+        if columns != None:
+            self.closeCSV()
+            columns = [listColumn(col) for col in columns]
+            if len(columns[0]) < 1:
+                print("No data in file {0}!".format(self.m_fname))
+                return None
+            headers = self.getSpecificHeaders(indices)
+            allseries = []
+            for i in range(0, len(headers)):
+                allseries.append(series.Trajectory(headers[i], columns[0], \
+                    columns[2*i+1], columns[2*i+2]))
+            return allseries
+        
         # Check there is enough information in the CSV file
+        print("Reading file {0} line by line.".format(self.m_fname))
+        self.m_istream.seek(0)
         result = self.checkForEnoughInfo()
         if (not result):
             print("No data in file {0}!".format(self.m_fname))
             self.closeCSV()
             return None
         
-        # Convert indices
-        csvindices = self.convertPassedIndices(indices)
-        
         # Get headers again.
         headers = self.getSpecificHeaders(indices)
 
@@ -158,7 +294,7 @@ class TrajectoryParser(Parser):
         # Given a list of indices, return a list with only
         # the data entries given by those indices
         
-        hparser = HeaderParser(self.m_fname)
+        hparser = HeaderParser(self.getSource())
         allheaders = hparser.getHeaders()
         
         headers = []
@@ -179,7 +315,7 @@ class MiscFileParser(Parser):
         
         # Read in the file.
         try:
-            (headers, data) = self.parse(delimiter)
+            (headers, fixed) = self.parseColumns(delimiter)
         except:
             print("Couldn't parse file")
             return []
@@ -188,8 +324,7 @@ class MiscFileParser(Parser):
         if len(headers) < 1:
             print("Error getting the headers!")
         else:
-            fixed = self.convertData(data)
-            
+
             # Generate series
             results = []
             for i in range(1, len(headers)):
@@ -244,6 +379,31 @@ class MiscFileParser(Parser):
             line = self.getCSVLine(hline, type('str'), delimiter)
         return (hasHeaders, line)
     
+    def parseColumns(self, delimiter):
+        # Parses a misc. DSV file into its headers and columns, in one pass
+        # if possible or else with parse()
+        line = self.m_istream.readline()
+        (hasHeaders, hline) = self.checkForHeaders(line, delimiter)
+        
+        columns = self.readColumns(range(0, len(hline)), delimiter)
+        if columns == None:
+            print("Reading file {0} line by line.".format(self.m_fname))
+            self.m_istream.seek(0)
+            (headers, data) = self.parse(delimiter)
+            if len(headers) < 1: return ([], [])
+            return (headers, self.convertData(data))
+        self.closeCSV()
+        columns = [listColumn(col) for col in columns]
+        
+        if hasHeaders:
+            headers = hline
+        else:
+            # The first line is data too
+            headers = ["import"] * len(hline)
+            columns = [[v] + col for v, col in zip(hline, columns)]
+        if len(columns) < 1 or len(columns[0]) < 1: return ([], [])
+        return (headers, columns)
+    
     def parse(self, delimiter):
         # Parses a misc. DSV file
         
@@ -277,9 +437,8 @@ class PSLHeaderParser(Parser):
         print("Getting headers of file {0}".format(self.m_fname))
         
         # Get first line
-        csvline = self.m_istream.readline()
+        line = self.getHeaderFields()
         self.closeCSV()
-        line = self.getCSVLine(csvline, type('str'), ',')
     
         # Check the file format
         if self.__checkForStandardFormat(line):
@@ -291,13 +450,25 @@ class PSLHeaderParser(Parser):
         # Given a list of headers from a csv file, check it is compatible
         
         ans = False
-        if (re.search("Weight", line[0])):
+        if self.getFormat(line) == "psl":
             ans = True
         else:
             print("Unrecognised MOPS PSL file format.")
             ans = False
         return ans
     
+    def findColumn(self, line, pattern):
+        # Returns the index of the first column whose header is pattern or
+        # matches it as a regular expression (ignoring case), or 0 if none
+        for i in range(1, len(line)):
+            if line[i] == pattern: return i
+        for i in range(1, len(line)):
+            try:
+                if re.search(pattern, line[i], re.IGNORECASE): return i
+            except re.error:
+                return 0
+        return 0
+    
     def scanForDiameters(self, line, consts):
         
         dsph = 0
@@ -318,21 +489,58 @@ class PSLHeaderParser(Parser):
                 [consts.d_mob, dmob], 
                 [consts.d_col, dcol], 
                 [consts.d_pri, dpri])
+    
+    def scanForWeightings(self, line):
+        # Finds the columns of the particle properties which the number
+        # weights can be multiplied by for surface, volume or mass-weighted
+        # PSDs. Returns a list of [name, col id] of those in the file.
+        weightings = []
+        for name, pattern in [["surface", "Surface Area"], \
+                              ["volume", "Volume"], ["mass", "Mass"]]:
+            col = self.findColumn(line, pattern)
+            if col != 0: weightings.append([name, col])
+        return weightings
         
 
 class PSLParser(Parser):
     # Class to parse MOPS psl files
     
-    def start(self, parsedata):
+    # Array typecodes of the columns for each storage type other than lists
+    # (see Ensemble.STORAGE). The weights are always doubles.
+    TYPECODES = {"double": "d", "float": "f"}
+    
+    def start(self, parsedata, storage="list"):
         self.m_parseinfo = parsedata
         
         # Read headers
         headers = self.m_istream.readline()
+        
+        # The weights and the columns are read in one pass if possible
+        wanted = [0] + [info[1] for info in self.m_parseinfo]
+        typecodes = [self.TYPECODES.get(storage) for i in wanted]
+        if storage in self.TYPECODES: typecodes[0] = "d"
+        columns = self.readColumns(wanted, ",", typecodes)
+        if columns != None:
+            self.closeCSV()
+            # The ensembles take lists for list storage
+            columns = [col if code != None else listColumn(col) \
+                       for col, code in zip(columns, typecodes)]
+            return [columns[0]] + [[info[0], info[2], col] for info, col \
+                                   in zip(self.m_parseinfo, columns[1:])]
+        
+        print("Reading file {0} line by line.".format(self.m_fname))
+        self.m_istream.seek(0)
+        headers = self.m_istream.readline()
 
+        # The columns are read into lists, or typed arrays to save memory
         weight = []
+        if storage in self.TYPECODES: weight = array.array("d")
         diameters = []
         for i in range(0, len(self.m_parseinfo)):
-            diameters.append([])
+            if storage in self.TYPECODES:
+                diameters.append(array.array(self.TYPECODES[storage]))
+            else:
+                diameters.append([])
         
         # Read in and store the columns
         for csvline in self.m_istream:
@@ -350,4 +558,239 @@ class PSLParser(Parser):
                     diameters[i]]
             results.append(item)
             
-        return results
\ No newline at end of file
+        return results
+
+
+class FileSession:
+    # A CSV opened (and its status read) once for all the parsers of it,
+    # which are given the session in place of the file name. The headers in
+    # its first line are split, and the format of the file detected, only
+    # once. The parsers leave the file open, so close() must be called when
+    # they are done, or the session used in a with statement.
+    
+    def __init__(self, fname):
+        self.m_fname = fname
+        
+        try:
+            print("Loading file {0}.".format(self.m_fname))
+            self.m_istream = open(self.m_fname, "r")
+        except:
+            print("Couldn't open file {0}.".format(self.m_fname))
+            raise
+        self.m_stat = os.fstat(self.m_istream.fileno())
+        self.m_headers = None
+        self.m_format = None
+    
+    def rewind(self):
+        # Goes back to the start of the file for the next parser
+        self.m_istream.seek(0)
+    
+    def getHeaderFields(self):
+        # Gets the headers in the first line of the CSV
+        if self.m_headers == None:
+            self.rewind()
+            self.m_headers = [str(l.strip()) for l in \
+                              self.m_istream.readline().split(",")]
+        return self.m_headers
+    
+    def getFormat(self):
+        # Gets the format of the file (see detectFormat())
+        if self.m_format == None:
+            self.m_format = detectFormat(self.getHeaderFields())
+        return self.m_format
+    
+    def close(self):
+        if self.m_istream.closed: return
+        print("Closing file {0}.".format(self.m_fname))
+        self.m_istream.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exctype, value, traceback):
+        self.close()
+        return False
+
+class ColumnCache:
+    # Binary sidecar files of the columns parsed from CSVs, kept in one
+    # directory. Each file has a JSON header (the CSV's path, size and
+    # modification time, the delimiter, and the numbers of rows and columns)
+    # followed by each column in turn as native doubles, which are
+    # memory-mapped when loaded. Files whose CSV has changed are removed when
+    # they are found, and the least recently used are removed when the
+    # directory holds more than its capacity in bytes.
+    
+    def __init__(self, directory=None, capacity=None):
+        if directory == None: directory = CACHE_DIR
+        if capacity == None: capacity = CACHE_CAPACITY
+        self.m_directory = directory
+        self.m_capacity = capacity
+    
+    def getCacheName(self, fname, delimiter):
+        # Gets the sidecar file of the CSV read with the delimiter
+        key = "{0}|{1}".format(os.path.abspath(fname), delimiter)
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.m_directory, \
+                            "{0}.{1}.cols".format(os.path.basename(fname), digest))
+    
+    def getStamp(self, fname, delimiter, stat):
+        # Gets what a sidecar file must match to hold the CSV's columns, from
+        # the status of the CSV
+        return {"path": os.path.abspath(fname), "size": stat.st_size, \
+                "mtime": stat.st_mtime, "delimiter": delimiter, \
+                "byteorder": sys.byteorder}
+    
+    def load(self, fname, delimiter, columns, typecodes, stat):
+        # Gets the columns at the indices, as storeColumn() does with the
+        # typecodes, from the CSV's sidecar file, or None if there isn't one
+        # that is up to date with the status of the CSV
+        cname = self.getCacheName(fname, delimiter)
+        if not os.path.exists(cname): return None
+        stamp = self.getStamp(fname, delimiter, stat)
+        results = None
+        try:
+            stream = open(cname, "rb")
+            try:
+                mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                stream.close()
+            try:
+                header = self.readHeader(mapped)
+                if header != None and \
+                        header["stamp"] == stamp:
+                    results = self.readMapped(mapped, header, columns, typecodes)
+            finally:
+                mapped.close()
+        except (EnvironmentError, ValueError, KeyError):
+            header = None
+        
+        if header == None or header["stamp"] != stamp:
+            print("Removing stale cache file {0}.".format(cname))
+            try:
+                os.remove(cname)
+            except EnvironmentError:
+                print("Couldn't remove cache file {0}.".format(cname))
+            return None
+        if results == None: return None
+        
+        # The modification time marks the file as recently used
+        os.utime(cname, None)
+        print("Loaded columns of {0} from cache.".format(fname))
+        return results
+    
+    def readMapped(self, mapped, header, columns, typecodes):
+        # Gets the columns at the indices from a mapped sidecar file with
+        # the header, or None if it has too few columns
+        if max(columns) >= header["columns"]: return None
+        rows = header["rows"]
+        results = []
+        for j, code in zip(columns, typecodes):
+            start = header["offset"] + 8 * j * rows
+            if HAVE_NUMPY:
+                column = numpy.frombuffer(mapped, dtype=numpy.float64, \
+                                          count=rows, offset=start)
+                # Copied, as the file is unmapped once it is loaded
+                if code == None: column = column.copy()
+            else:
+                column = array.array("d", mapped[start:start + 8 * rows])
+            results.append(storeColumn(column, code))
+            del column
+        return results
+    
+    def readHeader(self, mapped):
+        # Gets the header of a mapped sidecar file, with the offset of the
+        # first column, or None if it isn't one
+        if len(mapped) < 12 or mapped[:8] != CACHE_MAGIC: return None
+        length = struct.unpack("<I", mapped[8:12])[0]
+        header = json.loads(mapped[12:12 + length].decode("utf-8"))
+        header["offset"] = alignOffset(12 + length)
+        if len(mapped) < header["offset"] + 8 * header["rows"] * header["columns"]:
+            return None
+        return header
+    
+    def save(self, fname, delimiter, columns, stat):
+        # Writes the columns parsed from the CSV, with its status when it was
+        # opened, to its sidecar file unless they wouldn't fit in the cache
+        rows = len(columns[0])
+        if rows < 1: return
+        header = json.dumps({"stamp": self.getStamp(fname, delimiter, stat), \
+                             "rows": rows, "columns": len(columns)}).encode("utf-8")
+        offset = alignOffset(12 + len(header))
+        size = offset + 8 * rows * len(columns)
+        if size > self.m_capacity: return
+        
+        cname = self.getCacheName(fname, delimiter)
+        try:
+            if not os.path.isdir(self.m_directory): os.makedirs(self.m_directory)
+            # Written to a temporary file, so no partial file is ever read
+            stream = open(cname + ".tmp", "wb")
+            try:
+                stream.write(CACHE_MAGIC + struct.pack("<I", len(header)) + header)
+                stream.write(b"\0" * (offset - 12 - len(header)))
+                for column in columns:
+                    if HAVE_NUMPY:
+                        data = numpy.ascontiguousarray(column, dtype=numpy.float64)
+                    else:
+                        data = array.array("d", column)
+                    if hasattr(data, "tobytes"): stream.write(data.tobytes())
+                    else: stream.write(data.tostring())
+            finally:
+                stream.close()
+            if os.path.exists(cname): os.remove(cname)
+            os.rename(cname + ".tmp", cname)
+            print("Cached columns of {0} in {1}.".format(fname, cname))
+            self.evict(cname)
+        except EnvironmentError:
+            print("Couldn't write cache file {0}.".format(cname))
+    
+    def evict(self, keep=None):
+        # Removes the least recently used sidecar files (except keep) until
+        # the cache is within its capacity
+        files = []
+        for name in os.listdir(self.m_directory):
+            if not name.endswith(".cols"): continue
+            path = os.path.join(self.m_directory, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum([f[1] for f in files])
+        for (mtime, size, path) in files:
+            if total <= self.m_capacity: break
+            if path == keep: continue
+            print("Evicting cache file {0}.".format(path))
+            os.remove(path)
+            total -= size
+
+def detectFormat(line):
+    # Gets the format of a MOPS CSV from the headers in its first line:
+    # "trajectory" (moments and rates), "psl" or "" if it is neither
+    if len(line) > 1 and line[0] == "Step" and re.search("Time", line[1]):
+        return "trajectory"
+    if len(line) > 0 and re.search("Weight", line[0]):
+        return "psl"
+    return ""
+
+def alignOffset(offset):
+    # Rounds a file offset up to a multiple of 8 bytes
+    return (offset + 7) // 8 * 8
+
+def storeColumn(values, typecode=None):
+    # Gets a column of floats (a list, typed array or numpy array) as a
+    # contiguous typed array of the typecode or, for typecode None, as a
+    # contiguous numpy array of doubles (or a list, if it isn't numpy)
+    if HAVE_NUMPY and isinstance(values, numpy.ndarray):
+        if typecode == None:
+            return numpy.ascontiguousarray(values, dtype=numpy.float64)
+        values = numpy.ascontiguousarray(values, dtype=numpy.dtype(typecode))
+        return array.array(typecode, values.tobytes())
+    if typecode == None:
+        if isinstance(values, list): return values
+        return list(values)
+    return array.array(typecode, values)
+
+def listColumn(values):
+    # Gets a column from Parser.readColumns() as a list of floats, for the
+    # callers that need one
+    if isinstance(values, list): return values
+    if HAVE_NUMPY and isinstance(values, numpy.ndarray): return values.tolist()
+    return list(values)
@@ -28,7 +28,7 @@ class Series:
             
             for v, e in zip(yseries, errors):
                 self.m_lower_ci.append(max(v - e, 0.0))
-                self.m_lower_ci.append(v + e)
+                self.m_upper_ci.append(v + e)
     
         # Returns a parameter's name and unit as vector
     def getParameterName(self, string):
@@ -129,6 +129,22 @@ class PSD(Series):
     def setParent(self, parent):
         self.m_parent = parent
     
+    def setBands(self, lower, upper):
+        # Sets the (bootstrap) confidence bands of the PSD
+        self.m_lower_ci = lower
+        self.m_upper_ci = upper
+    
+    def getOutputData(self):
+        # Adds the confidence bands to the output, if there are any
+        if not hasattr(self, "m_lower_ci"):
+            return Series.getOutputData(self)
+        
+        data = [self.m_dheader + ["lowerci", "upperci"]]
+        for x, y, l, u in zip(self.m_xvalues, self.m_yvalues, \
+                              self.m_lower_ci, self.m_upper_ci):
+            data.append([x, y, l, u])
+        return data
+    
     def getPlotPaneList(self):
         item = [self.m_type, self.m_h, self.m_parent]
         return item
\ No newline at end of file
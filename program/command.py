@@ -4,6 +4,7 @@ Source for dealing with the command-line interface of the postprocessor
 (c) William Menz (wjm34) 2012
 """
 
+import re
 import sys
 import datamodel.mops_parser as MParser
 import datamodel.ensemble as Ensemble
@@ -20,37 +21,108 @@ class Command:
 class PSLCommand(Command):
     # Command-line interface for postprocessing PSL files
     
+    def __init__(self, fname, consts, kdeopts=None, bandwidth=-1, \
+                 quantiles=None, meansonly=False, bootstrap=0, processes=None, \
+                 joint=None, weighted=False, columns=None):
+        Command.__init__(self, fname, consts)
+        
+        # Keyword arguments passed on to each KernelDensity (e.g. engine)
+        if kdeopts == None: kdeopts = {}
+        self.m_kdeopts = kdeopts
+        
+        # Bandwidth for all PSDs: -1 (rule of thumb), a selector name from
+        # Ensemble.BANDWIDTHS or a value
+        self.m_bandwidth = bandwidth
+        
+        # Percentiles of the particles written to the XML
+        if quantiles == None: quantiles = [10, 50, 90]
+        self.m_quantiles = quantiles
+        
+        # Only write the means and moments to the XML, so no PSD is needed
+        self.m_meansonly = meansonly
+        
+        # Number of bootstrap replicates for confidence bands (0 for none)
+        # and the number of processes to evaluate them with
+        self.m_bootstrap = bootstrap
+        self.m_processes = processes
+        
+        # Pair of column headers (or patterns) for a joint 2D KDE
+        self.m_joint = joint
+        self.m_jointkde = None
+        
+        # Also find the surface, volume and mass-weighted PSDs
+        self.m_weighted = weighted
+        self.m_weightings = []
+        
+        # PSL columns (headers or patterns) to analyse instead of the
+        # diameters, e.g. "Age (s)" or "Num coags"
+        self.m_columns = columns
+    
     def start(self):
         # Initialise output writing
         self.m_allowOutput = True
         
         
-        # Parse the headers to see what is there!
-        parser = MParser.PSLHeaderParser(self.m_fname)
-        line = parser.getHeaders()
-        if line != None:
-            parseddata = parser.scanForDiameters(line, self.m_consts)
-            self.m_parseddata = []
-            # Hide zero col id entries (i.e. not found in PSL) from the parser
-            for data in parseddata:
-                if data[1] != 0: self.m_parseddata.append(data)
-        else:
-            print(self.m_consts.tcFAIL + \
-                  "Couldn't parse headers" + \
-                  self.m_consts.tcENDC)
-            sys.exit(1)
-        
-        procdata = []
-        for data in self.m_parseddata:
-            if data[1] != 0:
-                print(self.m_consts.tcOKGREEN + \
-                      "Found diameter type "+self.m_consts.matchDiam(data[0]) + \
+        # The file is opened once for the header and the PSL parsers
+        with MParser.FileSession(self.m_fname) as session:
+            # Parse the headers to see what is there!
+            parser = MParser.PSLHeaderParser(session)
+            line = parser.getHeaders()
+            if line != None:
+                if self.m_columns == None:
+                    parseddata = parser.scanForDiameters(line, self.m_consts)
+                else:
+                    parseddata = self.scanForColumns(parser, line)
+                self.m_parseddata = []
+                # Hide zero col id entries (i.e. not found in PSL) from the parser
+                for data in parseddata:
+                    if data[1] != 0: self.m_parseddata.append(data)
+            else:
+                print(self.m_consts.tcFAIL + \
+                      "Couldn't parse headers" + \
                       self.m_consts.tcENDC)
-                # Append -1 to indicate automatic calculation of bandwidth
-                procdata.append(data + [-1])
-        
-        parser = MParser.PSLParser(self.m_fname)
-        parsed = parser.start(procdata)
+                sys.exit(1)
+            
+            procdata = []
+            for data in self.m_parseddata:
+                if data[1] != 0:
+                    if self.m_columns == None:
+                        print(self.m_consts.tcOKGREEN + \
+                              "Found diameter type "+self.m_consts.matchDiam(data[0]) + \
+                              self.m_consts.tcENDC)
+                    else:
+                        print(self.m_consts.tcOKGREEN + \
+                              "Found column "+self.m_consts.matchDiam(data[0]) + \
+                              self.m_consts.tcENDC)
+                    # Append the bandwidth (-1 indicates automatic calculation)
+                    procdata.append(data + [self.m_bandwidth])
+            
+            # The joint KDE columns are read in the same pass, after the diameters
+            jointcols = []
+            if self.m_joint != None:
+                for pattern in self.m_joint:
+                    col = parser.findColumn(line, pattern)
+                    if col == 0:
+                        print(self.m_consts.tcWARNING + \
+                              "Couldn't find column {0} for the joint PSD.".format(pattern) + \
+                              self.m_consts.tcENDC)
+                        jointcols = []
+                        break
+                    jointcols.append([line[col], col, -1])
+            
+            # The property columns for the weighted PSDs are read in the same pass
+            momentcols = []
+            if self.m_weighted:
+                for name, col in parser.scanForWeightings(line):
+                    momentcols.append([name, col, -1])
+                if len(momentcols) == 0:
+                    print(self.m_consts.tcWARNING + \
+                          "Couldn't find any columns for the weighted PSDs." + \
+                          self.m_consts.tcENDC)
+            
+            parser = MParser.PSLParser(session)
+            parsed = parser.start(procdata + momentcols + jointcols, \
+                                  self.m_kdeopts.get("storage", "list"))
         
         if len(parsed) < 1:
             print(self.m_consts.tcFAIL + \
@@ -58,18 +130,62 @@ class PSLCommand(Command):
                   self.m_consts.tcENDC)
             sys.exit(1)
         
+        if len(jointcols) > 0:
+            self.m_jointkde = Ensemble.JointKernelDensity(parsed[-2][2], \
+                parsed[-1][2], parsed[0], \
+                kernel=self.m_kdeopts.get("kernel", "Gaussian"), \
+                logspace=(self.m_kdeopts.get("logspace", False),)*2)
+            self.m_jointnames = [sets[0] for sets in parsed[-2:]]
+            parsed = parsed[:-2]
+        
+        # Number weights times each property, shared by all diameter types
+        weightsets = {}
+        for sets in parsed[1+len(procdata):]:
+            weightsets[sets[0]] = [w * x for w, x in zip(parsed[0], sets[2])]
+        self.m_weightings = sorted(weightsets.keys())
+        parsed = parsed[:1+len(procdata)]
+        
         self.m_ensembles = []
+        # Other columns may be far from zero (e.g. ages), so their bounds
+        # follow the range of the values
+        kdeopts = dict(self.m_kdeopts)
+        if self.m_columns != None: kdeopts.setdefault("bounds", "range")
+        
         for sets in parsed[1:]:
-            ens = Ensemble.KernelDensity(sets[2], parsed[0], sets[1])
+            ens = Ensemble.KernelDensity(sets[2], parsed[0], sets[1], \
+                                         weightsets=weightsets, **kdeopts)
+            # The PSD and its statistics are computed when first written
             if len(ens.diameters) > 0:
-                ens.calculateCumulativePSD()
-                ens.calculatePSDStats()
+                print("Ensemble {0} holds {1} particles as {2} values in {3:.1f} kB ({4} storage).".format(\
+                    self.m_consts.matchDiam(sets[0]), ens.num_particles, \
+                    len(ens.diameters), ens.memoryFootprint() / 1024.0, \
+                    ens.storage))
+                if self.m_bootstrap > 0:
+                    ens.calculateBootstrap(self.m_bootstrap, \
+                                           processes=self.m_processes)
                 self.m_ensembles.append(ens)
         
         if len(self.m_ensembles) < 1:
             # Block output if there were no ensembles added.
             self.m_allowOutput = False
         
+    def scanForColumns(self, parser, line):
+        # Finds the requested columns in the headers, in the form of
+        # scanForDiameters() with the header in place of the diameter type.
+        # Each column is only analysed once.
+        parseddata = []
+        cols = []
+        for pattern in self.m_columns:
+            col = parser.findColumn(line, pattern)
+            if col == 0:
+                print(self.m_consts.tcWARNING + \
+                      "Couldn't find column {0}.".format(pattern) + \
+                      self.m_consts.tcENDC)
+            elif col not in cols:
+                cols.append(col)
+                parseddata.append([line[col], col])
+        return parseddata
+    
     def writeXML(self, oname):
         # Write the ensembles to XML!
         parser = Out.XMLOut(oname)
@@ -90,21 +206,62 @@ class PSLCommand(Command):
         
         # Write the ensembles
         for data, ens in zip(self.m_parseddata, self.m_ensembles):
-            parser.write1("psl", [["type", self.m_consts.matchDiam(data[0])]], 1)
+            parser.write1("psl", [["type", self.m_consts.matchDiam(data[0])], \
+                                  ["particles", ens.num_particles], \
+                                  ["unique", len(ens.diameters)]], 1)
             
             parser.write2("amean", ens.damean, 2)
             parser.write2("gmean", ens.dgmean, 2)
             parser.write2("astdev", ens.astdev, 2)
             parser.write2("gstdev", ens.gstdev, 2)
+            parser.write2("d32", ens.d32, 2)
+            parser.write2("d43", ens.d43, 2)
+            parser.write2("skewness", ens.skewness, 2)
+            parser.write2("kurtosis", ens.kurtosis, 2)
+            parser.write2("ndensity", ens.number_density, 2)
+            
+            # Moments of the diameters weighted by surface, volume or mass
+            moments = ens.calculateWeightedMoments()
+            for name in sorted(moments.keys()):
+                parser.write1("moments", [["weighting", name]], 2)
+                parser.write2("amean", moments[name].mean, 3)
+                parser.write2("astdev", moments[name].stdev(), 3)
+                parser.write2("skewness", moments[name].skewness(), 3)
+                parser.write2("kurtosis", moments[name].kurtosis(), 3)
+                parser.write1("/moments", [], 2)
+            
+            # Exact weighted quantiles of the particles, without smoothing
+            parser.write1("quantiles", [["source", "particles"]], 2)
+            values = ens.getParticleQuantiles([0.01*q for q in self.m_quantiles])
+            for q, value in zip(self.m_quantiles, values):
+                parser.write2("d{0:g}".format(q), value, 3)
+            parser.write1("/quantiles", [], 2)
+            
+            if self.m_meansonly:
+                parser.write1("/psl", [], 1)
+                continue
             
             # Write PSD diagnostics
-            parser.write1("psd", [["points", ens.num_points], ["bandwidth", ens.smoothing], ["area", ens.psd_area]], 2)
+            attrs = [["points", len(ens.mesh)], ["bandwidth", ens.smoothing], \
+                     ["kernel", ens.getEstimator()], ["space", ens.getSpace()], \
+                     ["area", ens.psd_area]]
+            if ens.variable: attrs.append(["variable", "abramson"])
+            parser.write1("psd", attrs, 2)
             
             parser.write2("d10", ens.d10, 3)
             parser.write2("d50", ens.d50, 3)
             parser.write2("d90", ens.d90, 3)
             parser.write2("dmode", ens.dmode, 3)
             
+            if ens.isComputed("psd_bands"):
+                bands = ens.psd_bands
+                parser.write1("bootstrap", [["replicates", bands["replicates"]], \
+                                            ["level", bands["level"]]], 3)
+                for name in ["d10", "d50", "d90", "dmode"]:
+                    parser.write1(name, [["lower", bands[name][0]], \
+                                         ["upper", bands[name][1]]], 4, "/")
+                parser.write1("/bootstrap", [], 3)
+            
             parser.write1("/psd", [], 2)
             
             parser.write1("/psl", [], 1)
@@ -120,9 +277,85 @@ class PSLCommand(Command):
         # One file per PSD.
         
         for data, ens in zip(self.m_parseddata, self.m_ensembles):
-            fname = self.fileName(oname, self.m_consts.matchDiam(data[0]))
+            fname = self.fileName(oname, self.fileTag(data))
             self.writePSD(fname, ens, delimiter)
     
+    def writeSweeps(self, oname, bandwidths, delimiter=","):
+        # Writes the PSDs for a list of bandwidths, one file per diameter
+        # type with one density column per bandwidth. The bandwidths are in
+        # the space of the KDE, so the headers say whether they are widths
+        # in d or in ln(d).
+        
+        for data, ens in zip(self.m_parseddata, self.m_ensembles):
+            fname = self.fileName(oname, self.fileTag(data) + ".sweep")
+            psds = ens.calculateBandwidthSweep(bandwidths)
+            space = "ln(d)" if ens.logspace else "d"
+            
+            parser = Out.DSVOut(fname)
+            parser.head(["diameter"] + ["h={0} in {1}".format(h, space) \
+                                        for h in bandwidths], delimiter)
+            for i in range(0, len(ens.mesh)):
+                parser.write([ens.mesh[i]] + [psd[i] for psd in psds], \
+                             delimiter, None)
+            parser.close()
+    
+    def writeJoint(self, oname, delimiter=","):
+        # Writes the joint PSD as a DSV file with one row per mesh point
+        if self.m_jointkde == None:
+            print(self.m_consts.tcWARNING + "No joint PSD to write." + \
+                  self.m_consts.tcENDC)
+            return
+        
+        kde = self.m_jointkde
+        parser = Out.DSVOut(self.fileName(oname, "joint"))
+        parser.head(self.m_jointnames + ["density"], delimiter)
+        for x, row in zip(kde.xmesh, kde.density):
+            for y, f in zip(kde.ymesh, row):
+                parser.write([x, y, f], delimiter, None)
+        parser.close()
+        return parser
+    
+    def writeBenchmark(self, oname, delimiter=","):
+        # Writes the runtime and error of each engine for the PSDs of this
+        # file and of synthetic lognormal ensembles, as measured by
+        # Ensemble.benchmarkEngines(), and prints the fitted ENGINE_COSTS
+        opts = {}
+        for key in ["kernel", "logspace", "points", "accuracy", "cutoff"]:
+            if key in self.m_kdeopts: opts[key] = self.m_kdeopts[key]
+        
+        sets = []
+        for data, ens in zip(self.m_parseddata, self.m_ensembles):
+            sets.append([self.m_consts.matchDiam(data[0]), ens.diameters, \
+                         ens.weights, opts.get("points", 64)])
+        for count in [1000, 10000, 100000]:
+            (diameters, weights) = Ensemble.syntheticParticles(count)
+            for points in [64, 256]:
+                sets.append(["lognormal", diameters, weights, points])
+        
+        parser = Out.DSVOut(oname)
+        parser.head(["set", "engine", "particles", "points", "bandwidth", \
+                     "work", "seconds", "bound", "error"], delimiter)
+        rows = []
+        for name, diameters, weights, points in sets:
+            print("Benchmarking engines for {0} ({1} particles, {2} points).".format(\
+                name, len(diameters), points))
+            opts["points"] = points
+            for row in Ensemble.benchmarkEngines(diameters, weights, **opts):
+                parser.write([name] + row, delimiter, None)
+                rows.append(row)
+        parser.close()
+        
+        costs = Ensemble.fitEngineCosts(rows)
+        for engine in sorted(costs.keys()):
+            print("{0}: {1:.3g} s per call, {2:.3g} s per unit of work".format(\
+                engine, costs[engine][0], costs[engine][1]))
+        return parser
+    
+    def fileTag(self, data):
+        # Gets the name of an ensemble for its file names, where column
+        # headers are reduced to word characters (e.g. "Age (s)" gives "Age_s")
+        return re.sub(r"\W+", "_", self.m_consts.matchDiam(data[0])).strip("_")
+    
     def fileName(self, oname, ftype):
         # Generates a filename of the form oname.ftype.ext
         splitted = oname.split(".")
@@ -145,11 +378,23 @@ class PSLCommand(Command):
         
         parser = Out.DSVOut(oname)
         
-        parser.head(["diameter", "density", "cumulative"], delimiter)
-        
-        for d, r, c in zip(ensemble.mesh, ensemble.psd, \
-                           ensemble.cumulative_psd):
-            parser.write([d, r, c], delimiter, None)
+        headers = ["diameter", "density", "cumulative"]
+        columns = [ensemble.mesh, ensemble.psd, ensemble.cumulative_psd]
+        if ensemble.isComputed("psd_bands"):
+            # Add the bootstrap confidence bands of the density
+            headers += ["lower", "upper"]
+            columns += [ensemble.psd_bands["lower"], \
+                        ensemble.psd_bands["upper"]]
+        if len(ensemble.weightsets) > 0:
+            # Add the surface, volume or mass-weighted densities
+            weighted = ensemble.weighted_psds
+            for name in sorted(weighted.keys()):
+                headers.append(name)
+                columns.append(weighted[name])
+        
+        parser.head(headers, delimiter)
+        for row in zip(*columns):
+            parser.write(list(row), delimiter, None)
         
         parser.close()
         return parser
@@ -160,18 +405,20 @@ class TrajectoryCommand(Command):
     m_rtol  = 1.0e-6    # relative tolerance for getting time
  
     def start(self):
-        # Parse the headers to see what is there!
-        parser = MParser.HeaderParser(self.m_fname)
-        self.m_headers = parser.getHeaders()
-        
-        if self.m_headers == None:
-            print(self.m_consts.tcFAIL + \
-                  "Couldn't parse headers" + \
-                  self.m_consts.tcENDC)
-            sys.exit(1)
-        
-        parser = MParser.TrajectoryParser(self.m_fname)
-        self.m_allseries = parser.start(range(0, len(self.m_headers)))
+        # The file is opened once for the header and trajectory parsers
+        with MParser.FileSession(self.m_fname) as session:
+            # Parse the headers to see what is there!
+            parser = MParser.HeaderParser(session)
+            self.m_headers = parser.getHeaders()
+            
+            if self.m_headers == None:
+                print(self.m_consts.tcFAIL + \
+                      "Couldn't parse headers" + \
+                      self.m_consts.tcENDC)
+                sys.exit(1)
+            
+            parser = MParser.TrajectoryParser(session)
+            self.m_allseries = parser.start(range(0, len(self.m_headers)))
     
     def splitHeader(self, entry):
         # Splits Header (unit) into [Header, unit]
@@ -5,6 +5,7 @@ Dialog boxes used to communicate information in the GUI.
 """
 
 import os
+import sys
 
 try:
     import pygtk
@@ -14,6 +15,17 @@ except:
     print("Couldn't find pygtk or gtk.")
     sys.exit(1)
 
+# Import key matplotlib objects, for the joint PSD window
+try:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_gtkagg \
+        import FigureCanvasGTKAgg as FigureCanvas
+    from matplotlib.backends.backend_gtkagg \
+        import NavigationToolbar2GTKAgg as NavToolbar
+except:
+    print("Couldn't find matplotlib dependencies.")
+    sys.exit(2)
+
 # Other libraries
 try:
     import datamodel.mops_parser as MParser
@@ -36,6 +48,9 @@ class LoadCSVDialog:
         self.m_types = consts
         self.m_results = []     # To be returned by the destroy()
         
+        # The file stays open for the trajectory parser, which closes it
+        self.m_session = MParser.FileSession(self.m_fname)
+        
         # Initialise a new window
         self.m_window = gtk.Window()
         self.m_window.connect("destroy", self.destroy)
@@ -77,10 +92,11 @@ class LoadCSVDialog:
     
     def makeTreeView(self):
         # Makes the list view showing all series in the file
-        headerparser = MParser.HeaderParser(self.m_fname)
+        headerparser = MParser.HeaderParser(self.m_session)
         data = headerparser.getHeaders()
         if (data == None):
             print("No data found in file.")
+            self.m_session.close()
             self.destroy(None, None)
         else:
             
@@ -242,6 +258,7 @@ class LoadPSLDialog:
     # Class for loading MOPS PSL files.
     
     def destroy(self, widget, data=None):
+        self.m_session.close()
         self.m_window.destroy()
     
     def __init__(self, fname, psdpane, consts):
@@ -250,6 +267,9 @@ class LoadPSLDialog:
         self.m_results = []     # To be returned by the destroy()
         self.m_consts  = consts # Reference to contants
         
+        # The file stays open for the PSL parsers until the window closes
+        self.m_session = MParser.FileSession(self.m_fname)
+        
         # Initialise a new window
         self.m_window = gtk.Window()
         self.m_window.connect("destroy", self.destroy, )
@@ -271,6 +291,12 @@ class LoadPSLDialog:
                                     padding = self.m_consts.m_pad)
         
         self.generateDiamEntries()
+        self.m_vbox.pack_start(self.makeColumnEntry(), expand=False, \
+                               padding=self.m_consts.m_pad)
+        self.m_vbox.pack_start(self.makeEngineEntry(), expand=False, \
+                               padding=self.m_consts.m_pad)
+        self.m_vbox.pack_start(self.makeJointEntry(), expand=False, \
+                               padding=self.m_consts.m_pad)
         
         self.m_loadSelected = gtk.Button("Load selected")
         self.m_loadSelected.connect("clicked", self.loadSelected, None)
@@ -293,6 +319,15 @@ class LoadPSLDialog:
                 results.append(active)
             i += 1
         
+        # Other columns are given by header or pattern
+        for pattern in self.m_columns.get_text().split(","):
+            if pattern.strip() == "": continue
+            col = self.m_headparser.findColumn(self.m_headers, pattern.strip())
+            if col == 0:
+                print("Couldn't find column {0}.".format(pattern.strip()))
+            elif col not in [active[1] for active in results]:
+                results.append([self.m_headers[col], col, -1])
+        
         # Data passed to the PSL parser has the form:
         # [[Const id, Column id, bandwidth], ..]
         # Note -1 bandwidth gives automatic calculation.
@@ -300,27 +335,76 @@ class LoadPSLDialog:
         if len(results) < 1: 
             print("Nothing selected!")
         else:
+            # The property columns for the weighted PSDs are read too
+            extras = []
+            if self.m_weighted.get_active():
+                extras = [[name, col, -1] for name, col in self.m_weightcols]
+            
             # Now need to parser the file and get the relevant series
-            parser = MParser.PSLParser(self.m_fname)
-            parsed = parser.start(results)
+            parser = MParser.PSLParser(self.m_session)
+            parsed = parser.start(results + extras)
             
             if len(parsed) < 1:
                 print("Failure trying to get parsed data.")
                 self.destroy(None, None)
+            
+            weightsets = {}
+            for sets in parsed[1+len(results):]:
+                weightsets[sets[0]] = [w * x for w, x in zip(parsed[0], sets[2])]
+            parsed = parsed[:1+len(results)]
              
             # Call the ensemble object to create ensembles
             allseries = []
             for sets in parsed[1:]:
-                ens = Ensemble.KernelDensity(sets[2], parsed[0], sets[1])
+                # A list of bandwidths gives one PSD for each, evaluated
+                # together on the mesh of the first.
+                sweep = None
+                h = sets[1]
+                if isinstance(h, list):
+                    sweep = h
+                    h = sweep[0]
+                opts = self.getKDEOptions()
+                if isinstance(sets[0], str): opts["bounds"] = "range"
+                ens = Ensemble.KernelDensity(sets[2], parsed[0], h, \
+                                             weightsets=weightsets, **opts)
                 
                 if len(ens.diameters) > 0:
                     
-                    series = Series.PSD(self.m_consts.matchDiam(sets[0]), ens.mesh,\
-                                            ens.psd)
-                    series.setH(ens.smoothing)
-                    series.setParent(self.m_fname)
-                    series.setType(sets[0], self.m_consts)
-                    allseries.append(series)
+                    bands = None
+                    if sweep == None:
+                        psds = [(ens.smoothing, ens.psd)]
+                        if self.getBootstrap() > 0:
+                            # One process, as a pool started from the GTK main
+                            # loop would copy the whole GUI into each worker
+                            ens.calculateBootstrap(self.getBootstrap(), \
+                                                   processes=1)
+                            if ens.isComputed("psd_bands"): bands = ens.psd_bands
+                    else:
+                        psds = zip(sweep, ens.calculateBandwidthSweep(sweep))
+                    
+                    for h, psd in psds:
+                        series = Series.PSD(self.m_consts.matchDiam(sets[0]), \
+                                            ens.mesh, psd)
+                        series.setH(h)
+                        if bands != None:
+                            series.setBands(bands["lower"], bands["upper"])
+                        series.setParent(self.m_fname)
+                        series.setType(sets[0], self.m_consts)
+                        if ens.logspace: series.m_type += " (log)"
+                        allseries.append(series)
+                    
+                    # One series for each of the other weightings
+                    weighted = {}
+                    if len(weightsets) > 0: weighted = ens.weighted_psds
+                    for name in sorted(weighted.keys()):
+                        series = Series.PSD(self.m_consts.matchDiam(sets[0]), \
+                                            ens.mesh, weighted[name])
+                        series.setH(ens.smoothing)
+                        series.setParent(self.m_fname)
+                        series.setType(sets[0], self.m_consts)
+                        series.m_type += " ({0})".format(name)
+                        if ens.logspace: series.m_type += " (log)"
+                        allseries.append(series)
             
             # Now send the series to the plotpane!
             if len(allseries) > 0:
@@ -334,10 +418,15 @@ class LoadPSLDialog:
         # Calls the parser to see which diameter types are present
         # adds their entry to the load pane
         
-        parser = MParser.PSLHeaderParser(self.m_fname)
+        parser = MParser.PSLHeaderParser(self.m_session)
         line = parser.getHeaders()
+        self.m_headparser = parser
+        self.m_headers = []
+        self.m_weightcols = []
         if line != None:
             self.m_cols = parser.scanForDiameters(line, self.m_consts)
+            self.m_weightcols = parser.scanForWeightings(line)
+            self.m_headers = line
         
         self.m_dHEntry = []
         self.m_dCheck  = []
@@ -360,11 +449,14 @@ class LoadPSLDialog:
         hbox.pack_start(label)
         
         label = gtk.Label("h:")
-        entry = gtk.Entry(6)
+        combo = gtk.combo_box_entry_new_text()
+        for method in Ensemble.BANDWIDTHS:
+            combo.append_text(method)
+        entry = combo.child
         entry.set_text("auto")
         entry.set_width_chars(6)
         hbox.pack_start(label, expand=False)
-        hbox.pack_start(entry, expand=False, padding=5)
+        hbox.pack_start(combo, expand=False, padding=5)
         
         label = gtk.Label("load?")
         check = gtk.CheckButton()
@@ -381,12 +473,180 @@ class LoadPSLDialog:
         
         return hbox
     
+    def makeColumnEntry(self):
+        # Creates an entry for other PSL columns to load, e.g. "Age (s)"
+        hbox = gtk.HBox(homogeneous=False)
+        label = gtk.Label("Other columns:")
+        hbox.pack_start(label, expand=False)
+        
+        self.m_columns = gtk.Entry()
+        self.m_columns.set_text("")
+        self.m_columns.set_tooltip_text("Comma-separated headers or patterns, e.g. Age,Num coags")
+        hbox.pack_start(self.m_columns, padding=5)
+        
+        return hbox
+    
+    def makeEngineEntry(self):
+        # Creates combo boxes to choose the kernel and its evaluation engine
+        hbox = gtk.HBox(homogeneous=False)
+        label = gtk.Label("Kernel:")
+        hbox.pack_start(label)
+        
+        self.m_kernel = gtk.combo_box_new_text()
+        names = sorted(Ensemble.KERNELS.keys())
+        for name in names:
+            self.m_kernel.append_text(name)
+        self.m_kernel.set_active(names.index("Gaussian"))
+        hbox.pack_start(self.m_kernel, expand=False, padding=5)
+        
+        label = gtk.Label("engine:")
+        hbox.pack_start(label, expand=False)
+        
+        self.m_engine = gtk.combo_box_new_text()
+        for engine in Ensemble.ENGINES:
+            self.m_engine.append_text(engine)
+        self.m_engine.set_active(0)
+        hbox.pack_start(self.m_engine, expand=False)
+        
+        label = gtk.Label("bins:")
+        hbox.pack_start(label, expand=False, padding=5)
+        
+        self.m_bins = gtk.combo_box_new_text()
+        for bins in ["KDE"] + Ensemble.BINS:
+            self.m_bins.append_text(bins)
+        self.m_bins.set_active(0)
+        self.m_bins.set_tooltip_text("Weighted histogram bin rule instead of the KDE")
+        hbox.pack_start(self.m_bins, expand=False)
+        
+        label = gtk.Label("mesh:")
+        hbox.pack_start(label, expand=False, padding=5)
+        
+        self.m_mesh = gtk.combo_box_new_text()
+        for mesh in ["uniform", "adaptive"]:
+            self.m_mesh.append_text(mesh)
+        self.m_mesh.set_active(0)
+        hbox.pack_start(self.m_mesh, expand=False)
+        
+        label = gtk.Label("log(d)?")
+        self.m_logspace = gtk.CheckButton()
+        self.m_logspace.set_active(False)
+        self.m_logspace.set_tooltip_text("Estimate the PSD from ln(d) on a geometric mesh")
+        hbox.pack_start(label, expand=False, padding=5)
+        hbox.pack_start(self.m_logspace, expand=False)
+        
+        label = gtk.Label("variable h?")
+        self.m_variable = gtk.CheckButton()
+        self.m_variable.set_active(False)
+        self.m_variable.set_tooltip_text("Abramson variable bandwidths from a pilot estimate")
+        hbox.pack_start(label, expand=False, padding=5)
+        hbox.pack_start(self.m_variable, expand=False)
+        
+        label = gtk.Label("collapse?")
+        self.m_collapse = gtk.CheckButton()
+        self.m_collapse.set_active(False)
+        self.m_collapse.set_tooltip_text("Merge particles with equal diameters before the KDE")
+        hbox.pack_start(label, expand=False, padding=5)
+        hbox.pack_start(self.m_collapse, expand=False)
+        
+        label = gtk.Label("bootstrap:")
+        self.m_bootstrap = gtk.Entry()
+        self.m_bootstrap.set_width_chars(4)
+        self.m_bootstrap.set_text("0")
+        self.m_bootstrap.set_tooltip_text("Number of bootstrap replicates for confidence bands")
+        hbox.pack_start(label, expand=False, padding=5)
+        hbox.pack_start(self.m_bootstrap, expand=False)
+        
+        label = gtk.Label("weighted?")
+        self.m_weighted = gtk.CheckButton()
+        self.m_weighted.set_active(False)
+        self.m_weighted.set_tooltip_text("Also load the surface, volume and mass-weighted PSDs")
+        self.m_weighted.set_sensitive(len(self.m_weightcols) > 0)
+        hbox.pack_start(label, expand=False, padding=5)
+        hbox.pack_start(self.m_weighted, expand=False)
+        
+        return hbox
+    
+    def makeJointEntry(self):
+        # Creates combo boxes to choose two columns for a joint PSD
+        hbox = gtk.HBox(homogeneous=False)
+        label = gtk.Label("Joint PSD of")
+        hbox.pack_start(label, expand=False)
+        
+        self.m_joint = []
+        for text in ["and", None]:
+            combo = gtk.combo_box_new_text()
+            for header in self.m_headers[1:]:
+                combo.append_text(header)
+            hbox.pack_start(combo, expand=False, padding=5)
+            if text != None: hbox.pack_start(gtk.Label(text), expand=False)
+            self.m_joint.append(combo)
+        
+        button = gtk.Button("Plot joint")
+        button.set_tooltip_text("Plot the joint PSD of the two columns")
+        button.connect("clicked", self.plotJoint, None)
+        hbox.pack_start(button, expand=False)
+        
+        return hbox
+    
+    def plotJoint(self, widget, data=None):
+        # Estimates the joint PSD of the chosen columns and plots it in a
+        # new window
+        cols = [combo.get_active() + 1 for combo in self.m_joint]
+        if min(cols) < 1:
+            print("Choose two columns for the joint PSD.")
+            return
+        
+        names = [self.m_headers[col] for col in cols]
+        parser = MParser.PSLParser(self.m_session)
+        parsed = parser.start([[name, col, -1] for name, col in zip(names, cols)])
+        if len(parsed) < 3 or len(parsed[0]) < 1:
+            print("Failure trying to get parsed data.")
+            return
+        
+        opts = self.getKDEOptions()
+        kde = Ensemble.JointKernelDensity(parsed[1][2], parsed[2][2], parsed[0], \
+                                          kernel=opts.get("kernel", "Gaussian"), \
+                                          logspace=(opts["logspace"],)*2)
+        JointPSDWindow(kde, names, self.m_fname)
+    
+    def getKDEOptions(self):
+        # Gets the keyword arguments for the KernelDensity objects
+        opts = {}
+        kernel = self.m_kernel.get_active_text()
+        if kernel != None: opts["kernel"] = kernel
+        engine = self.m_engine.get_active_text()
+        if engine != None: opts["engine"] = engine
+        opts["logspace"] = self.m_logspace.get_active()
+        opts["variable"] = self.m_variable.get_active()
+        if self.m_collapse.get_active(): opts["collapse"] = 0.0
+        mesh = self.m_mesh.get_active_text()
+        if mesh != None: opts["mesh"] = mesh
+        bins = self.m_bins.get_active_text()
+        if bins in Ensemble.BINS: opts["bins"] = bins
+        return opts
+    
+    def getBootstrap(self):
+        # Gets the number of bootstrap replicates (0 for none)
+        try:
+            return max(0, int(self.m_bootstrap.get_text()))
+        except:
+            return 0
+    
     def getH(self, widget, data=None):
         # Gets the scaling factor from a widget
         h = -1
         text = widget.get_text()
         if (text == "auto" or text == "*" or \
             text == "def"): h = -1
+        elif text in Ensemble.BANDWIDTHS:
+            # Data-driven selector, e.g. "sj" or "lscv"
+            h = text
+        elif "," in text:
+            # Comma-separated list of bandwidths to sweep over
+            try:
+                h = [float(t) for t in text.split(",")]
+            except:
+                h = -1
         else:
             try:
                 h = float(text)
@@ -394,6 +654,41 @@ class LoadPSLDialog:
                 h = -1
         return h
 
+class JointPSDWindow:
+    """
+    Window with a contour plot of a joint PSD
+    """
+    
+    def destroy(self, widget, data=None):
+        self.m_window.destroy()
+    
+    def __init__(self, kde, names, fname):
+        self.m_window = gtk.Window()
+        self.m_window.connect("destroy", self.destroy, )
+        self.m_window.set_default_size(500,450)
+        self.m_window.set_title("Joint PSD of {0}".format(fname))
+        
+        figure = Figure()
+        canvas = FigureCanvas(figure)
+        axes = figure.add_subplot(111)
+        figure.subplots_adjust(bottom=0.15)
+        figure.subplots_adjust(left=0.15)
+        
+        # density[i][j] is at (xmesh[i], ymesh[j]), so transpose for contourf
+        density = [list(col) for col in zip(*kde.density)]
+        contours = axes.contourf(kde.xmesh, kde.ymesh, density, 20)
+        figure.colorbar(contours, ax=axes)
+        axes.set_xlabel(names[0])
+        axes.set_ylabel(names[1])
+        if kde.logspace[0]: axes.set_xscale("log")
+        if kde.logspace[1]: axes.set_yscale("log")
+        
+        vbox = gtk.VBox(homogeneous=False)
+        vbox.pack_start(NavToolbar(canvas, self.m_window), expand=False)
+        vbox.pack_start(canvas)
+        self.m_window.add(vbox)
+        self.m_window.show_all()
+
 class GetStatsDialog:
     """
     Dialog box giving the XML output of a given input file, just
@@ -299,12 +299,13 @@ class ControlPane:
         
         # Parse the file 
         if len(results) > 0:
-            parser = MParser.TrajectoryParser(self.m_dialog.m_fname)
+            parser = MParser.TrajectoryParser(self.m_dialog.m_session)
             allseries = parser.start(results)
             
             # Now pass the series list over to the PlotPane
             self.m_app.m_trj_pane.addSeries(allseries)
         
+        self.m_dialog.m_session.close()
         del self.m_dialog
 
     
@@ -323,6 +324,7 @@ class PlotPane:
     # on the list of series in the plot container.
     
     m_sType = 0 # Type indicating whether it takes trajectories or series
+    m_shadeCIs = False # Whether series confidence bands are shaded
     
     def __init__(self, window, name, consts, xlabel):
         # Must pass pointer to the main window reference, to allow MPL toolbar
@@ -502,6 +504,14 @@ class PlotPane:
         # Displays the selected series in the MPL figure
         line = self.m_axes.plot(series.m_xvalues, series.m_yvalues, \
                          self.m_styles.getNextStyle(), label=series.m_name)
+        
+        # Shade the confidence bands, if the pane shows them and the series
+        # has them
+        if self.m_shadeCIs and hasattr(series, "m_lower_ci") \
+            and len(series.m_lower_ci) > 0:
+            self.m_axes.fill_between(series.m_xvalues, series.m_lower_ci, \
+                                     series.m_upper_ci, alpha=0.25, \
+                                     color=line[0].get_color())
         #line[0].set_picker(True)
         self.m_axes.set_autoscale_on(True)
         self.m_axes.legend(loc=0, prop={'size':10})
@@ -676,6 +686,7 @@ class TrajectoryPane(PlotPane):
 class PSDPane(PlotPane):
     
     m_sType = 2
+    m_shadeCIs = True
     
     def createPlotList(self):
         # Create the liststore
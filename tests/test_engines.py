@@ -0,0 +1,188 @@
+"""
+test_engines.py
+Tests of the kernel registry, of the KernelDensity engines against the
+direct sums of kernel() and of the engine planner, run from the top directory
+with: python -m unittest discover tests
+"""
+
+import math
+import random
+import unittest
+import datamodel.ensemble as Ensemble
+
+def particles(count, sigma=0.5, seed=1):
+    # Lognormal diameters with random weights
+    rng = random.Random(seed)
+    diameters = [rng.lognormvariate(3.0, sigma) for i in range(count)]
+    weights = [rng.uniform(0.5, 2.0) for d in diameters]
+    return (diameters, weights)
+
+def directPSD(ens):
+    # The PSD of ens on its mesh from the direct engine
+    engine = ens.engine
+    ens.engine = "direct"
+    (values, points) = ens.getKDECoordinates(ens.diameters)
+    psd = ens.applyJacobian(ens.evaluatePSD(values, ens.weights, points, \
+                                            ens.smoothing))
+    ens.engine = engine
+    return psd
+
+class KernelTest(unittest.TestCase):
+    
+    def testKernelsAreDensities(self):
+        # Each registered kernel integrates to one, vanishes outside its
+        # support, and its cdf() is the integral of its density
+        for name, kern in Ensemble.KERNELS.items():
+            reach = kern.reach(8.0)
+            steps = 20000
+            du = 2.0 * reach / steps
+            total = 0.0
+            for i in range(0, steps):
+                u = -reach + (i + 0.5) * du
+                total += kern.density(u) * du
+                if i % 2500 == 0:
+                    self.assertAlmostEqual(kern.cdf(u + 0.5 * du), total, \
+                                           places=6, msg=name)
+            self.assertAlmostEqual(total, 1.0, places=6, msg=name)
+            self.assertAlmostEqual(kern.cdf(reach), 1.0, places=12, msg=name)
+            if kern.support != None:
+                self.assertEqual(kern.density(1.001 * kern.support), 0.0)
+                self.assertEqual(kern.cdf(-kern.support), 0.0)
+
+class EngineTest(unittest.TestCase):
+    
+    def assertClose(self, psd, reference, tolerance):
+        # Agreement relative to the peak of the reference
+        self.assertEqual(len(psd), len(reference))
+        peak = max(reference)
+        error = max([abs(a - b) for a, b in zip(psd, reference)])
+        self.assertTrue(error <= tolerance * peak, \
+                        "error {0} of peak".format(error / peak))
+    
+    @unittest.skipUnless(Ensemble.HAVE_NUMPY, "numpy is not installed")
+    def testNumpyMatchesDirect(self):
+        # The vectorised sums are the direct sums, in both spaces
+        (diameters, weights) = particles(2000)
+        for logspace in [False, True]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, "numpy", \
+                                         logspace=logspace, collapse=None)
+            self.assertClose(ens.psd, directPSD(ens), 1.0e-13)
+    
+    @unittest.skipUnless(Ensemble.HAVE_NUMPY, "numpy is not installed")
+    def testBinnedWithinBound(self):
+        # The binned sums are within errorBound() of the direct sums, on a
+        # coarse grid as on the default one
+        (diameters, weights) = particles(3000)
+        for kernel in ["Gaussian", "Epanechnikov"]:
+            for gridsize in [256, None]:
+                ens = Ensemble.KernelDensity(diameters, weights, -1, "binned", \
+                                             kernel=kernel, gridsize=gridsize, \
+                                             collapse=None)
+                (values, points) = ens.getKDECoordinates(ens.diameters)
+                bound = ens.errorBound("binned", values, points)
+                peak = Ensemble.KERNELS[kernel].norm / ens.smoothing
+                error = max([abs(a - b) for a, b \
+                             in zip(ens.psd, directPSD(ens))])
+                self.assertTrue(error <= bound * peak)
+                self.assertTrue(error > 0.0)
+    
+    def testWindowMatchesDirect(self):
+        # Truncating the Gaussian loses at most windowErrorBound(), and
+        # compact kernels are summed over their whole support
+        (diameters, weights) = particles(2000)
+        for cutoff in [2.0, None]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, "window", \
+                                         cutoff=cutoff, collapse=None)
+            error = max([abs(a - b) for a, b in zip(ens.psd, directPSD(ens))])
+            self.assertTrue(error <= ens.windowErrorBound())
+        for kernel in ["Epanechnikov", "Biweight", "Uniform"]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, "window", \
+                                         kernel=kernel, collapse=None)
+            self.assertEqual(ens.windowErrorBound(), 0.0)
+            self.assertClose(ens.psd, directPSD(ens), 1.0e-13)
+    
+    def testPrefixWideData(self):
+        # The prefix sums stay accurate when the data span many bandwidths
+        (diameters, weights) = particles(4000, sigma=1.2)
+        for kernel in ["Epanechnikov", "Biweight", "Triweight"]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, "prefix", \
+                                         kernel=kernel, collapse=None)
+            self.assertClose(ens.psd, directPSD(ens), 1.0e-11)
+
+class VariableBandwidthTest(unittest.TestCase):
+    
+    def testEnginesMatchVariableSums(self):
+        # The local factors have a geometric mean of one and widen the
+        # kernels in the tails, and each engine is within its error bound of
+        # the sum of each particle's own kernel
+        (diameters, weights) = particles(1500)
+        engines = ["direct", "window"]
+        if Ensemble.HAVE_NUMPY: engines += ["numpy", "binned"]
+        for engine in engines:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, engine, \
+                                         variable=True, collapse=None)
+            factors = ens.local_factors
+            logmean = sum([w * math.log(f) for f, w \
+                           in zip(factors, ens.weights)]) / sum(ens.weights)
+            self.assertAlmostEqual(logmean, 0.0, places=10)
+            self.assertTrue(factors[ens.diameters.index(max(ens.diameters))] > 1.0)
+            
+            kern = Ensemble.KERNELS["Gaussian"]
+            h = ens.smoothing
+            psd = [sum([w * kern.density((x - d) / (h * f)) / (h * f) \
+                        for d, w, f in zip(ens.diameters, ens.weights, factors)]) / \
+                   sum(ens.weights) for x in ens.mesh]
+            bound = ens.errorBound(engine, ens.diameters, ens.mesh)
+            error = max([abs(a - b) for a, b in zip(ens.psd, psd)])
+            self.assertTrue(error <= max(bound, 1.0e-12) * kern.norm / h, \
+                            engine)
+
+class PlannerTest(unittest.TestCase):
+    
+    def testPlansWithinAccuracy(self):
+        # The planned engine is within the accuracy asked for, an accuracy of
+        # zero leaves only the engines without error, and a loose one lets
+        # a large ensemble be binned
+        (diameters, weights) = particles(20000)
+        for accuracy in [1.0e-3, 1.0e-8, 0.0]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, "auto", \
+                                         accuracy=accuracy, collapse=None)
+            ens.psd
+            (values, points) = ens.getKDECoordinates(ens.diameters)
+            if ens.engine == "binned":
+                bound = ens.errorBound("binned", values, points)
+                self.assertTrue(bound <= accuracy)
+            peak = Ensemble.KERNELS["Gaussian"].norm / ens.smoothing
+            error = max([abs(a - b) for a, b in zip(ens.psd, directPSD(ens))])
+            self.assertTrue(error <= accuracy * peak + 1.0e-12 * max(ens.psd), \
+                            ens.engine)
+            if accuracy == 0.0:
+                self.assertTrue(ens.engine in ["direct", "numpy"])
+            elif accuracy == 1.0e-3 and Ensemble.HAVE_NUMPY:
+                self.assertEqual(ens.engine, "binned")
+    
+    def testPrefixBound(self):
+        # The prefix engine's bound covers its error against the direct sums,
+        # and the planner passes over it when the bound is too large
+        (diameters, weights) = particles(3000, sigma=1.2)
+        ens = Ensemble.KernelDensity(diameters, weights, -1, "prefix", \
+                                     kernel="Triweight", collapse=None)
+        (values, points) = ens.getKDECoordinates(ens.diameters)
+        bound = ens.errorBound("prefix", values, points)
+        self.assertTrue(bound > 0.0)
+        kern = Ensemble.KERNELS["Triweight"]
+        peak = kern.norm / ens.smoothing
+        error = max([abs(a - b) for a, b in zip(ens.psd, directPSD(ens))])
+        self.assertTrue(error <= bound * peak)
+        
+        for accuracy in [0.5 * bound, 2.0 * bound]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, "auto", \
+                                         kernel="Triweight", collapse=None, \
+                                         accuracy=accuracy)
+            ens.psd
+            self.assertTrue(ens.errorBound(ens.engine, values, points) <= \
+                            accuracy)
+            if accuracy < bound: self.assertNotEqual(ens.engine, "prefix")
+
+if __name__ == "__main__":
+    unittest.main()
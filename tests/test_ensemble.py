@@ -0,0 +1,495 @@
+"""
+test_ensemble.py
+Tests of the PSDs, statistics, particle updates and storage of
+KernelDensity, run from the top directory with:
+python -m unittest discover tests
+"""
+
+import math
+import random
+import unittest
+import datamodel.ensemble as Ensemble
+
+def rebuild(ens):
+    # A KernelDensity made from scratch from the particles stored in ens,
+    # with its bandwidth and mesh
+    fresh = Ensemble.KernelDensity(list(ens.diameters), list(ens.weights), \
+                                   ens.smoothing, engine=ens.engine, \
+                                   points=len(ens.mesh), logspace=ens.logspace, \
+                                   collapse=None)
+    fresh.setLowerBound(ens.lowerbound)
+    fresh.setUpperBound(ens.upperbound)
+    return fresh
+
+class LazyAttributeTest(unittest.TestCase):
+    
+    def testComputedWhenNeeded(self):
+        # Nothing is computed until it is asked for, asking for d50 computes
+        # what it depends on, and setting the bandwidth forgets only what
+        # depends on it
+        rng = random.Random(11)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(300)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        ens = Ensemble.KernelDensity(diameters, weights, -1, collapse=None)
+        for name in ["damean", "smoothing", "psd", "cumulative_psd", "d50"]:
+            self.assertFalse(ens.isComputed(name), name)
+        
+        ens.d50
+        for name in ["smoothing", "mesh", "psd", "cumulative_psd", "d10"]:
+            self.assertTrue(ens.isComputed(name), name)
+        
+        ens.damean
+        ens.setBandwidth(2.0)
+        self.assertTrue(ens.isComputed("damean"))
+        for name in ["smoothing", "psd", "cumulative_psd", "d50"]:
+            self.assertFalse(ens.isComputed(name), name)
+        fresh = Ensemble.KernelDensity(diameters, weights, 2.0, collapse=None)
+        self.assertEqual(ens.psd, fresh.psd)
+        self.assertEqual(ens.d50, fresh.d50)
+
+class ColumnValuesTest(unittest.TestCase):
+    
+    def testRangeBounds(self):
+        # Values far from zero get a mesh padded by a fraction of their
+        # range, and values that aren't positive have no geometric statistics
+        # or log space
+        rng = random.Random(12)
+        for centre in [1000.0, 0.0]:
+            values = [rng.gauss(centre, 5.0) for i in range(400)]
+            weights = [1.0 for v in values]
+            ens = Ensemble.KernelDensity(values, weights, -1, bounds="range", \
+                                         logspace=(centre == 0.0), \
+                                         collapse=None)
+            spread = ens.bound_multiplier * (max(values) - min(values))
+            self.assertAlmostEqual(ens.mesh[0], min(values) - spread, places=9)
+            self.assertTrue(ens.mesh[-1] < max(values) + spread)
+            self.assertAlmostEqual(ens.psd_area, 1.0, places=3)
+            if centre == 0.0:
+                self.assertFalse(ens.logspace)
+                self.assertTrue(math.isnan(ens.dgmean))
+                self.assertTrue(math.isnan(ens.gstdev))
+
+class LogSpaceTest(unittest.TestCase):
+    
+    def testLogDensity(self):
+        # In log space the mesh is geometric and the PSD is the KDE of ln(d)
+        # divided by d, so it still integrates to one over d
+        rng = random.Random(7)
+        diameters = [rng.lognormvariate(1.0, 1.5) for i in range(500)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        ens = Ensemble.KernelDensity(diameters, weights, -1, points=512, \
+                                     logspace=True, collapse=None)
+        ens.setLowerBound(min(diameters) / 5.0)
+        ens.setUpperBound(max(diameters) * 5.0)
+        ratios = [b / a for a, b in zip(ens.mesh[:-1], ens.mesh[1:])]
+        for r in ratios:
+            self.assertAlmostEqual(r, ratios[0], places=10)
+        
+        kern = Ensemble.KERNELS["Gaussian"]
+        h = ens.smoothing
+        total = sum(weights)
+        for dm, f in zip(ens.mesh[::32], ens.psd[::32]):
+            k = sum([w * kern.density((math.log(dm) - math.log(d)) / h) \
+                     for d, w in zip(diameters, weights)])
+            self.assertAlmostEqual(f, k / (total * h * dm), places=12)
+        
+        area = sum([0.5 * (a + b) * (y - x) for a, b, x, y in \
+                    zip(ens.psd[:-1], ens.psd[1:], ens.mesh[:-1], ens.mesh[1:])])
+        self.assertAlmostEqual(area, 1.0, places=3)
+
+class BandwidthTest(unittest.TestCase):
+    
+    def testSelectors(self):
+        # For normal data the selectors are close to the rule of thumb, for
+        # two well separated modes they pick narrower kernels, and scaling
+        # the weights changes nothing
+        rng = random.Random(8)
+        normal = [rng.gauss(50.0, 5.0) for i in range(2000)]
+        modes = [rng.gauss(30.0, 2.0) for i in range(1000)] + \
+                [rng.gauss(70.0, 2.0) for i in range(1000)]
+        for diameters in [normal, modes]:
+            weights = [1.0 for d in diameters]
+            auto = Ensemble.KernelDensity(diameters, weights, -1).smoothing
+            for method in ["sj", "lscv"]:
+                h = Ensemble.KernelDensity(diameters, weights, method).smoothing
+                scaled = Ensemble.KernelDensity(diameters, \
+                    [3.0 * w for w in weights], method).smoothing
+                self.assertAlmostEqual(scaled / h, 1.0, places=10)
+                if diameters is normal:
+                    self.assertTrue(0.7 * auto < h < 1.4 * auto, method)
+                else:
+                    self.assertTrue(h < 0.5 * auto, method)
+
+class QuantileTest(unittest.TestCase):
+    
+    def testExactQuantiles(self):
+        # The exact CDF is the sum of the kernel CDFs, the exact quantiles
+        # are its roots, and a fine mesh gives nearly the same quantiles. The
+        # kernels stay clear of zero diameter, where linear meshes stop.
+        rng = random.Random(9)
+        diameters = [rng.lognormvariate(3.0, 0.25) for i in range(400)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        for kernel in ["Gaussian", "Epanechnikov"]:
+            for logspace in [False, True]:
+                opts = {"kernel": kernel, "logspace": logspace, \
+                        "collapse": None}
+                ens = Ensemble.KernelDensity(diameters, weights, -1, \
+                                             quantiles="exact", **opts)
+                kern = Ensemble.KERNELS[kernel]
+                (values, points) = ens.getKDECoordinates(ens.diameters)
+                x = values[0]
+                cdf = sum([w * kern.cdf((x - v) / ens.smoothing) \
+                           for v, w in zip(values, weights)]) / sum(weights)
+                self.assertAlmostEqual(ens.evaluateCDF(x)[0], cdf, places=12)
+                
+                # A fine mesh over all of the kernels
+                reach = kern.reach(8.0) * ens.smoothing
+                (lower, upper) = (min(values) - reach, max(values) + reach)
+                if logspace: (lower, upper) = (math.exp(lower), math.exp(upper))
+                fine = Ensemble.KernelDensity(diameters, weights, -1, \
+                                              points=2048, **opts)
+                fine.setLowerBound(lower)
+                fine.setUpperBound(upper)
+                step = max([b - a for a, b in zip(fine.mesh[:-1], \
+                                                  fine.mesh[1:])])
+                for t, d in [(0.1, ens.d10), (0.5, ens.d50), (0.9, ens.d90)]:
+                    self.assertAlmostEqual(ens.getCDF(d), t, places=8)
+                    self.assertTrue(abs(d - fine.findPoint(t)) < 2.0 * step)
+
+class HistogramTest(unittest.TestCase):
+    
+    def testBinsHoldTheirWeight(self):
+        # Each bin holds the weight of the particles in it, every particle is
+        # binned, and the bin rules give the counts they should
+        rng = random.Random(13)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(500)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        total = sum(weights)
+        engines = ["direct"]
+        if Ensemble.HAVE_NUMPY: engines.append("numpy")
+        for engine in engines:
+            for logspace in [False, True]:
+                ens = Ensemble.KernelDensity(diameters, weights, -1, engine, \
+                                             bins=10, logspace=logspace, \
+                                             collapse=None)
+                self.assertEqual(len(ens.mesh), 10)
+                values = ens.getKDECoordinates(ens.diameters)[0]
+                h = ens.smoothing
+                density = ens.psd
+                if logspace:
+                    density = [f * dm for f, dm in zip(ens.psd, ens.mesh)]
+                self.assertAlmostEqual(sum(density) * h, 1.0, places=12)
+                # The bins span the particles, so the largest particle is on
+                # the upper edge of the last bin
+                for i in range(0, 10):
+                    lower = min(values) + i * h
+                    inside = sum([w for v, w in zip(values, ens.weights) \
+                                  if lower <= v < lower + h or \
+                                  (i == 9 and v == max(values))])
+                    self.assertAlmostEqual(density[i] * h, inside / total, \
+                                           places=12)
+        
+        ens = Ensemble.KernelDensity(diameters, weights, -1, bins="sturges", \
+                                     collapse=None)
+        self.assertEqual(len(ens.mesh), 10)
+
+class IncrementalUpdateTest(unittest.TestCase):
+    
+    def assertSameDensity(self, ens, fresh):
+        self.assertEqual(len(ens.psd), len(fresh.psd))
+        peak = max(fresh.psd)
+        for a, b in zip(ens.psd, fresh.psd):
+            self.assertAlmostEqual(a / peak, b / peak, places=10)
+        self.assertAlmostEqual(ens.damean, fresh.damean, places=10)
+        self.assertAlmostEqual(ens.dgmean, fresh.dgmean, places=10)
+    
+    def testRemoveRepeatedDiameter(self):
+        # The entry with enough weight is removed, not the first one found
+        ens = Ensemble.KernelDensity([10.0, 10.0, 20.0, 30.0], \
+                                     [1.0, 5.0, 2.0, 3.0], -1, collapse=None)
+        ens.psd
+        ens.removeParticles([10.0], [5.0])
+        self.assertEqual(list(ens.diameters), [10.0, 20.0, 30.0])
+        self.assertEqual(list(ens.weights), [1.0, 2.0, 3.0])
+        self.assertSameDensity(ens, rebuild(ens))
+    
+    def testUpdatesMatchRebuild(self):
+        # Adding merges particles into neighbours within the tolerance and
+        # removing undoes merges, which the kernel sums must follow
+        rng = random.Random(1)
+        for engine in ["direct", "window"]:
+            for logspace in [False, True]:
+                diameters = [rng.lognormvariate(3.0, 0.4) for i in range(200)]
+                weights = [rng.uniform(0.5, 2.0) for d in diameters]
+                ens = Ensemble.KernelDensity(diameters, weights, -1, engine, \
+                                             logspace=logspace, collapse=0.01)
+                ens.psd
+                ens.damean
+                extra = [diameters[i] * 1.004 for i in range(0, 40, 2)]
+                ens.addParticles(extra, [1.5] * len(extra))
+                ens.removeParticles(extra[:10], [1.5] * 10)
+                ens.removeParticles(diameters[1:20:3], weights[1:20:3])
+                self.assertSameDensity(ens, rebuild(ens))
+
+class CollapseTest(unittest.TestCase):
+    
+    def testCollapseIsOptIn(self):
+        # Every particle is kept unless a tolerance is given, and merging
+        # equal diameters leaves the PSD unchanged
+        diameters = [10.0, 12.0, 10.0, 15.0, 12.0]
+        weights = [1.0, 2.0, 3.0, 4.0, 5.0]
+        kept = Ensemble.KernelDensity(diameters, weights, -1)
+        merged = Ensemble.KernelDensity(diameters, weights, -1, collapse=0.0)
+        self.assertEqual(len(kept.diameters), 5)
+        self.assertEqual(list(merged.diameters), [10.0, 12.0, 15.0])
+        self.assertEqual(list(merged.weights), [4.0, 7.0, 4.0])
+        self.assertEqual(merged.num_particles, 5)
+        peak = max(kept.psd)
+        for a, b in zip(kept.psd, merged.psd):
+            self.assertAlmostEqual(a / peak, b / peak, places=12)
+
+class BootstrapTest(unittest.TestCase):
+    
+    def testBandsMatchEstimates(self):
+        # The bands bracket the estimates they are found for, with exact
+        # quantiles as with mesh ones, and don't depend on the processes
+        rng = random.Random(4)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(300)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        for quantiles in ["mesh", "exact"]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, \
+                                         quantiles=quantiles)
+            ens.calculateBootstrap(40, processes=1, seed=5)
+            bands = ens.psd_bands
+            for name in ["d10", "d50", "d90"]:
+                (lower, upper) = bands[name]
+                self.assertTrue(lower <= getattr(ens, name) <= upper)
+            again = Ensemble.KernelDensity(diameters, weights, -1, \
+                                           quantiles=quantiles)
+            again.calculateBootstrap(40, processes=2, seed=5)
+            self.assertEqual(again.psd_bands["d50"], bands["d50"])
+    
+    def testExactReplicateQuantiles(self):
+        # A replicate with the ensemble's own weights has its quantiles
+        ens = Ensemble.KernelDensity([10.0, 12.0, 13.0, 20.0], \
+                                     [1.0, 2.0, 1.0, 1.0], -1, quantiles="exact")
+        particles = Ensemble.cumulativeParticles(list(ens.diameters), \
+                                                 list(ens.weights))
+        self.assertAlmostEqual(ens.findQuantile(0.5, particles), ens.d50)
+
+class StorageTest(unittest.TestCase):
+    
+    def testFloatDiametersAreUnique(self):
+        # Diameters that differ only beyond single precision are merged
+        diameters = [10.0, 10.0 * (1.0 + 2.0e-8), 11.0]
+        ens = Ensemble.KernelDensity(diameters, [1.0, 2.0, 3.0], -1, \
+                                     collapse=0.0, storage="float")
+        self.assertEqual(len(ens.diameters), 2)
+        self.assertEqual(list(ens.weights), [3.0, 3.0])
+
+def twoPassMoments(values, weights):
+    # The weighted mean, stdev, skewness and excess kurtosis from the
+    # deviations about the mean
+    total = sum(weights)
+    mean = sum([w * v for v, w in zip(values, weights)]) / total
+    m = [sum([w * (v - mean)**k for v, w in zip(values, weights)]) / total \
+         for k in [2, 3, 4]]
+    return (mean, math.sqrt(m[0]), m[1] / m[0]**1.5, m[2] / m[0]**2 - 3.0)
+
+class MomentsTest(unittest.TestCase):
+    
+    def testStatsMatchTwoPass(self):
+        # The one-pass ensemble statistics agree with two passes over the
+        # particles, also when the spread is tiny next to the mean
+        rng = random.Random(10)
+        for offset in [0.0, 1.0e8]:
+            diameters = [offset + rng.lognormvariate(3.0, 0.4) \
+                         for i in range(500)]
+            weights = [rng.uniform(0.5, 2.0) for d in diameters]
+            ens = Ensemble.KernelDensity(diameters, weights, -1, collapse=None)
+            (mean, stdev, skewness, kurtosis) = \
+                twoPassMoments(diameters, weights)
+            self.assertAlmostEqual(ens.damean / mean, 1.0, places=12)
+            self.assertAlmostEqual(ens.astdev / stdev, 1.0, places=6)
+            self.assertAlmostEqual(ens.skewness, skewness, places=6)
+            self.assertAlmostEqual(ens.kurtosis, kurtosis, places=6)
+            
+            logs = [math.log(d) for d in diameters]
+            (lmean, lstdev, ls, lk) = twoPassMoments(logs, weights)
+            self.assertAlmostEqual(ens.dgmean / math.exp(lmean), 1.0, places=12)
+            self.assertAlmostEqual(ens.gstdev / math.exp(lstdev), 1.0, places=6)
+            
+            s = [sum([w * d**k for d, w in zip(diameters, weights)]) \
+                 for k in [2, 3, 4]]
+            self.assertAlmostEqual(ens.d32 / (s[1] / s[0]), 1.0, places=12)
+            self.assertAlmostEqual(ens.d43 / (s[2] / s[1]), 1.0, places=12)
+    
+    def testBatchMatchesOneAtATime(self):
+        # Moments added in numpy batches agree with those added singly
+        if not Ensemble.HAVE_NUMPY: return
+        rng = random.Random(3)
+        values = [rng.lognormvariate(3.0, 0.4) for i in range(3000)]
+        weights = [rng.uniform(0.5, 2.0) for v in values]
+        single = Ensemble.WeightedMoments()
+        for v, w in zip(values, weights): single.add(v, w)
+        batch = Ensemble.WeightedMoments()
+        for i in range(0, 3000, 1000):
+            batch.addArray(Ensemble.numpy.asarray(values[i:i+1000]), \
+                           Ensemble.numpy.asarray(weights[i:i+1000]))
+        self.assertAlmostEqual(batch.weight, single.weight, places=8)
+        self.assertAlmostEqual(batch.mean, single.mean, places=10)
+        self.assertAlmostEqual(batch.stdev(), single.stdev(), places=10)
+        self.assertAlmostEqual(batch.skewness(), single.skewness(), places=10)
+        self.assertAlmostEqual(batch.kurtosis(), single.kurtosis(), places=10)
+
+class WeightSetTest(unittest.TestCase):
+    
+    def testOnePassMatchesSeparatePasses(self):
+        # The number PSD and the weighted PSDs from one pass agree with each
+        # weighting evaluated on its own by the same engine. A short window
+        # cutoff tells the window engine apart from the others.
+        rng = random.Random(2)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(500)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        weightsets = {"surface": [w * d**2 for w, d in zip(weights, diameters)], \
+                      "volume": [w * d**3 for w, d in zip(weights, diameters)]}
+        plans = [("direct", "Gaussian"), ("window", "Gaussian"), \
+                 ("prefix", "Biweight")]
+        if Ensemble.HAVE_NUMPY: plans += [("numpy", "Gaussian"), \
+                                          ("binned", "Gaussian")]
+        for engine, kernel in plans:
+            for logspace in [False, True]:
+                opts = {"logspace": logspace, "kernel": kernel, "cutoff": 2.0}
+                ens = Ensemble.KernelDensity(diameters, weights, -1, engine, \
+                                             weightsets=weightsets, **opts)
+                single = Ensemble.KernelDensity(diameters, weights, -1, engine, \
+                                                **opts)
+                (values, points) = ens.getKDECoordinates(ens.diameters)
+                for name in ["surface", "volume"]:
+                    psd = ens.applyJacobian(ens.evaluatePSD(values, \
+                        ens.weightsets[name], points, ens.smoothing))
+                    peak = max(psd)
+                    for a, b in zip(ens.weighted_psds[name], psd):
+                        self.assertAlmostEqual(a / peak, b / peak, places=12)
+                peak = max(single.psd)
+                for a, b in zip(ens.psd, single.psd):
+                    self.assertAlmostEqual(a / peak, b / peak, places=12)
+
+class AdaptiveMeshTest(unittest.TestCase):
+    
+    def testMeshIsRefinedAndExact(self):
+        # The adaptive mesh reaches ADAPTIVE_REACH bandwidths beyond the
+        # particles (but not below zero diameter), its PSD is the kernel sum at each of its points, and the
+        # mesh size asked for by the user is left alone
+        rng = random.Random(5)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(300)]
+        weights = [1.0 for d in diameters]
+        for logspace in [False, True]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, mesh="adaptive", \
+                                         points=32, logspace=logspace, \
+                                         collapse=None)
+            self.assertTrue(len(ens.mesh) > Ensemble.ADAPTIVE_START)
+            self.assertEqual(ens.num_points, 32)
+            (values, points) = ens.getKDECoordinates(ens.diameters)
+            reach = Ensemble.ADAPTIVE_REACH * ens.smoothing
+            lower = min(values) - reach
+            if not logspace: lower = max(lower, 0.0)
+            self.assertAlmostEqual(points[0], lower, places=9)
+            self.assertAlmostEqual(points[-1], max(values) + reach, places=9)
+            self.assertAlmostEqual(ens.cumulative_psd[-1], 1.0, places=3)
+            psd = ens.applyJacobian(ens.evaluatePSD(values, ens.weights, \
+                                                    points, ens.smoothing))
+            for a, b in zip(ens.psd, psd):
+                self.assertAlmostEqual(a, b, places=12)
+    
+    def testMeshKeepsUserBounds(self):
+        # Bounds set by the user clip the adaptive mesh
+        rng = random.Random(6)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(300)]
+        weights = [1.0 for d in diameters]
+        for logspace in [False, True]:
+            ens = Ensemble.KernelDensity(diameters, weights, -1, mesh="adaptive", \
+                                         logspace=logspace, collapse=None)
+            ens.setLowerBound(15.0)
+            ens.setUpperBound(30.0)
+            self.assertAlmostEqual(ens.mesh[0], 15.0, places=9)
+            self.assertAlmostEqual(ens.mesh[-1], 30.0, places=9)
+            self.assertEqual(ens.lowerbound, 15.0)
+            self.assertEqual(ens.upperbound, 30.0)
+
+class JointTest(unittest.TestCase):
+    
+    def testJointMatchesProductSums(self):
+        # The binned joint density is close to the sum of the product
+        # kernels, in linear and log space along each axis, with numpy (on a
+        # refined grid) and without it
+        rng = random.Random(14)
+        xs = [rng.lognormvariate(3.0, 0.4) for i in range(300)]
+        ys = [x * rng.lognormvariate(0.5, 0.2) for x in xs]
+        weights = [rng.uniform(0.5, 2.0) for x in xs]
+        kern = Ensemble.KERNELS["Gaussian"]
+        have_numpy = Ensemble.HAVE_NUMPY
+        plans = [(False, 0.05)]
+        if have_numpy: plans.append((True, 0.01))
+        try:
+            for use_numpy, tolerance in plans:
+                Ensemble.HAVE_NUMPY = use_numpy
+                for logspace in [(False, False), (True, True), (False, True)]:
+                    joint = Ensemble.JointKernelDensity(xs, ys, weights, \
+                        points=32, logspace=logspace)
+                    (hx, hy) = joint.smoothing
+                    (u, v) = (xs, ys)
+                    if logspace[0]: u = [math.log(x) for x in xs]
+                    if logspace[1]: v = [math.log(y) for y in ys]
+                    density = []
+                    for x in joint.xmesh:
+                        fx = x
+                        if logspace[0]: fx = math.log(x)
+                        kx = [kern.density((fx - a) / hx) for a in u]
+                        row = []
+                        for y in joint.ymesh:
+                            fy = y
+                            if logspace[1]: fy = math.log(y)
+                            f = sum([w * k * kern.density((fy - b) / hy) \
+                                     for k, b, w in zip(kx, v, weights)])
+                            f /= sum(weights) * hx * hy
+                            if logspace[0]: f /= x
+                            if logspace[1]: f /= y
+                            row.append(f)
+                        density.append(row)
+                    peak = max([max(row) for row in density])
+                    error = max([abs(a - b) for got, want in \
+                                 zip(joint.density, density) \
+                                 for a, b in zip(got, want)])
+                    self.assertTrue(error <= tolerance * peak, logspace)
+        finally:
+            Ensemble.HAVE_NUMPY = have_numpy
+
+class SweepTest(unittest.TestCase):
+    
+    def testSweepMatchesEachBandwidth(self):
+        # Each PSD of a sweep is the PSD for that bandwidth on its own, with
+        # the bandwidths taken in ln(d) in log space as for setBandwidth.
+        # The binned sweep shares one grid wide enough for the largest
+        # bandwidth, so it agrees only to within the binning error.
+        rng = random.Random(4)
+        diameters = [rng.lognormvariate(3.0, 0.4) for i in range(400)]
+        weights = [rng.uniform(0.5, 2.0) for d in diameters]
+        plans = [("direct", 12), ("window", 12)]
+        if Ensemble.HAVE_NUMPY: plans += [("numpy", 12), ("binned", 4)]
+        for engine, places in plans:
+            for logspace, bandwidths in [(False, [1.0, 2.5]), \
+                                         (True, [0.05, 0.12])]:
+                ens = Ensemble.KernelDensity(diameters, weights, -1, engine, \
+                                             logspace=logspace, collapse=None)
+                psds = ens.calculateBandwidthSweep(bandwidths)
+                for h, psd in zip(bandwidths, psds):
+                    ens.smoothing = h
+                    fresh = rebuild(ens)
+                    self.assertEqual(fresh.mesh, ens.mesh)
+                    peak = max(fresh.psd)
+                    for a, b in zip(psd, fresh.psd):
+                        self.assertAlmostEqual(a / peak, b / peak, places=places)
+
+if __name__ == "__main__":
+    unittest.main()
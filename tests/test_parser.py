@@ -0,0 +1,222 @@
+"""
+test_parser.py
+Tests of the MOPS CSV parsers, run from the top directory with:
+python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import datamodel.mops_parser as MParser
+
+PSL_HEADERS = ["Weight", "Equiv. Sphere Diameter (nm)", \
+               "Collision Diameter (nm)", "Mobility Diameter (nm)", \
+               "Surface Area (cm2)", "Volume (cm3)", "Age (s)", "Num coags", \
+               "Avg. Sintering Level"]
+
+def writePSL(directory, rows=200, seed=1, name="test-psl.csv"):
+    # Writes a PSL of random particles, returning its path and its rows
+    rng = random.Random(seed)
+    data = []
+    for i in range(0, rows):
+        d = rng.lognormvariate(3.0, 0.4)
+        data.append([rng.uniform(1.0e3, 1.0e4), d, 2.0 * d, 2.1 * d, \
+                     3.14e-14 * d * d, 5.2e-22 * d**3, rng.uniform(0.0, 1.0), \
+                     float(rng.randint(0, 100)), rng.random()])
+    fname = os.path.join(directory, name)
+    stream = open(fname, "w")
+    stream.write(",".join(PSL_HEADERS) + "\n")
+    for row in data:
+        stream.write(",".join([repr(x) for x in row]) + "\n")
+    stream.close()
+    return (fname, data)
+
+class ParserTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        (self.fname, self.data) = writePSL(self.directory)
+    
+    def tearDown(self):
+        MParser.setColumnCache(None)
+        shutil.rmtree(self.directory)
+
+class ColumnTest(ParserTest):
+    
+    def testFindColumn(self):
+        # Columns are found by header, then by regular expression ignoring
+        # case, and 0 is returned for no match or a bad expression
+        parser = MParser.PSLHeaderParser(self.fname)
+        line = parser.getHeaderFields()
+        parser.closeCSV()
+        self.assertEqual(parser.findColumn(line, "Age (s)"), 6)
+        self.assertEqual(parser.findColumn(line, "num coags"), 7)
+        self.assertEqual(parser.findColumn(line, "Sintering"), 8)
+        self.assertEqual(parser.findColumn(line, "^Mob.*nm"), 3)
+        self.assertEqual(parser.findColumn(line, "Weight"), 0)
+        self.assertEqual(parser.findColumn(line, "Charge"), 0)
+        self.assertEqual(parser.findColumn(line, "Age ("), 0)
+    
+    def testReadAnyColumn(self):
+        # Any column is read with the weights, as for the diameters
+        parser = MParser.PSLParser(self.fname)
+        results = parser.start([["Age (s)", 6, -1], ["Num coags", 7, -1]])
+        self.assertEqual(results[0], [row[0] for row in self.data])
+        self.assertEqual(results[1][2], [row[6] for row in self.data])
+        self.assertEqual(results[2][2], [row[7] for row in self.data])
+
+class ReadColumnsTest(ParserTest):
+    
+    def readLines(self, columns):
+        # The columns as read by getCSVLine() from each line
+        parser = MParser.Parser(self.fname)
+        parser.m_istream.readline()
+        rows = [parser.getCSVLine(l, type(1.0), ",") for l in parser.m_istream]
+        parser.closeCSV()
+        return [[row[j] for row in rows] for j in columns]
+    
+    def readBulk(self, columns, typecodes=None):
+        parser = MParser.Parser(self.fname)
+        parser.m_istream.readline()
+        results = parser.readColumns(columns, ",", typecodes)
+        parser.closeCSV()
+        return results
+    
+    def testMatchesLineByLine(self):
+        # The bulk read gives the same numbers as the line-by-line parser,
+        # with or without numpy, as numpy arrays, lists or typed arrays
+        columns = [0, 1, 6, 8]
+        expected = self.readLines(columns)
+        have_numpy = MParser.HAVE_NUMPY
+        try:
+            for use_numpy in set([have_numpy, False]):
+                MParser.HAVE_NUMPY = use_numpy
+                bulk = self.readBulk(columns)
+                for column, values in zip(bulk, expected):
+                    if use_numpy:
+                        self.assertTrue(column.flags["C_CONTIGUOUS"])
+                    self.assertEqual(list(column), values)
+                bulk = self.readBulk(columns, ["d", "f", "d", None])
+                self.assertEqual(bulk[0].typecode, "d")
+                self.assertEqual(list(bulk[0]), expected[0])
+                self.assertEqual(bulk[1].typecode, "f")
+                for a, b in zip(bulk[1], expected[1]):
+                    self.assertAlmostEqual(a / b, 1.0, places=6)
+        finally:
+            MParser.HAVE_NUMPY = have_numpy
+    
+    def testRaggedRows(self):
+        # A file whose rows differ in length is left to the line-by-line
+        # parser
+        stream = open(self.fname, "a")
+        stream.write("1.0,2.0\n")
+        stream.close()
+        self.assertEqual(self.readBulk([0, 1]), None)
+    
+    def testPSLStorage(self):
+        # PSLParser gives the same columns for each storage type
+        data = [["d_sph", 1, -1], ["Age (s)", 6, -1]]
+        lists = MParser.PSLParser(self.fname).start(data)
+        for storage in ["double", "float"]:
+            arrays = MParser.PSLParser(self.fname).start(data, storage)
+            self.assertEqual(arrays[0].typecode, "d")
+            self.assertEqual(list(arrays[0]), lists[0])
+            for a, b in zip(arrays[1:], lists[1:]):
+                self.assertEqual(a[:2], b[:2])
+                for x, y in zip(a[2], b[2]):
+                    self.assertAlmostEqual(x / y, 1.0, places=6)
+
+class ColumnCacheTest(ParserTest):
+    
+    def readBulk(self, fname, columns):
+        parser = MParser.Parser(fname)
+        parser.m_istream.readline()
+        results = parser.readColumns(columns, ",")
+        parser.closeCSV()
+        return [list(column) for column in results]
+    
+    def sidecars(self, directory):
+        return sorted([name for name in os.listdir(directory) \
+                       if name.endswith(".cols")])
+    
+    def testSaveLoadAndStale(self):
+        # The first read writes a sidecar file that the next read loads, and
+        # the sidecar of a CSV that has changed is removed and written again
+        directory = os.path.join(self.directory, "cache")
+        cache = MParser.ColumnCache(directory)
+        MParser.setColumnCache(cache)
+        first = self.readBulk(self.fname, [0, 1, 6])
+        self.assertEqual(len(self.sidecars(directory)), 1)
+        stamp = cache.getStamp(self.fname, ",", os.stat(self.fname))
+        self.assertNotEqual(cache.load(self.fname, ",", [0, 1, 6], \
+                                       [None] * 3, os.stat(self.fname)), None)
+        self.assertEqual(self.readBulk(self.fname, [0, 1, 6]), first)
+        self.assertEqual(first[1], [row[1] for row in self.data])
+        
+        (fname, data) = writePSL(self.directory, rows=150, seed=2)
+        self.assertNotEqual(cache.getStamp(fname, ",", os.stat(fname)), stamp)
+        self.assertEqual(cache.load(fname, ",", [0], [None], \
+                                    os.stat(fname)), None)
+        self.assertEqual(self.sidecars(directory), [])
+        self.assertEqual(self.readBulk(fname, [1])[0], \
+                         [row[1] for row in data])
+        self.assertEqual(len(self.sidecars(directory)), 1)
+    
+    def testEvictLeastRecentlyUsed(self):
+        # Caching a file beyond the capacity removes the least recently used
+        # sidecar file, and loading a file marks it as used
+        directory = os.path.join(self.directory, "cache")
+        names = ["a-psl.csv", "b-psl.csv", "c-psl.csv"]
+        files = [writePSL(self.directory, name=name)[0] for name in names]
+        MParser.setColumnCache(MParser.ColumnCache(directory))
+        self.readBulk(files[0], [0])
+        size = os.path.getsize(os.path.join(directory, \
+                                            self.sidecars(directory)[0]))
+        MParser.setColumnCache(MParser.ColumnCache(directory, 2 * size))
+        self.readBulk(files[1], [0])
+        
+        # a is loaded after b was cached, so b is the one to go
+        for name, age in zip(self.sidecars(directory), [200, 100]):
+            path = os.path.join(directory, name)
+            os.utime(path, (os.path.getatime(path), os.path.getmtime(path) - age))
+        self.readBulk(files[0], [0])
+        self.readBulk(files[2], [0])
+        cached = self.sidecars(directory)
+        self.assertEqual(len(cached), 2)
+        self.assertTrue(cached[0].startswith("a-psl.csv"))
+        self.assertTrue(cached[1].startswith("c-psl.csv"))
+
+class FileSessionTest(ParserTest):
+    
+    def testParsersShareSession(self):
+        # The parsers of a session read the one open file from its start,
+        # with the headers split once, and leave it open until the with
+        # statement ends
+        data = [["d_sph", 1, -1]]
+        alone = MParser.PSLParser(self.fname).start(data)
+        with MParser.FileSession(self.fname) as session:
+            hparser = MParser.PSLHeaderParser(session)
+            line = hparser.getHeaderFields()
+            self.assertEqual(line, PSL_HEADERS)
+            self.assertTrue(session.getHeaderFields() is session.m_headers)
+            self.assertEqual(hparser.getFormat(line), "psl")
+            hparser.closeCSV()
+            self.assertFalse(session.m_istream.closed)
+            self.assertEqual(MParser.PSLParser(session).start(data), alone)
+            self.assertEqual(MParser.PSLParser(session).start(data), alone)
+            self.assertFalse(session.m_istream.closed)
+        self.assertTrue(session.m_istream.closed)
+    
+    def testClosedOnError(self):
+        # The file is closed when a parser fails inside the with statement
+        try:
+            with MParser.FileSession(self.fname) as session:
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(session.m_istream.closed)
+
+if __name__ == "__main__":
+    unittest.main()